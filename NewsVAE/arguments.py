@@ -66,6 +66,14 @@ def preprare_parser(jupyter=False, print_settings=True):
     parser.add_argument("--ddp", default=False, type=lambda x: bool(distutils.util.strtobool(x)),
                         help="Whether or not to use Distributed Data Parallel (DDP) "
                              "(default: True if n_gpus > 1, else: False).")
+    parser.add_argument("--device_type", default="cuda", type=str,
+                        help="Which device type to run on: cuda (DDP with nccl) or cpu (DDP with gloo) "
+                             "(default: cuda).")
+    parser.add_argument("--n_cpu_processes", default=1, type=int,
+                        help="Number of processes per node with DDP on CPU (default: 1).")
+    parser.add_argument("--n_threads_per_process", default=-1, type=int,
+                        help="Number of threads per CPU process, -1 divides the cores over the "
+                             "processes (default: -1).")
 
     # LOGGING
     parser.add_argument("--logging", default=True, type=lambda x: bool(distutils.util.strtobool(x)),
@@ -121,6 +129,17 @@ def preprare_parser(jupyter=False, print_settings=True):
                         help="How many posterior samples should be used for importance weighted LL eval (default: 300).")
     parser.add_argument("--max_seq_len_x_gen", default=64, type=int,
                         help="What the maximum length is for sequences sampled from the model (default: 64).")
+    parser.add_argument("--iw_ll_sampling", default="iid", type=str,
+                        help="How to draw the posterior samples for IW LL eval, options: iid, antithetic, sobol "
+                             "(default: iid).")
+    parser.add_argument("--x_gen_pool_size", default=1024, type=int,
+                        help="How many samples to generate and sort by length together for the IW LL evaluation of "
+                             "generated data. The pool generates one batch per validation step in rounds of this "
+                             "size at the start of the validation epoch. If 0, a new batch is generated every "
+                             "validation step (default: 1024).")
+    parser.add_argument("--x_gen_pool_background", default=True, type=lambda x: bool(distutils.util.strtobool(x)),
+                        help="Whether or not to generate the x_gen pool concurrently with the validation steps "
+                             "(default: True).")
 
     # SEED
     parser.add_argument("--seed", default=0, type=int,
@@ -383,12 +402,25 @@ def preprare_parser(jupyter=False, print_settings=True):
                         help="The learning rate for KDE 1d dim marginal KL constraint optimiser.")
     parser.add_argument("--kde1d_constraint_relation", default="le", type=str,
                         help="The relation for the KDE 1d dim marginal KL constraint, valid options: [ge, le, eq] (default: le)")
+    parser.add_argument("--kde1d_mode", default="pooled", type=str,
+                        help="1D KDE for the dim marginal KL: one KDE over all latent values (pooled) or a KDE per "
+                             "dimension with its own bandwidth (per_dimension) (default: pooled)")
 
 
     # ---------------------
     # BETA - TC - VAE     #
     # ---------------------
 
+    # Memory bank of recent posteriors (mu, logvar) as extra mixture components of q(z) for the
+    # log q(z) and log prod q(z_d) estimates (MI, TC, dim-KL), also used by the hoffman objective
+    parser.add_argument("--posterior_bank_size", default=0, type=int,
+                        help="Number of recent posteriors (mu, logvar) kept in a FIFO memory bank and used as extra "
+                             "(detached) components of q(z) in the log q(z) estimates. 0 means no bank, the "
+                             "estimates only use the current batch (default: 0).")
+    parser.add_argument("--posterior_bank_staleness_decay", default=1.0, type=float,
+                        help="Weight decay per training step of the memory bank entries: an entry pushed k steps ago "
+                             "has weight decay ** k. 1.0 means no down weighting (default: 1.0).")
+
     # ----------------------------------------------------
     # alpha * MI
     # How is the MI term managed
@@ -465,6 +497,10 @@ def preprare_parser(jupyter=False, print_settings=True):
 
     parser.add_argument("--mmd_vae_lambda", default=10000, type=float,
                         help="Lambda to weight the MMD loss (default: lambda = 10e3).")
+    parser.add_argument("--mmd_estimator", default="quadratic", type=str,
+                        help="MMD estimator for mmd-vae and the tts_mmd of the constraint objectives, valid options: "
+                             "[quadratic, linear]. The linear time estimate is unbiased but has a higher variance, "
+                             "meant for large batches (default: quadratic).")
 
     # ---------------------
     # HOFFMAN -VAE        #
@@ -574,6 +610,12 @@ def preprare_parser(jupyter=False, print_settings=True):
 
     assert args.kde1d_constraint_relation in ["le", "eq", "ge"], \
         "invalid constraint relation for kde1d_dim_margkl, must be one of eq, ge, le"
+    assert args.kde1d_mode in ["pooled", "per_dimension"], \
+        "invalid kde1d_mode, must be one of pooled, per_dimension"
+    assert args.mmd_estimator in ["quadratic", "linear"], \
+        "invalid mmd_estimator, must be one of quadratic, linear"
+    assert 0.0 < args.posterior_bank_staleness_decay <= 1.0, \
+        "invalid posterior_bank_staleness_decay, must be in (0, 1]"
     assert args.mmd_constraint_relation in ["le", "eq", "ge"], \
         "invalid constraint relation mmd, must be one of eq, ge, le"
     assert args.distortion_constraint_relation in ["le", "eq", "ge"], \
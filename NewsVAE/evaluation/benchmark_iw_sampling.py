@@ -0,0 +1,100 @@
+import argparse
+import sys
+sys.path.append("/home/cbarkhof/code-thesis/NewsVAE")
+from dataset_wrappper import NewsData
+from utils_train import transfer_batch_to_device, load_from_checkpoint
+from utils_evaluation import benchmark_iw_sampling, iw_samples_needed, dump_pickle
+from pytorch_lightning import seed_everything
+from pathlib import Path
+import numpy as np
+import torch
+import os
+
+
+def benchmark(config):
+    seed_everything(config.seed)
+
+    vae_model = load_from_checkpoint(path=config.model_path, device_name=config.device_name,
+                                     latent_size=config.latent_size, evaluation=True)
+    vae_model = vae_model.to(config.device_name)
+    vae_model.eval()
+
+    data = NewsData(config.dataset_name, "roberta", batch_size=config.batch_size, num_workers=config.num_workers,
+                    pin_memory=True, max_seq_len=64, device=config.device_name)
+    loader = data.val_dataloader(shuffle=False, batch_size=config.batch_size)
+
+    sample_sizes = [int(n) for n in config.sample_sizes.split(",")]
+    sampling_schemes = config.sampling_schemes.split(",")
+
+    batch_results = []
+    for batch_i, batch in enumerate(loader):
+        print(f"Batch {batch_i + 1}/{config.max_batches}")
+        batch = transfer_batch_to_device(batch, device_name=config.device_name)
+
+        with torch.no_grad():
+            batch_results.append(benchmark_iw_sampling(vae_model, batch, sampling_schemes=sampling_schemes,
+                                                       sample_sizes=sample_sizes,
+                                                       reference_n_samples=config.reference_n_samples,
+                                                       n_repeats=config.n_repeats, verbose=True))
+
+        if batch_i + 1 == config.max_batches:
+            break
+
+    # Average the standard errors over batches
+    std_error = {s: {n: np.mean([r["std_error"][s][n] for r in batch_results]) for n in
+                     batch_results[0]["std_error"][s].keys()} for s in sampling_schemes}
+    reference_std_error, samples_needed = iw_samples_needed(std_error, config.reference_n_samples)
+
+    print("-" * 60)
+    print(f"Reference: iid with {config.reference_n_samples} samples, std. error {reference_std_error:.4f}")
+    print("-" * 60)
+    for s in sampling_schemes:
+        errors = "  ".join([f"{n}: {e:.4f}" for n, e in sorted(std_error[s].items())])
+        print(f"{s:10s} | samples needed: {str(samples_needed[s]):5s} | {errors}")
+
+    result_dir = Path(config.result_dir_path)
+    os.makedirs(result_dir, exist_ok=True)
+    run_name = config.model_path.split("/")[-2]
+    dump_pickle({"std_error": std_error, "reference_std_error": reference_std_error,
+                 "samples_needed": samples_needed, "batch_results": batch_results},
+                result_dir / f"{run_name}_iw_sampling_benchmark_max_batches_{config.max_batches}.pickle")
+
+
+def get_config():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model_path", required=True, type=str,
+                        help="Path to the model needed to evaluate it.")
+    parser.add_argument("--result_dir_path", required=False, type=str,
+                        default="/home/cbarkhof/code-thesis/NewsVAE/evaluation/result-files/iw-sampling-benchmark",
+                        help="Path to directory to store the results.")
+    parser.add_argument("--dataset_name", required=False, type=str,
+                        default="ptb_text_only", help="The name of the dataset (default: ptb_text_only).")
+    parser.add_argument("--latent_size", required=False, type=int, default=32,
+                        help="Latent size of the model (default: 32).")
+    parser.add_argument("--batch_size", required=False, type=int, default=16,
+                        help="Batch size (default: 16).")
+    parser.add_argument("--max_batches", required=False, type=int, default=4,
+                        help="Number of validation batches to benchmark on (default: 4).")
+    parser.add_argument("--sampling_schemes", required=False, type=str, default="iid,antithetic,sobol",
+                        help="Comma separated sampling schemes (default: iid,antithetic,sobol).")
+    parser.add_argument("--sample_sizes", required=False, type=str, default="32,64,128,256,512,600",
+                        help="Comma separated numbers of samples (default: 32,64,128,256,512,600).")
+    parser.add_argument("--reference_n_samples", required=False, type=int, default=600,
+                        help="Number of iid samples of the reference standard error (default: 600).")
+    parser.add_argument("--n_repeats", required=False, type=int, default=10,
+                        help="Number of repeated estimates to measure the standard error (default: 10).")
+    parser.add_argument("--num_workers", required=False, type=int, default=2,
+                        help="Num workers for data loading (default: 2).")
+    parser.add_argument("--device_name", required=False, type=str, default="cuda:0",
+                        help="Device to run on (default: cuda:0).")
+    parser.add_argument("--seed", required=False, type=int, default=0,
+                        help="Seed (default: 0).")
+
+    config = parser.parse_args()
+
+    return config
+
+
+if __name__ == "__main__":
+    benchmark(get_config())
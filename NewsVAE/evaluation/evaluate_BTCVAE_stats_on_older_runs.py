@@ -8,57 +8,44 @@ from pytorch_lightning import seed_everything
 from pathlib import Path
 import torch
 import numpy as np
-import pickle
 import os
 import copy
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-import torch.distributed as dist
-from utils_train import set_ddp_environment_vars, load_from_checkpoint
-from utils_evaluation import load_pickle, dump_pickle
+from utils_train import set_ddp_environment_vars, load_from_checkpoint, set_device, init_process_group, \
+    all_gather_results, load_shared_model
+from utils_evaluation import dump_pickle
 import distutils
 
 
-def combine_result_files(result_dir_path, run_name, max_batches, batch_size, n_samples):
-    all_res = dict()
+def get_latent_size(model_path):
+    return 32 if "latent32" in model_path else 64
 
-    # write away the accumulated results
-    result_dir = Path(result_dir_path)
-
-    # accumulate all results from cuda 0 to 3
-    for f in os.listdir(result_dir_path):
-        if "cuda" in f and run_name in f:
-            r = load_pickle(str(result_dir / f))
-            for k, v in r.items():
-                if k in all_res:
-                    all_res[k].append(v)
-                else:
-                    all_res[k] = [v]
-
-    # cat all tensors in list
-    for k, v in all_res.items():
-        all_res[k] = torch.cat(v)
 
-    result_file = result_dir / f"{run_name}_max_batches_{max_batches}_batch_size_{batch_size}_n_samples_{n_samples}.pickle"
-    dump_pickle(all_res, result_file)
+def get_load_kwargs(model_path, objective):
+    return dict(path=model_path, latent_size=get_latent_size(model_path), do_tie_embedding_spaces=True,
+                add_decoder_output_embedding_bias=False, do_tie_weights=True, add_latent_via_embeddings=False,
+                add_latent_via_memory=True, objective=objective, evaluation=True)
 
 
 def get_dist_validation_loader(batch_size=12, num_workers=8, max_seq_len=64, world_size=4,
                                dataset_name="cnn_dailymail", tokenizer_name="roberta",
                                device_name="cuda:0", gpu_rank=0):
     # Get data
+    pin_memory = True if "cuda" in device_name else False
     data = NewsData(dataset_name, tokenizer_name,
                     batch_size=batch_size, num_workers=num_workers,
-                    pin_memory=True, max_seq_len=max_seq_len,
+                    pin_memory=pin_memory, max_seq_len=max_seq_len,
                     device=device_name)
 
-    # Get distributed sampler
+    # Shuffled (not length-sorted) batches: the statistics of this script are minibatch estimates
+    # (minibatch weighted log q(z), MI, TC, dim-KL, posterior std over x), which depend on the batch composition
     sampler = DistributedSampler(data.datasets["validation"], num_replicas=world_size,
                                  shuffle=True, rank=gpu_rank)
 
     # Get data loader
     loader = DataLoader(data.datasets["validation"], batch_size=batch_size,
-                        sampler=sampler, pin_memory=True, shuffle=False,
+                        sampler=sampler, pin_memory=pin_memory, shuffle=False,
                         num_workers=num_workers, collate_fn=data.collate_fn)
 
     return loader
@@ -67,14 +54,16 @@ def get_dist_validation_loader(batch_size=12, num_workers=8, max_seq_len=64, wor
 
 def evaluation_function(device_rank, run_name, model_path, max_batches,
                         result_dir_path, batch_size, dataset_name, objective,
-                        world_size, num_workers):
+                        world_size, num_workers, device_type="cuda", n_threads_per_process=-1, vae_model=None):
     # Prepare some variables & result directory
-    device_name = f"cuda:{device_rank}"
-    latent_size = 32 if "latent32" in model_path else 64
+    device_name = set_device(device_rank, device_type=device_type, n_threads=n_threads_per_process,
+                             world_size=world_size)
+    latent_size = get_latent_size(model_path)
     result_dir = Path(result_dir_path)
     os.makedirs(result_dir, exist_ok=True)
 
-    result_file = result_dir / f"{device_name}_{run_name}_max_batches_{max_batches}.pickle"
+    # One result file for all ranks, gathered and written by the master rank
+    result_file = result_dir / f"{run_name}_world_size_{world_size}_max_batches_{max_batches}.pickle"
 
     if os.path.isfile(result_file):
 
@@ -94,22 +83,17 @@ def evaluation_function(device_rank, run_name, model_path, max_batches,
         print("device name:", device_name)
         print("-" * 30)
 
-        # Get model
-        # vae_model = #(path=model_path, device_name=device_name)
-        vae_model = load_from_checkpoint(path=model_path, device_name=device_name, latent_size=latent_size,
-                                         do_tie_embedding_spaces=True,
-                                         add_decoder_output_embedding_bias=False, do_tie_weights=True,
-                                         add_latent_via_embeddings=False,
-                                         add_latent_via_memory=True, objective=objective, evaluation=True)
-        vae_model = vae_model.to(device_name)
+        # Get model (unless a model in shared memory is given)
+        if vae_model is None:
+            vae_model = load_from_checkpoint(device_name=device_name, **get_load_kwargs(model_path, objective))
+            vae_model = vae_model.to(device_name)
 
         # Get distributed validation data loader of PTB data set
         loader = get_dist_validation_loader(batch_size=batch_size, num_workers=num_workers, max_seq_len=64,
                                             world_size=world_size, dataset_name=dataset_name, tokenizer_name="roberta",
                                             device_name=device_name, gpu_rank=device_rank)
 
-        dist.init_process_group(backend='nccl', init_method='env://',
-                                world_size=world_size, rank=device_rank)
+        init_process_group(device_rank, world_size, device_type=device_type)
 
         # Seed everything
         seed_everything(0)
@@ -154,11 +138,16 @@ def evaluation_function(device_rank, run_name, model_path, max_batches,
                         else:
                             results[k].append(v)
 
-                if batch_i + 1 == max_batches:
-                    break
+            if batch_i + 1 == N:
+                break
 
-            # Dump the results for this device
-            pickle.dump(results, open(result_file, "wb"))
+        # Gather the per batch results of all ranks (in rank order) and dump them on the master rank
+        results = {k: torch.tensor(v) if all(isinstance(x, (int, float)) for x in v) else v
+                   for k, v in results.items()}
+        all_results = all_gather_results(results, world_size)
+
+        if device_rank == 0:
+            dump_pickle(all_results, result_file)
 
 def get_config():
     parser = argparse.ArgumentParser()
@@ -179,7 +168,13 @@ def get_config():
     parser.add_argument("--num_workers", required=False, type=int, default=2,
                         help="Num workers for data loading (default: 8).")
     parser.add_argument("--world_size", required=False, type=int, default=2,
-                        help="Number of GPUs to use (default: 4).")
+                        help="Number of processes (GPUs or CPU processes) to use (default: 2).")
+    parser.add_argument("--device_type", required=False, type=str, default="cuda",
+                        help="Device type: cuda (one process per GPU, nccl) or cpu (gloo) (default: cuda).")
+    parser.add_argument("--n_threads_per_process", required=False, type=int, default=-1,
+                        help="Threads per CPU process, -1 divides the cores over the processes (default: -1).")
+    parser.add_argument("--share_model_memory", default=True, type=lambda x: bool(distutils.util.strtobool(x)),
+                        help="On CPU, load the model once in shared memory for all processes (default: True).")
     parser.add_argument("--objective", required=False, type=str,
                         default="beta-tc-vae",
                         help="Which objective to use.")
@@ -191,14 +186,22 @@ def get_config():
 
 def main(config):
     # INIT DDP
-    # print(f"*** Using DDP, spawing 4 processes")
+    print(f"*** Using DDP, spawing {config.world_size} processes on {config.device_type}")
     set_ddp_environment_vars(port_nr=1236)
     seed_everything(0)
     run_name = config.model_path.split("/")[-2]
-    mp.spawn(evaluation_function, nprocs=4, args=(run_name, config.model_path, config.max_batches,
-                                                  config.result_dir_path, config.batch_size, config.dataset_name, config.objective,
-                                                  config.world_size, config.num_workers))
-    combine_result_files(config.result_dir_path, run_name, config.max_batches, config.batch_size, config.n_samples)
+
+    # On CPU all processes share one copy of the weights, loaded here once
+    vae_model = None
+    if config.device_type == "cpu" and config.share_model_memory:
+        load_kwargs = get_load_kwargs(config.model_path, config.objective)
+        vae_model = load_shared_model(load_kwargs.pop("path"), **load_kwargs)
+
+    mp.spawn(evaluation_function, nprocs=config.world_size,
+             args=(run_name, config.model_path, config.max_batches,
+                   config.result_dir_path, config.batch_size, config.dataset_name, config.objective,
+                   config.world_size, config.num_workers, config.device_type, config.n_threads_per_process,
+                   vae_model))
 
 
 if __name__ == "__main__":
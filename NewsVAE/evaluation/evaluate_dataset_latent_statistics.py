@@ -0,0 +1,178 @@
+import torch.multiprocessing as mp
+import argparse
+import sys
+sys.path.append("/home/cbarkhof/code-thesis/NewsVAE")
+from dataset_wrappper import NewsData
+from pytorch_lightning import seed_everything
+from pathlib import Path
+import torch
+import os
+from torch.utils.data import DataLoader, Subset
+from utils_train import set_ddp_environment_vars, load_from_checkpoint, set_device, init_process_group, \
+    all_gather_results, load_shared_model
+from utils_evaluation import PosteriorIndex, build_posterior_index, dataset_latent_statistics, dump_pickle
+import distutils
+
+
+def get_rank_loader(batch_size=64, num_workers=8, max_seq_len=64, world_size=4, dataset_name="ptb_text_only",
+                    tokenizer_name="roberta", device_name="cuda:0", gpu_rank=0, train_validation="validation"):
+    # Get data
+    pin_memory = True if "cuda" in device_name else False
+    data = NewsData(dataset_name, tokenizer_name,
+                    batch_size=batch_size, num_workers=num_workers,
+                    pin_memory=pin_memory, max_seq_len=max_seq_len,
+                    device=device_name)
+
+    # Every rank encodes every world_size-th sentence of the split (no padding with duplicates like the
+    # DistributedSampler, every sentence is in the index exactly once)
+    dataset = data.datasets[train_validation]
+    rank_dataset = Subset(dataset, list(range(gpu_rank, len(dataset), world_size)))
+
+    loader = DataLoader(rank_dataset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory,
+                        num_workers=num_workers, collate_fn=data.collate_fn)
+
+    return loader
+
+
+def get_posterior_index(index_dir, device_rank, device_name, model_path, batch_size, dataset_name,
+                        train_validation, world_size, num_workers, vae_model=None):
+    """
+    Load the posterior index of the split, or encode it: every rank encodes its part of the split, the parts
+    are gathered on all ranks and the master rank saves the index for later runs.
+    """
+    if os.path.isfile(index_dir / "mu.npy"):
+        print(f"Loading posterior index from {index_dir}")
+        return PosteriorIndex.load(index_dir, mmap=True)
+
+    # Get model (unless a model in shared memory is given)
+    if vae_model is None:
+        vae_model = load_from_checkpoint(model_path, world_master=True, ddp=False, device_name=device_name,
+                                         evaluation=True, return_loss_term_manager=False)
+    vae_model.eval()
+
+    loader = get_rank_loader(batch_size=batch_size, num_workers=num_workers, max_seq_len=64,
+                             world_size=world_size, dataset_name=dataset_name, tokenizer_name="roberta",
+                             device_name=device_name, gpu_rank=device_rank, train_validation=train_validation)
+
+    rank_index = build_posterior_index(vae_model, loader, device_name=device_name)
+    rows = torch.tensor(loader.dataset.indices)
+
+    # Gather the parts (in rank order) and put them back in dataset order, so that the index (and the samples drawn
+    # for its rows) does not depend on the number of ranks
+    gathered = all_gather_results({"mu": rank_index.mu, "logvar": rank_index.logvar, "rows": rows}, world_size)
+    order = torch.argsort(gathered["rows"])
+    index = PosteriorIndex(gathered["mu"][order], gathered["logvar"][order])
+
+    if device_rank == 0:
+        index.save(index_dir)
+
+    return index
+
+
+def evaluation_function(device_rank, run_name, model_path, result_dir_path, batch_size, dataset_name,
+                        train_validation, n_z, z_chunk_size, x_block_size, seed, world_size, num_workers,
+                        device_type="cuda", n_threads_per_process=-1, vae_model=None):
+    # Prepare some variables & result directory
+    device_name = set_device(device_rank, device_type=device_type, n_threads=n_threads_per_process,
+                             world_size=world_size)
+    result_dir = Path(result_dir_path) / run_name
+    os.makedirs(result_dir, exist_ok=True)
+
+    result_file = result_dir / f"{run_name}_{dataset_name}_{train_validation}_dataset_latent_statistics_" \
+                               f"n_z_{n_z}_seed_{seed}.pickle"
+
+    # All ranks join the process group, also when the result exists, otherwise the others hang at rendezvous
+    init_process_group(device_rank, world_size, device_type=device_type)
+
+    if os.path.isfile(result_file):
+        print('_' * 80)
+        print('_' * 80)
+        print("Have done this one already!")
+        print('_' * 80)
+        print('_' * 80)
+        return
+
+    print("-" * 30)
+    print("run_name:", run_name)
+    print("split:", train_validation)
+    print("n_z:", n_z)
+    print("device name:", device_name)
+    print("-" * 30)
+
+    index_dir = result_dir / f"posterior_index_{dataset_name}_{train_validation}"
+    index = get_posterior_index(index_dir, device_rank, device_name, model_path, batch_size, dataset_name,
+                                train_validation, world_size, num_workers, vae_model=vae_model)
+
+    # The samples are divided over the ranks, the per sample terms are gathered on all ranks
+    results = dataset_latent_statistics(index, n_z=n_z, z_chunk_size=z_chunk_size, x_block_size=x_block_size,
+                                        device_name=device_name, seed=seed, rank=device_rank,
+                                        world_size=world_size)
+
+    if device_rank == 0:
+        print()
+        for k in ["mutual_information", "marginal_kl", "kl", "total_correlation"]:
+            if k in results:
+                print(f"{k}: {results[k].item():.4f}")
+        dump_pickle(results, result_file)
+
+
+def get_config():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model_path", required=True, type=str,
+                        help="Path to the model needed to evaluate it.")
+    parser.add_argument("--result_dir_path", required=False, type=str,
+                        default="/home/cbarkhof/code-thesis/NewsVAE/evaluation/result-files/dataset-latent-statistics",
+                        help="Path to directory to store the results (and the posterior index).")
+    parser.add_argument("--dataset_name", required=False, type=str,
+                        default="ptb_text_only", help="The name of the dataset (default: ptb_text_only).")
+    parser.add_argument("--train_validation", required=False, type=str, default="validation",
+                        help="Which split to evaluate: train or validation (default: validation).")
+    parser.add_argument("--batch_size", required=False, type=int, default=64,
+                        help="Batch size for encoding the split (default: 64).")
+    parser.add_argument("--n_z", required=False, type=int, default=-1,
+                        help="Number of data points to draw a sample for (default: -1, means all).")
+    parser.add_argument("--z_chunk_size", required=False, type=int, default=1024,
+                        help="Number of samples evaluated at once against a block of posteriors (default: 1024).")
+    parser.add_argument("--x_block_size", required=False, type=int, default=4096,
+                        help="Number of posteriors per block (default: 4096).")
+    parser.add_argument("--seed", required=False, type=int, default=0,
+                        help="Seed for the subset of data points and the samples (default: 0).")
+    parser.add_argument("--num_workers", required=False, type=int, default=2,
+                        help="Num workers for data loading (default: 2).")
+    parser.add_argument("--world_size", required=False, type=int, default=2,
+                        help="Number of processes (GPUs or CPU processes) to use (default: 2).")
+    parser.add_argument("--device_type", required=False, type=str, default="cuda",
+                        help="Device type: cuda (one process per GPU, nccl) or cpu (gloo) (default: cuda).")
+    parser.add_argument("--n_threads_per_process", required=False, type=int, default=-1,
+                        help="Threads per CPU process, -1 divides the cores over the processes (default: -1).")
+    parser.add_argument("--share_model_memory", default=True, type=lambda x: bool(distutils.util.strtobool(x)),
+                        help="On CPU, load the model once in shared memory for all processes (default: True).")
+
+    config = parser.parse_args()
+
+    return config
+
+
+def main(config):
+    # INIT DDP
+    print(f"*** Using DDP, spawing {config.world_size} processes on {config.device_type}")
+    set_ddp_environment_vars(port_nr=1237)
+    seed_everything(config.seed)
+    run_name = config.model_path.split("/")[-2]
+
+    # On CPU all processes share one copy of the weights, loaded here once
+    vae_model = None
+    if config.device_type == "cpu" and config.share_model_memory:
+        vae_model = load_shared_model(config.model_path, world_master=True, ddp=False)
+
+    mp.spawn(evaluation_function, nprocs=config.world_size,
+             args=(run_name, config.model_path, config.result_dir_path, config.batch_size, config.dataset_name,
+                   config.train_validation, config.n_z, config.z_chunk_size, config.x_block_size, config.seed,
+                   config.world_size, config.num_workers, config.device_type, config.n_threads_per_process,
+                   vae_model))
+
+
+if __name__ == "__main__":
+    args = get_config()
+    main(args)
@@ -0,0 +1,434 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from transformers import top_k_top_p_filtering
+
+# ----------------------------------------------------------------------------------------------------
+# CONTINUOUS BATCHING GENERATION
+# ----------------------------------------------------------------------------------------------------
+#
+# All latent-to-text decoding (prior samples, reconstructions, interpolations) can go through one
+# engine per decoder. Instead of decoding a fixed batch until its longest member is done (like
+# DecoderNewsVAE.autoregressive_decode), the engine keeps a running batch of decode slots: every step
+# decodes one token for all active slots, finished sequences leave their slot and new latent codes
+# take their place in the next step. The keys and values of all slots live in one pre-allocated
+# KV cache pool of [max_batch_size, n_heads, max_seq_len, head_size] per layer, which is read and
+# written in place by the single token fast path VaeDecoderRobertaForCausalLM.step_forward.
+#
+# Usage (synchronous):
+#     generator = ContinuousBatchingGenerator(vae_model.decoder, max_batch_size=256, device_name="cuda:0")
+#     predictions = generator.generate(latent_z, max_seq_len=64)
+#
+# Usage (asyncio, e.g. many callers / checkpoints in one process):
+#     service = AsyncGenerationService(generator)
+#     await service.start()
+#     predictions = await service.generate(latent_z)
+#     await service.stop()
+# ----------------------------------------------------------------------------------------------------
+
+
+class GenerationRequest:
+    def __init__(self, latent_z, max_seq_len=64, nucleus_sampling=False, top_k=0, top_p=0.9):
+        """
+        A batch of latent codes that should be decoded to text with the same settings.
+
+        Args:
+            latent_z: Tensor [n_sequences, latent_size]
+            max_seq_len: int
+                Maximum sequence length including <s> and </s>, as in autoregressive_decode
+            nucleus_sampling: bool
+                Whether to sample with top_k_top_p_filtering (otherwise greedy decoding)
+            top_k: int
+            top_p: float
+        """
+        self.latent_z = latent_z
+        self.n_sequences = latent_z.shape[0]
+        self.max_seq_len = max_seq_len
+        self.sampling_settings = (nucleus_sampling, top_k, top_p)
+
+        # Rows that have been admitted into the running batch and rows that are done
+        self.next_row = 0
+        self.n_finished = 0
+        self.predictions = [None] * self.n_sequences
+
+        # Set by the asyncio front-end
+        self.future = None
+
+    def is_done(self):
+        return self.n_finished == self.n_sequences
+
+    def get_predictions(self):
+        """
+        Returns:
+            predictions: Tensor [n_sequences, max_seq_len - 1]
+                Generated token ids (without <s>), padded with <pad> after </s>
+        """
+        return torch.stack(self.predictions, dim=0)
+
+
+class ContinuousBatchingGenerator:
+    def __init__(self, decoder, max_batch_size=128, max_seq_len=64, device_name="cuda:0",
+                 bos_token_id=0, eos_token_id=2, pad_token_id=1):
+        """
+        Continuous batching decoder for DecoderNewsVAE. Sequences join the running batch as soon as a
+        slot is free and leave it as soon as they produced </s> (or reach their maximum length).
+
+        Args:
+            decoder: DecoderNewsVAE
+                The decoder to generate with (put it in eval mode yourself).
+            max_batch_size: int
+                Number of decode slots, this bounds the size of the KV cache pool.
+            max_seq_len: int
+                Maximum sequence length (including <s> and </s>) of any request.
+            device_name: str
+        """
+        self.decoder = decoder
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.device_name = device_name
+
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+
+        config = decoder.model.config
+        self.n_layers = config.num_hidden_layers
+        self.n_heads = config.num_attention_heads
+        self.head_size = config.hidden_size // config.num_attention_heads
+        # RoBERTa position ids start after the padding index
+        self.position_offset = config.pad_token_id + 1
+
+        # Requests that still have rows waiting for a slot
+        self.pending_requests = deque()
+
+        # Host side bookkeeping per slot: (request, row) or None if the slot is free
+        self.slot_owner = [None] * max_batch_size
+        self.active_slots = None
+        self.sampling_groups = None
+
+        self.key_pool, self.value_pool = None, None
+        self.allocate_slots()
+
+    def allocate_slots(self):
+        """
+        Allocate the KV cache pool and the per slot state on the device. The pool is initialised with
+        zeros, as masked (never written) positions are still multiplied with their (zero) attention weight.
+        Stale keys and values of a previous occupant of a slot are masked in the same way.
+        """
+        dtype = next(self.decoder.parameters()).dtype
+        pool_shape = (self.max_batch_size, self.n_heads, self.max_seq_len, self.head_size)
+
+        self.key_pool = [torch.zeros(pool_shape, dtype=dtype, device=self.device_name)
+                         for _ in range(self.n_layers)]
+        self.value_pool = [torch.zeros(pool_shape, dtype=dtype, device=self.device_name)
+                           for _ in range(self.n_layers)]
+
+        self.slot_latent = torch.zeros((self.max_batch_size, self.decoder.latent_size), dtype=dtype,
+                                       device=self.device_name)
+        # Number of tokens in the cache of every slot, which is also the index of the current input token
+        self.slot_position = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device_name)
+        self.slot_input_token = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device_name)
+        self.slot_max_predictions = torch.zeros(self.max_batch_size, dtype=torch.long, device=self.device_name)
+        self.slot_predictions = torch.full((self.max_batch_size, self.max_seq_len - 1), self.pad_token_id,
+                                           dtype=torch.long, device=self.device_name)
+        # Additive attention mask over the pool, a position is opened (0.0) when its key and value are written
+        self.slot_attention_mask = torch.full((self.max_batch_size, self.max_seq_len), -10000.0, dtype=dtype,
+                                              device=self.device_name)
+
+    @staticmethod
+    def slots_for_memory_budget(decoder, max_seq_len, max_memory_mb, bytes_per_element=4):
+        """
+        Number of decode slots that fit a memory budget: the KV cache pool of a slot plus its logits.
+
+        Args:
+            decoder: DecoderNewsVAE
+            max_seq_len: int
+            max_memory_mb: int
+        Returns:
+            max_batch_size: int
+        """
+        config = decoder.model.config
+        kv_cache = 2 * config.num_hidden_layers * max_seq_len * config.hidden_size
+        logits = 2 * config.vocab_size
+        bytes_per_slot = (kv_cache + logits) * bytes_per_element
+
+        return max(1, int(max_memory_mb * 1024 ** 2 // bytes_per_slot))
+
+    def add_request(self, request):
+        assert request.max_seq_len <= self.max_seq_len, \
+            "Request max_seq_len ({}) exceeds the max_seq_len of the generator ({}). Aborting.".format(
+                request.max_seq_len, self.max_seq_len)
+
+        if request.n_sequences == 0:
+            return
+        request.latent_z = request.latent_z.to(self.device_name)
+        self.pending_requests.append(request)
+
+    def has_work(self):
+        return len(self.pending_requests) > 0 or any(owner is not None for owner in self.slot_owner)
+
+    def admit_pending(self):
+        """
+        Move rows of pending requests into free slots.
+        """
+        free_slots = [i for i, owner in enumerate(self.slot_owner) if owner is None]
+        if len(free_slots) == 0 or len(self.pending_requests) == 0:
+            return
+
+        slots, latents, max_predictions = [], [], []
+        while len(free_slots) > 0 and len(self.pending_requests) > 0:
+            request = self.pending_requests[0]
+            n_admit = min(len(free_slots), request.n_sequences - request.next_row)
+
+            for row in range(request.next_row, request.next_row + n_admit):
+                slot = free_slots.pop(0)
+                self.slot_owner[slot] = (request, row)
+                slots.append(slot)
+
+            latents.append(request.latent_z[request.next_row:request.next_row + n_admit])
+            max_predictions += [request.max_seq_len - 1] * n_admit
+            request.next_row += n_admit
+
+            if request.next_row == request.n_sequences:
+                self.pending_requests.popleft()
+
+        slots = torch.tensor(slots, dtype=torch.long, device=self.device_name)
+        self.slot_latent[slots] = torch.cat(latents, dim=0).to(self.slot_latent.dtype)
+        self.slot_position[slots] = 0
+        self.slot_input_token[slots] = self.bos_token_id
+        self.slot_max_predictions[slots] = torch.tensor(max_predictions, dtype=torch.long, device=self.device_name)
+        self.slot_predictions[slots] = self.pad_token_id
+        self.slot_attention_mask[slots] = -10000.0
+
+        self.update_active_slots()
+
+    def update_active_slots(self):
+        """
+        Cache the index tensors of the running batch, they only change when sequences join or leave.
+        """
+        active = [i for i, owner in enumerate(self.slot_owner) if owner is not None]
+        self.active_slots = torch.tensor(active, dtype=torch.long, device=self.device_name)
+
+        # Rows of the running batch grouped per sampling setting
+        groups = {}
+        for batch_row, slot in enumerate(active):
+            groups.setdefault(self.slot_owner[slot][0].sampling_settings, []).append(batch_row)
+        self.sampling_groups = [(settings, torch.tensor(rows, dtype=torch.long, device=self.device_name))
+                                for settings, rows in groups.items()]
+
+        # Number of cached positions to attend over, grows by one every step
+        self.n_cached = None
+
+    def sample(self, logits):
+        """
+        Pick the next token for every row of the running batch, according to the settings of its request.
+
+        Args:
+            logits: Tensor [n_active, vocab_size]
+        Returns:
+            next_tokens: Tensor [n_active]
+        """
+        if len(self.sampling_groups) == 1:
+            (nucleus_sampling, top_k, top_p), _ = self.sampling_groups[0]
+            return self.sample_group(logits, nucleus_sampling, top_k, top_p)
+
+        next_tokens = torch.empty(logits.shape[0], dtype=torch.long, device=logits.device)
+        for (nucleus_sampling, top_k, top_p), rows in self.sampling_groups:
+            next_tokens[rows] = self.sample_group(logits[rows], nucleus_sampling, top_k, top_p)
+        return next_tokens
+
+    @staticmethod
+    def sample_group(logits, nucleus_sampling, top_k, top_p):
+        if nucleus_sampling:
+            logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+            probs = torch.nn.functional.softmax(logits, dim=-1)
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            return logits.argmax(dim=-1)
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admit waiting sequences and decode one token for every sequence in the running batch.
+
+        Returns:
+            finished_requests: List[GenerationRequest]
+                Requests of which all sequences are done after this step.
+        """
+        self.admit_pending()
+        if self.active_slots is None or len(self.active_slots) == 0:
+            return []
+
+        active = self.active_slots
+        positions = self.slot_position[active]
+
+        # Attend over the longest cache in the running batch (plus the current token), shorter ones are masked
+        if self.n_cached is None:
+            self.n_cached = int(positions.max().item())
+        n_keys = self.n_cached + 1
+
+        # The current token may attend to itself
+        self.slot_attention_mask[active, positions] = 0.0
+        attention_mask = self.slot_attention_mask[active, :n_keys].unsqueeze(1).unsqueeze(1)
+
+        latent_to_decoder_output = self.decoder.latent_to_decoder(self.slot_latent[active])
+
+        # Writes the keys and values of the current token into the pool
+        logits = self.decoder.model.step_forward(
+            input_ids=self.slot_input_token[active],
+            positions=positions,
+            attention_mask=attention_mask,
+            key_cache=self.key_pool,
+            value_cache=self.value_pool,
+            slots=active,
+            latent_to_decoder_output=latent_to_decoder_output,
+            gating=self.decoder.add_latent_via_gating)
+
+        next_tokens = self.sample(logits)
+
+        self.slot_predictions[active, positions] = next_tokens
+        self.slot_input_token[active] = next_tokens
+        self.slot_position[active] = positions + 1
+        self.n_cached += 1
+
+        finished = (next_tokens == self.eos_token_id) | ((positions + 1) >= self.slot_max_predictions[active])
+        finished_slots = active[finished].tolist()
+
+        finished_requests = []
+        for slot in finished_slots:
+            request, row = self.slot_owner[slot]
+            request.predictions[row] = self.slot_predictions[slot].clone()[:request.max_seq_len - 1]
+            request.n_finished += 1
+            self.slot_owner[slot] = None
+
+            if request.is_done():
+                finished_requests.append(request)
+
+        if len(finished_slots) > 0:
+            self.update_active_slots()
+
+        return finished_requests
+
+    def generate(self, latent_z, max_seq_len=None, nucleus_sampling=False, top_k=0, top_p=0.9):
+        """
+        Synchronous convenience function: decode a tensor of latents (together with anything else that
+        is queued in this generator).
+
+        Args:
+            latent_z: Tensor [n_sequences, latent_size]
+            max_seq_len: int
+            nucleus_sampling: bool
+            top_k: int
+            top_p: float
+        Returns:
+            predictions: Tensor [n_sequences, max_seq_len - 1]
+        """
+        max_seq_len = self.max_seq_len if max_seq_len is None else max_seq_len
+        request = GenerationRequest(latent_z, max_seq_len=max_seq_len, nucleus_sampling=nucleus_sampling,
+                                    top_k=top_k, top_p=top_p)
+
+        if request.n_sequences == 0:
+            return torch.zeros((0, max_seq_len - 1), dtype=torch.long, device=self.device_name)
+
+        self.add_request(request)
+        while not request.is_done():
+            self.step()
+
+        return request.get_predictions()
+
+
+class AsyncGenerationService:
+    def __init__(self, generator):
+        """
+        An asyncio front-end to a ContinuousBatchingGenerator. Callers submit latents with
+        `await service.generate(latent_z)`, a single runner merges all submitted requests into the
+        running batch of the generator. Decode steps run in a worker thread, so the event loop stays
+        free to accept new requests while the model is busy.
+
+        Args:
+            generator: ContinuousBatchingGenerator
+        """
+        self.generator = generator
+        self.queue = None
+        self.runner = None
+        self.executor = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.runner = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """
+        Stop the runner after all requests that were submitted so far are done.
+        """
+        await self.queue.put(None)
+        await self.runner
+        self.executor.shutdown()
+
+    async def generate(self, latent_z, max_seq_len=None, nucleus_sampling=False, top_k=0, top_p=0.9):
+        """
+        Submit latents to the running batch and wait for their predictions.
+
+        Args:
+            latent_z: Tensor [n_sequences, latent_size]
+            max_seq_len: int
+            nucleus_sampling: bool
+            top_k: int
+            top_p: float
+        Returns:
+            predictions: Tensor [n_sequences, max_seq_len - 1]
+        """
+        assert self.runner is not None, "Call start() before submitting requests. Aborting."
+
+        max_seq_len = self.generator.max_seq_len if max_seq_len is None else max_seq_len
+        request = GenerationRequest(latent_z, max_seq_len=max_seq_len, nucleus_sampling=nucleus_sampling,
+                                    top_k=top_k, top_p=top_p)
+
+        if request.n_sequences == 0:
+            return torch.zeros((0, max_seq_len - 1), dtype=torch.long, device=self.generator.device_name)
+
+        request.future = asyncio.get_event_loop().create_future()
+        await self.queue.put(request)
+
+        return await request.future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        in_flight = []
+        stopping = False
+
+        while True:
+            # Block on the queue only when the generator has nothing to do
+            if not self.generator.has_work() and not stopping:
+                request = await self.queue.get()
+                stopping = self.add_from_queue(request, in_flight) or stopping
+
+            while not self.queue.empty():
+                stopping = self.add_from_queue(self.queue.get_nowait(), in_flight) or stopping
+
+            if not self.generator.has_work():
+                if stopping:
+                    break
+                continue
+
+            try:
+                finished_requests = await loop.run_in_executor(self.executor, self.generator.step)
+            except Exception as e:
+                for request in in_flight:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                raise
+
+            for request in finished_requests:
+                in_flight.remove(request)
+                request.future.set_result(request.get_predictions())
+
+    def add_from_queue(self, request, in_flight):
+        # None is the stop signal
+        if request is None:
+            return True
+        self.generator.add_request(request)
+        in_flight.append(request)
+        return False
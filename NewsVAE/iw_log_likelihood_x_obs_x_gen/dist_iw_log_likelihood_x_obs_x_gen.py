@@ -7,14 +7,14 @@ from dataset_wrappper import NewsData
 from pytorch_lightning import seed_everything
 from pathlib import Path
 import torch
-import pickle
 import os
-from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
-import torch.distributed as dist
-from utils_train import set_ddp_environment_vars, load_from_checkpoint
+from utils_train import set_ddp_environment_vars, load_from_checkpoint, transfer_batch_to_device, set_device, \
+    init_process_group, all_gather_results, load_shared_model, \
+    get_length_sorted_loader, restore_original_order
 import distutils
-from utils_evaluation import iw_log_p_x_generated, iw_log_p_x_dataset, dump_pickle, load_pickle
+from utils_evaluation import iw_log_p_x_generated, iw_log_p_x, dump_pickle, sequence_keys
+from utils_storage import ResultJournal, merge_journals
+import zlib
 
 # only target rate of 0.5 per dimension
 # only drop-out rates of 0.0, 0.4, 0.8
@@ -45,157 +45,204 @@ RUNS_TO_EVALUATE = [
  '2021-04-27-21APRIL-matrix-influence-memory-MDR-0.5-DROP-0.8-run-13:58:42']
 
 
-def combine_results_N_gpus(result_dir_path, run_name, max_batches, batch_size, n_samples, world_size):
+def journal_path(result_dir, device_rank, run_name, dataset_name, world_size, max_batches, batch_size, n_samples,
+                 max_seq_len_gen, duplicates):
+    """
+    The journal of a rank. The batch keys in a journal ("valid/{i}", ...) refer to the batches of a rank, so every
+    setting that changes the division of the data in batches or the results of a batch is part of the name: a run
+    with other settings starts a new journal instead of resuming from records of another partition of the data.
+    """
+    return result_dir / f"rank_{device_rank}_{run_name}_{dataset_name}_world_size_{world_size}_" \
+                        f"max_batches_{max_batches}_batch_size_{batch_size}_n_samples_{n_samples}_" \
+                        f"max_seq_len_gen_{max_seq_len_gen}_duplicates_{duplicates}.journal"
+
+
+def combine_results_N_gpus(result_dir_path, run_name, max_batches, batch_size, n_samples, world_size,
+                           dataset_name="ptb_text_only", max_seq_len_gen=64, duplicates="reuse"):
+    """
+    Merge the batches that are committed in the journals of all ranks so far into one result file.
+    Can be run at any time, also while (or after preemption of) the evaluation, the journals are kept
+    so that a next run resumes from them. (A finished evaluation gathers and writes the results itself.)
+    """
     result_dir = Path(result_dir_path) / run_name
-    all_res = dict()
 
-    for i in range(world_size):
-        device_name = f"cuda:{i}"
-
-        result_file = result_dir / f"{device_name}_{run_name}_max_batches_{max_batches}.pickle"
-        res = load_pickle(result_file)
-        for k, v in res.items():
-            if k in all_res:
-                all_res[k].append(v)
-            else:
-                all_res[k] = [v]
-
-    # cat all tensors in list
-    for k, v in all_res.items():
-        all_res[k] = torch.cat(v)
+    journal_paths = [journal_path(result_dir, i, run_name, dataset_name, world_size, max_batches, batch_size,
+                                  n_samples, max_seq_len_gen, duplicates) for i in range(world_size)]
+    all_res = restore_dataset_order(merge_journals(journal_paths))
 
     result_file = result_dir / f"{run_name}_world_size_{world_size}_max_batches_{max_batches}_" \
                                f"batch_size_{batch_size}_n_samples_{n_samples}.pickle"
     dump_pickle(all_res, result_file)
 
-    for f in os.listdir(result_dir):
-        if "cuda" in str(f):
-            os.remove(result_dir / f)
+    return all_res
+
+
+def restore_dataset_order(all_res):
+    """
+    Put the results on observed data (evaluated in length-sorted batches) back in dataset order.
+    """
+    for phase in ["valid", "train"]:
+        index_key = f"index_obs_{phase}"
+        if index_key not in all_res:
+            continue
+
+        phase_res = {k: v for k, v in all_res.items() if k.endswith(f"obs_{phase}")}
+        all_res.update(restore_original_order(phase_res, all_res[index_key]))
+
+    return all_res
+
+
+def batch_seed(phase, batch_i, device_rank):
+    """
+    Seed per batch, so that the results of a batch do not depend on whether the evaluation was resumed.
+    """
+    return zlib.crc32(f"{phase}/{batch_i}/{device_rank}".encode("utf-8"))
 
 
 def get_dist_validation_loader(batch_size=12, num_workers=8, max_seq_len=64, world_size=4,
                                dataset_name="ptb_text_only", tokenizer_name="roberta",
-                               device_name="cuda:0", gpu_rank=0, train_validation="validation"):
+                               device_name="cuda:0", gpu_rank=0, train_validation="validation", max_batches=-1):
     # Get data
+    pin_memory = True if "cuda" in device_name else False
     data = NewsData(dataset_name, tokenizer_name,
                     batch_size=batch_size, num_workers=num_workers,
-                    pin_memory=True, max_seq_len=max_seq_len,
+                    pin_memory=pin_memory, max_seq_len=max_seq_len,
                     device=device_name)
 
-    # Get distributed sampler
-    sampler = DistributedSampler(data.datasets[train_validation], num_replicas=world_size,
-                                 shuffle=True, rank=gpu_rank)
-
-    # Get data loader
-    loader = DataLoader(data.datasets[train_validation], batch_size=batch_size,
-                        sampler=sampler, pin_memory=True, shuffle=False,
-                        num_workers=num_workers, collate_fn=data.collate_fn)
+    # Length-sorted batches, divided over the ranks by number of tokens
+    # (deterministic, so the batches of a rank are the same after a restart)
+    loader = get_length_sorted_loader(data.datasets[train_validation], data.collate_fn, batch_size=batch_size,
+                                      world_size=world_size, rank=gpu_rank, max_batches=max_batches,
+                                      num_workers=num_workers, pin_memory=pin_memory)
 
     return loader
 
 
 def dist_iw_log_likelihood_x_obs_x_gen(device_rank, run_name, model_path, max_batches,
                                        result_dir_path, batch_size, dataset_name,
-                                       world_size, num_workers, n_samples, n_chunks, max_seq_len_gen):
+                                       world_size, num_workers, n_samples, n_chunks, max_seq_len_gen,
+                                       device_type="cuda", n_threads_per_process=-1, vae_model=None,
+                                       duplicates="reuse"):
     # Prepare some variables & result directory
-    device_name = f"cuda:{device_rank}"
+    device_name = set_device(device_rank, device_type=device_type, n_threads=n_threads_per_process,
+                             world_size=world_size)
 
     result_dir = Path(result_dir_path) / run_name
     os.makedirs(result_dir, exist_ok=True)
 
-    # single GPU file
-    result_file = result_dir / f"{device_name}_{run_name}_max_batches_{max_batches}.pickle"
-
-    # combined for all GPUs
-    full_result_file = result_dir / f"{run_name}_world_size_{world_size}_max_batches_{max_batches}_" \
-                                    f"batch_size_{batch_size}_n_samples_{n_samples}.pickle"
-
-    if os.path.isfile(result_file) or os.path.isfile(full_result_file):
-
+    # Journal of this rank, every batch is committed to it as soon as it is done
+    journal = ResultJournal(journal_path(result_dir, device_rank, run_name, dataset_name, world_size, max_batches,
+                                         batch_size, n_samples, max_seq_len_gen, duplicates))
+
+    print("-" * 30)
+    print("run_name:", run_name)
+    print("batch size:", batch_size)
+    print("max_batches:", max_batches)
+    print("device name:", device_name)
+    print("committed batches:", len(journal.keys()))
+    print("-" * 30)
+
+    # Get distributed validation data loader of PTB data set
+    valid_loader = get_dist_validation_loader(batch_size=batch_size, num_workers=num_workers, max_seq_len=64,
+                                              world_size=world_size, dataset_name=dataset_name,
+                                              tokenizer_name="roberta",
+                                              device_name=device_name, gpu_rank=device_rank,
+                                              train_validation="validation", max_batches=max_batches)
+
+    train_loader = get_dist_validation_loader(batch_size=batch_size, num_workers=num_workers, max_seq_len=64,
+                                              world_size=world_size, dataset_name=dataset_name,
+                                              tokenizer_name="roberta",
+                                              device_name=device_name, gpu_rank=device_rank,
+                                              train_validation="train", max_batches=max_batches)
+
+    # The samplers already apply max_batches (in total over the ranks), with the token balanced division a rank
+    # can have more or fewer batches than max_batches, all of them are evaluated
+    N_valid = len(valid_loader)
+    N_train = len(train_loader)
+    N = max([N_valid, N_train])
+
+    print(f"N_valid {N_valid} N_train {N_train} N {N}")
+
+    todo = [f"valid/{i}" for i in range(N_valid)] + [f"train/{i}" for i in range(N_train)] + \
+           [f"gen/{i}" for i in range(N)]
+    todo = [key for key in todo if key not in journal]
+
+    init_process_group(device_rank, world_size, device_type=device_type)
+
+    if len(todo) == 0:
         print('_' * 80)
         print('_' * 80)
         print("Have done this one already!")
         print('_' * 80)
         print('_' * 80)
-
     else:
-
-        print("-" * 30)
-        print("run_name:", run_name)
-        print("batch size:", batch_size)
-        print("max_batches:", max_batches)
-        print("device name:", device_name)
-        print("-" * 30)
-
-        # Get model
+        evaluate_batches(device_rank, device_name, model_path, journal, valid_loader, train_loader, N_valid, N_train,
+                         N, batch_size, n_samples, n_chunks, max_seq_len_gen, vae_model=vae_model,
+                         duplicates=duplicates)
+
+    # Gather the results of all ranks and write them away on the master rank
+    results = {k: torch.from_numpy(v.copy()) for k, v in journal.read().items()}
+    all_res = all_gather_results(results, world_size)
+    all_res = restore_dataset_order(all_res)
+
+    for phase in ["valid", "train"]:
+        if f"n_unique_{phase}" in all_res:
+            dedup_ratio = 1.0 - all_res[f"n_unique_{phase}"].sum().item() / max(1, len(all_res[f"lens_obs_{phase}"]))
+            if device_rank == 0:
+                print(f"{phase} dedup ratio (within batches): {dedup_ratio:.3f}")
+
+    if device_rank == 0:
+        result_file = result_dir / f"{run_name}_world_size_{world_size}_max_batches_{max_batches}_" \
+                                   f"batch_size_{batch_size}_n_samples_{n_samples}.pickle"
+        dump_pickle(all_res, result_file)
+
+
+def evaluate_batches(device_rank, device_name, model_path, journal, valid_loader, train_loader, N_valid, N_train, N,
+                     batch_size, n_samples, n_chunks, max_seq_len_gen, vae_model=None, duplicates="reuse"):
+    # Get model (unless a model in shared memory is given)
+    if vae_model is None:
         vae_model = load_from_checkpoint(model_path, world_master=True, ddp=False, device_name=device_name,
                                          evaluation=True, return_loss_term_manager=False)
 
-        # Get distributed validation data loader of PTB data set
-        valid_loader = get_dist_validation_loader(batch_size=batch_size, num_workers=num_workers, max_seq_len=64,
-                                                  world_size=world_size, dataset_name=dataset_name,
-                                                  tokenizer_name="roberta",
-                                                  device_name=device_name, gpu_rank=device_rank,
-                                                  train_validation="validation")
-
-        train_loader = get_dist_validation_loader(batch_size=batch_size, num_workers=num_workers, max_seq_len=64,
-                                                  world_size=world_size, dataset_name=dataset_name,
-                                                  tokenizer_name="roberta",
-                                                  device_name=device_name, gpu_rank=device_rank,
-                                                  train_validation="train")
-
-        dist.init_process_group(backend='nccl', init_method='env://',
-                                world_size=world_size, rank=device_rank)
-
-        # Seed everything
-        seed_everything(0)
-
-        N_valid = max_batches if max_batches > 0 else len(valid_loader)
-        N_train = max_batches if max_batches > 0 else len(train_loader)
-        N = max([N_valid, N_train])
-
-        print(f"N_valid {N_valid} N_train {N_train} N {N}")
-
-        with torch.no_grad():
-
-            log_p_x_obs_valid, log_p_x_w_obs_valid, lens_obs_valid = iw_log_p_x_dataset(valid_loader, model=vae_model,
-                                                                                        path=None,
-                                                                                        n_samples=n_samples,
-                                                                                        n_chunks=n_chunks,
-                                                                                        verbose=True, ddp=False,
-                                                                                        device_name=device_name,
-                                                                                        max_batches=N_valid)
-
-            log_p_x_obs_train, log_p_x_w_obs_train, lens_obs_train = iw_log_p_x_dataset(train_loader, model=vae_model,
-                                                                                        path=None,
-                                                                                        n_samples=n_samples,
-                                                                                        n_chunks=n_chunks,
-                                                                                        verbose=True, ddp=False,
-                                                                                        device_name=device_name,
-                                                                                        max_batches=N_train)
-
-            log_p_x_gen, log_p_x_w_gen, lens_gen = iw_log_p_x_generated(model=vae_model, path=None, n_batches=N,
+    with torch.no_grad():
+        for phase, loader, n_batches in [("valid", valid_loader, N_valid), ("train", train_loader, N_train)]:
+            for batch_i, batch in enumerate(loader):
+                key = f"{phase}/{batch_i}"
+                if key in journal:
+                    continue
+
+                print(f"{phase} {batch_i + 1:3d}/{n_batches} - {device_name}")
+                torch.manual_seed(batch_seed(phase, batch_i, device_rank))
+
+                batch = transfer_batch_to_device(batch, device_name=device_name)
+                log_p_x = iw_log_p_x(vae_model, batch, n_samples=n_samples, n_chunks=n_chunks,
+                                     duplicates=duplicates).cpu()
+                lens = batch["attention_mask"].sum(dim=1).cpu()
+                n_unique = len(set(sequence_keys(batch["input_ids"], batch["attention_mask"])))
+
+                journal.append(key, {f"log_p_x_obs_{phase}": log_p_x,
+                                     f"log_p_x_w_obs_{phase}": log_p_x / lens,
+                                     f"lens_obs_{phase}": lens,
+                                     f"index_obs_{phase}": batch["index"].cpu(),
+                                     f"n_unique_{phase}": torch.tensor([n_unique])})
+
+        for batch_i in range(N):
+            key = f"gen/{batch_i}"
+            if key in journal:
+                continue
+
+            print(f"gen {batch_i + 1:3d}/{N} - {device_name}")
+            torch.manual_seed(batch_seed("gen", batch_i, device_rank))
+
+            log_p_x_gen, log_p_x_w_gen, lens_gen = iw_log_p_x_generated(model=vae_model, path=None, n_batches=1,
                                                                         batch_size=batch_size, n_samples=n_samples,
-                                                                        n_chunks=n_chunks,
-                                                                        verbose=True, ddp=False,
+                                                                        n_chunks=n_chunks, duplicates=duplicates,
+                                                                        use_cache=False,
+                                                                        verbose=False, ddp=False,
                                                                         device_name=device_name,
                                                                         max_seq_len_gen=max_seq_len_gen)
 
-        results = dict(
-            log_p_x_obs_valid=log_p_x_obs_valid.cpu(),
-            log_p_x_w_obs_valid=log_p_x_w_obs_valid.cpu(),
-            lens_obs_valid=lens_obs_valid.cpu(),
-            log_p_x_obs_train=log_p_x_obs_train.cpu(),
-            log_p_x_w_obs_train=log_p_x_w_obs_train.cpu(),
-            lens_obs_train=lens_obs_train.cpu(),
-            log_p_x_gen=log_p_x_gen.cpu(),
-            log_p_x_w_gen=log_p_x_w_gen.cpu(),
-            lens_gen=lens_gen.cpu()
-        )
-
-
-        # Dump the results for this device
-        pickle.dump(results, open(result_file, "wb"))
+            journal.append(key, {"log_p_x_gen": log_p_x_gen, "log_p_x_w_gen": log_p_x_w_gen, "lens_gen": lens_gen})
 
 
 def get_config():
@@ -218,6 +265,9 @@ def get_config():
                         help="Num workers for data loading (default: 8).")
     parser.add_argument("--world_size", required=False, type=int, default=4,
                         help="Number of GPUs to use (default: 4).")
+    parser.add_argument("--duplicates", required=False, type=str, default="reuse",
+                        help="Duplicate sentences in a batch: none, reuse (evaluate once) or pool "
+                             "(pool the samples of all occurrences) (default: reuse).")
     parser.add_argument("--n_chunks", required=False, type=int, default=3,
                         help="Number of chunks to divide the samples from posterior "
                              "in for importance weighting (default: 2).")
@@ -225,6 +275,13 @@ def get_config():
                         help="Number of samples to take per posterior or data point (default: 600).")
     parser.add_argument("--max_seq_len_gen", required=False, type=int, default=64,
                         help="Maximum sequence length for ancestral sampling generation (default: 64).")
+    parser.add_argument("--device_type", required=False, type=str, default="cuda",
+                        help="Device type: cuda (one process per GPU, nccl) or cpu (world_size processes, "
+                             "gloo) (default: cuda).")
+    parser.add_argument("--n_threads_per_process", required=False, type=int, default=-1,
+                        help="Threads per CPU process, -1 divides the cores over the processes (default: -1).")
+    parser.add_argument("--share_model_memory", default=True, type=lambda x: bool(distutils.util.strtobool(x)),
+                        help="On CPU, load the model once in shared memory for all processes (default: True).")
 
     config = parser.parse_args()
 
@@ -251,12 +308,16 @@ def main(config):
 
     assert os.path.isfile(model_path), "give a valid model path, not valid: {}".format(model_path)
 
+    # On CPU all processes share one copy of the weights, loaded here once
+    vae_model = None
+    if config.device_type == "cpu" and config.share_model_memory:
+        vae_model = load_shared_model(model_path, world_master=True, ddp=False)
+
     mp.spawn(dist_iw_log_likelihood_x_obs_x_gen, nprocs=config.world_size,
              args=(run_name, model_path, config.max_batches, config.result_dir_path,
                    config.batch_size, config.dataset_name, config.world_size, config.num_workers,
-                   config.n_samples, config.n_chunks, config.max_seq_len_gen))
-    combine_results_N_gpus(config.result_dir_path, run_name, config.max_batches, config.batch_size,
-                           config.n_samples, config.world_size)
+                   config.n_samples, config.n_chunks, config.max_seq_len_gen, config.device_type,
+                   config.n_threads_per_process, vae_model, config.duplicates))
 
 
 if __name__ == "__main__":
@@ -5,17 +5,23 @@ import torch
 import numpy as np
 import math
 import copy
-import torch_two_sample
-import torch
-from utils_latent_analysis_optimisation import GaussianKDE
+import torch.utils.checkpoint
+import threading
+import contextlib
+from utils_latent_analysis_optimisation import kde_1d_dim_marginal_log_density
+from utils_gaussian import gaussian_log_prob, standard_normal_log_prob, gaussian_kl_standard_normal, \
+    gaussian_log_density_matrix, logsumexp_marginal_densities
+from generation_engine import ContinuousBatchingGenerator, GenerationRequest
 from torch.distributions.distribution import Distribution
 
 
-def kl_divergence(mu, logvar, hinge_kl_loss_lambda=0.5, average_batch=True, sum_latent=True):
+def kl_divergence(mu, logvar, hinge_kl_loss_lambda=0.5, average_batch=True, sum_latent=True, kl_loss=None):
     """
     Calculates the KL-divergence between the posterior and the prior analytically.
+    If kl_loss (per latent dimension) is given, e.g. by EncoderNewsVAE.encode, it is used instead.
     """
-    kl_loss = 0.5 * (mu.pow(2) + logvar.exp() - logvar - 1)
+    if kl_loss is None:
+        kl_loss = gaussian_kl_standard_normal(mu, logvar)
 
     if hinge_kl_loss_lambda > 0.0:
 
@@ -43,37 +49,160 @@ def kl_divergence(mu, logvar, hinge_kl_loss_lambda=0.5, average_batch=True, sum_
     return kl_loss, hinge_kl_loss
 
 
-def maximum_mean_discrepancy(latent_z):
+# Bandwidths (alphas in exp(- alpha * ||x - y||^2)) of the multi kernel MMD (as used with torch_two_sample before)
+MMD_ALPHAS = [0.1 * i for i in range(15)]
+
+
+def pairwise_squared_distances(x, y):
+    """
+    Squared euclidean distances between all rows of x and y with a single matrix multiply:
+    ||x - y||^2 = ||x||^2 + ||y||^2 - 2 x.y
+
+    Args:
+        x: Tensor [n, d]
+        y: Tensor [m, d]
+    Returns:
+        sq_dist: Tensor [n, m]
+    """
+    x_norm = x.pow(2).sum(dim=1, keepdim=True)
+    y_norm = y.pow(2).sum(dim=1, keepdim=True)
+    sq_dist = torch.addmm(x_norm + y_norm.t(), x, y.t(), alpha=-2.0)
+
+    # Cancellation can give (small) negative values
+    return sq_dist.clamp(min=0.0)
+
+
+def multi_gaussian_kernel(sq_dist, alphas):
     """
-    Taken from: https://github.com/aktersnurra/information-maximizing-variational-autoencoders/blob/master/model/loss_functions/mmd_loss.py
+    Sum of Gaussian kernels exp(- alpha * ||x - y||^2) over all bandwidths, evaluated on one distance matrix.
 
-    :param latent_z:
-    :return:
+    Args:
+        sq_dist: Tensor [n, m]
+        alphas: List[float]
+    Returns:
+        kernel: Tensor [n, m]
+    """
+    kernel = torch.zeros_like(sq_dist)
+    for alpha in alphas:
+        kernel = kernel + torch.exp(- alpha * sq_dist)
+    return kernel
+
+
+def mmd_quadratic(sample_1, sample_2, alphas, block_size=None, eps=1e-5):
     """
-    x = torch.randn_like(latent_z).to(latent_z.device)
-    y = latent_z
-    x_kernel = gaussian_kernel(x, x)
-    y_kernel = gaussian_kernel(y, y)
-    xy_kernel = gaussian_kernel(x, y)
-    mmd = x_kernel.mean() + y_kernel.mean() - 2 * xy_kernel.mean()
+    Unbiased (U-statistic) multi kernel MMD^2 between two samples, the same estimate as
+    torch_two_sample.statistics_diff.MMDStatistic. The squared distances are computed once per block of rows
+    of the joint sample, so memory is [block_size, n_1 + n_2] instead of [n_1 + n_2, n_1 + n_2] per bandwidth.
+
+    Args:
+        sample_1: Tensor [n_1, d]
+        sample_2: Tensor [n_2, d]
+        alphas: List[float]
+        block_size: int
+            rows of the joint sample per block (None: all at once)
+        eps: float
+            added to the squared distances (as in torch_two_sample's pdist)
+    Returns:
+        mmd: Tensor (0-dim)
+    """
+    n_1, n_2 = sample_1.shape[0], sample_2.shape[0]
+    assert n_1 > 1 and n_2 > 1, "mmd_quadratic needs at least two samples per distribution. Aborting."
+
+    sample_12 = torch.cat((sample_1, sample_2), dim=0)
+    n = n_1 + n_2
+    block_size = n if block_size is None else block_size
+
+    k_11, k_22, k_12 = 0.0, 0.0, 0.0
+    for start in range(0, n, block_size):
+        rows = sample_12[start:start + block_size]
+        kernel = multi_gaussian_kernel(pairwise_squared_distances(rows, sample_12) + eps, alphas)
+
+        # Leave out k(x_i, x_i)
+        row_idx = torch.arange(rows.shape[0], device=rows.device)
+        kernel = kernel.index_put((row_idx, row_idx + start), torch.zeros_like(row_idx, dtype=kernel.dtype))
+
+        # Rows of this block that belong to sample_1 and sample_2
+        split = min(max(n_1 - start, 0), rows.shape[0])
+        k_11 = k_11 + kernel[:split, :n_1].sum()
+        k_12 = k_12 + kernel[:split, n_1:].sum()
+        k_22 = k_22 + kernel[split:, n_1:].sum()
+
+    mmd = k_11 / (n_1 * (n_1 - 1)) + k_22 / (n_2 * (n_2 - 1)) - 2 * k_12 / (n_1 * n_2)
 
     return mmd
 
 
+def mmd_linear(sample_1, sample_2, alphas, eps=1e-5):
+    """
+    Unbiased linear time multi kernel MMD^2 estimate (Gretton et al., 2012, Lemma 14): averages
+    h = k(x, x') + k(y, y') - k(x, y') - k(x', y) over disjoint pairs, so only O(n) kernel evaluations.
+    Has a higher variance than the quadratic estimate, meant for large batches.
+
+    Args:
+        sample_1: Tensor [n_1, d]
+        sample_2: Tensor [n_2, d]
+        alphas: List[float]
+        eps: float
+    Returns:
+        mmd: Tensor (0-dim)
+    """
+    m = (min(sample_1.shape[0], sample_2.shape[0]) // 2) * 2
+    assert m > 0, "mmd_linear needs at least two samples per distribution. Aborting."
+
+    x, x_ = sample_1[0:m:2], sample_1[1:m:2]
+    y, y_ = sample_2[0:m:2], sample_2[1:m:2]
+
+    def k(a, b):
+        return multi_gaussian_kernel((a - b).pow(2).sum(dim=1) + eps, alphas)
+
+    h = k(x, x_) + k(y, y_) - k(x, y_) - k(x_, y)
+
+    return h.mean()
+
+
+def maximum_mean_discrepancy(latent_z, alphas=None, estimator="quadratic", block_size=None):
+    """
+    MMD^2 between a batch of latents and a sample of the standard Normal prior of the same size.
+    Differentiable w.r.t. latent_z.
+
+    Args:
+        latent_z: Tensor [batch, latent_dim]
+        alphas: List[float]
+            kernel bandwidths, by default a single kernel exp(- ||x - y||^2 / latent_dim^2) (as the
+            InfoVAE implementation this loss was taken from)
+        estimator: str
+            quadratic (unbiased, O(n^2)) or linear (unbiased, O(n))
+        block_size: int
+            for the quadratic estimator
+    Returns:
+        mmd: Tensor (0-dim)
+    """
+    assert estimator in ["quadratic", "linear"], f"Unknown MMD estimator: {estimator}. Aborting."
+
+    if alphas is None:
+        alphas = [1.0 / latent_z.shape[-1] ** 2]
+
+    prior_sample = torch.randn_like(latent_z)
+
+    if estimator == "linear":
+        return mmd_linear(latent_z, prior_sample, alphas)
+    else:
+        return mmd_quadratic(latent_z, prior_sample, alphas, block_size=block_size)
+
+
 def gaussian_kernel(x, y):
     """
-    Gaussian kernel
-    Taken from: https://github.com/aktersnurra/information-maximizing-variational-autoencoders/blob/master/model/loss_functions/mmd_loss.py
+    Gaussian kernel exp(- ||x - y||^2 / dim^2) between all rows of x and y.
+    Based on: https://github.com/aktersnurra/information-maximizing-variational-autoencoders/blob/master/model/loss_functions/mmd_loss.py
+
+    Args:
+        x: Tensor [n, dim]
+        y: Tensor [m, dim]
+    Returns:
+        kernel: Tensor [n, m]
     """
-    x_size = x.size(0)
-    y_size = y.size(0)
     dim = x.size(1)
-    x = x.unsqueeze(1)
-    y = y.unsqueeze(0)
-    tiled_x = x.expand(x_size, y_size, dim)
-    tiled_y = y.expand(x_size, y_size, dim)
-    kernel_input = (tiled_x - tiled_y).pow(2).mean(2) / float(dim)
-    return torch.exp(-torch.tensor(kernel_input))
+    return torch.exp(- pairwise_squared_distances(x, y) / float(dim ** 2))
 
 
 def sample_log_likelihood(latent_z, mu=None, logvar=None, reduce_latent_dim=True, reduce_batch_dim=True):
@@ -92,17 +221,12 @@ def sample_log_likelihood(latent_z, mu=None, logvar=None, reduce_latent_dim=True
     # Under a posterior z under q(z|x)
     if logvar is not None and mu is not None:
         # N(z| mu, sigma) = [-1 / 2(log var + log 2pi + (x - mu) ^ 2 / var)]
-        var = logvar.exp()
-        likelihood = (- 0.5 * (logvar + math.log(2 * math.pi) + ((latent_z - mu) ** 2 / var)))
+        likelihood = gaussian_log_prob(latent_z, mu, logvar, reduce_latent_dim=reduce_latent_dim)
 
     # Under a prior
     else:
         # N(z | 0, 1) = [-1/2 ( log 2pi + x^2)]
-        likelihood = - 0.5 * (math.log(2 * math.pi) + (latent_z ** 2))
-
-    # Reduce the latent dimension (log sum)
-    if reduce_latent_dim:
-        likelihood = likelihood.sum(dim=-1)
+        likelihood = standard_normal_log_prob(latent_z, reduce_latent_dim=reduce_latent_dim)
 
     if reduce_batch_dim:
         likelihood = likelihood.mean(dim=0)
@@ -137,7 +261,7 @@ def approximate_total_correlation(mu, logvar, latent_z, method="chen", dataset_s
 
 
 def approximate_log_q_z(mu, logvar, latent_z, method="chen", dataset_size=42068, prod_marginals=False,
-                        reduce_mean=True):
+                        reduce_mean=True, block_size=None, max_block_elements=2 ** 24, log_weights=None):
     """
     Approximate E_q(z) [ log q (z) ]. This evaluates all samples x->z under q(z), which on itself
     relies on all data points. The "ideal" estimator would be:
@@ -151,9 +275,18 @@ def approximate_log_q_z(mu, logvar, latent_z, method="chen", dataset_size=42068,
     of the size of the whole dataset. Otherwise, we could estimate. One method is proposed by
     Chen et al. (2019), specifically designed for a batch of data.
 
+    The x_batch dimension is processed in blocks, so that memory does not grow with z_batch x x_batch x
+    latent_dim: the joint log q(z_i|x_j) of a block is computed with matrix multiplies (expanding the square
+    of the Gaussian exponent), the product of marginals needs the per dimension densities of a block of
+    at most max_block_elements. The logsumexp over x_batch is combined over the blocks.
+
+    With log_weights the mixture components are weighted (e.g. mu, logvar from an AggregatePosteriorBank
+    with staleness weights): log q(z) = log sum_j w_j q(z|x_j) - log sum_j w_j.
+
     Shapes:
         - mu, logvar: [x_batch, latent_dim]
         - latent_z: [z_batch, latent_dim]
+        - log_weights: [x_batch] (unnormalised, None: uniform)
 
         --> x_batch might in a lot of cases be the same as z_batch but does not need to be
             in that case the samples may come from (partially) different distributions than the
@@ -162,10 +295,12 @@ def approximate_log_q_z(mu, logvar, latent_z, method="chen", dataset_size=42068,
     if method == "chen":
         assert dataset_size is not None, "if using method 'chen', you need to provide a dataset size"
 
-    # print("dataset size", dataset_size)
-
     # Get shapes
     x_batch, n_dim = mu.shape
+    z_batch = latent_z.shape[0]
+
+    if block_size is None:
+        block_size = max(1, max_block_elements // max(1, z_batch * n_dim))
 
     """
     # from: https://github.com/rtqichen/beta-tcvae/blob/1a3577dbb14642b9ac27010928d12132d0c0fb91/vae_quant.py#L225
@@ -174,53 +309,521 @@ def approximate_log_q_z(mu, logvar, latent_z, method="chen", dataset_size=42068,
     logqz = (logsumexp(_logqz.sum(2), dim=1, keepdim=False) - math.log(batch_size * dataset_size))
     """
 
-    # Orient it as a row [1, x_batch, latent_dim]
-    mu_exp, logvar_exp = mu.unsqueeze(0), logvar.unsqueeze(0)
+    # Per block logsumexp over its x's: [z_batch] (joint) and [z_batch, latent_dim] (marginals)
+    log_q_z_blocks, log_q_z_prod_marg_blocks = [], []
 
-    # Orient it as a column [z_batch, 1, latent_dim]
-    latent_z_exp = latent_z.unsqueeze(1)
+    for start in range(0, x_batch, block_size):
+        mu_block, logvar_block = mu[start:start + block_size], logvar[start:start + block_size]
+        log_w_block = log_weights[start:start + block_size] if log_weights is not None else None
 
-    # Evaluate the log probability q(z_i|mu_j, sigma_j) for all z_i and all (mu_j, sigma_j)
-    # [z_batch, x_batch, latent_dim]
-    log_dens = sample_log_likelihood(latent_z_exp, mu_exp, logvar_exp,
-                                     reduce_latent_dim=False, reduce_batch_dim=False)
-    # print(log_dens.sum(dim=-1) / 32)
-    # print(log_dens.min(), log_dens.max())
+        # Evaluate the log probability q(z_i|mu_j, sigma_j) for all z_i and all (mu_j, sigma_j) in the block
+        # [z_batch, block]
+        log_dens = gaussian_log_density_matrix(latent_z, mu_block, logvar_block)
+        if log_w_block is not None:
+            log_dens = log_dens + log_w_block.unsqueeze(0)
+        log_q_z_blocks.append(torch.logsumexp(log_dens, dim=1))
 
-    log_q_z_prod_marg = None
+        # Log prod q(z_i) => Sum log q(z_j), needs the densities per dimension
+        if prod_marginals:
+            if torch.is_grad_enabled() and (latent_z.requires_grad or mu.requires_grad):
+                # Recompute the block in the backward pass instead of keeping it in memory
+                log_marg = torch.utils.checkpoint.checkpoint(logsumexp_marginal_densities,
+                                                             latent_z, mu_block, logvar_block, log_w_block)
+            else:
+                log_marg = logsumexp_marginal_densities(latent_z, mu_block, logvar_block, log_w_block)
+            log_q_z_prod_marg_blocks.append(log_marg)
 
-    # Log prod q(z_i) => Sum log q(z_j)
+    # Reduce x_batch dim over the blocks [z_batch]
+    log_q_z = torch.logsumexp(torch.stack(log_q_z_blocks, dim=-1), dim=-1)
+
+    log_q_z_prod_marg = None
     if prod_marginals:
-        # Reduce x_batch dim, then latent_dim (happens later in the code at **)
-        log_q_z_prod_marg = torch.logsumexp(log_dens, dim=1, keepdim=False)
+        # Reduce x_batch dim over the blocks, then latent_dim (happens later in the code at **) [z_batch, latent_dim]
+        log_q_z_prod_marg = torch.logsumexp(torch.stack(log_q_z_prod_marg_blocks, dim=-1), dim=-1)
 
-    # Reduce latent and then x_batch dim
-    log_q_z = torch.logsumexp(log_dens.sum(dim=2), dim=1, keepdim=False)
+    # Log of the (total weight of the) number of components
+    if log_weights is not None:
+        log_n_components = torch.logsumexp(log_weights, dim=0)
+    else:
+        log_n_components = math.log(x_batch)
 
     # We assume to have been given an batch, and use a weighted version as proposed in
     # Isolating Sources of Disentanglement (Chen et al., 2019)
     if method == "chen":
         if prod_marginals:
             # ** sum reduce the latent_dim
-            log_q_z_prod_marg = (log_q_z_prod_marg - math.log(x_batch * dataset_size)).sum(dim=1)
+            log_q_z_prod_marg = (log_q_z_prod_marg - log_n_components - math.log(dataset_size)).sum(dim=1)
 
-        log_q_z = log_q_z - math.log(x_batch * dataset_size)
+        log_q_z = log_q_z - log_n_components - math.log(dataset_size)
 
     # Assuming the data we got was the whole dataset
     else:
         if prod_marginals:
             # ** sum reduce the latent_dim
-            log_q_z_prod_marg = (log_q_z_prod_marg - math.log(x_batch)).sum(dim=1)
+            log_q_z_prod_marg = (log_q_z_prod_marg - log_n_components).sum(dim=1)
 
-        log_q_z = log_q_z - math.log(x_batch)
+        log_q_z = log_q_z - log_n_components
 
     if reduce_mean:
         log_q_z = log_q_z.mean()
-        log_q_z_prod_marg = log_q_z_prod_marg.mean()
+        if prod_marginals:
+            log_q_z_prod_marg = log_q_z_prod_marg.mean()
 
     return log_q_z, log_q_z_prod_marg
 
 
+def make_batch_from_model_samples(predictions, eos_token_id=2, pad_token_id=1, bos_token_id=0):
+    """
+    Turn generated predictions into a batch that can be fed to the model: prepend <s>, pad everything
+    after the first </s> and trim the batch to the longest sequence. Everything stays on the device
+    of the predictions.
+
+    Args:
+        predictions: Tensor [batch, max_seq_len - 1]
+            Generated token ids (without <s>)
+    Returns:
+        predictions: Tensor [batch, seq_len]
+            Token ids with <s> and padded after </s>, seq_len is the longest sequence incl. </s>
+        mask: Tensor [batch, seq_len]
+            Attention mask (True up to and including </s>)
+        lens: Tensor [batch]
+            Position of </s> (the sequence length without </s> incl. <s>), or the full length if no </s>
+    """
+    batch_size = predictions.shape[0]
+
+    # Add a <s> token to the predictions
+    bos = torch.full((batch_size, 1), bos_token_id, dtype=predictions.dtype, device=predictions.device)
+    predictions = torch.cat([bos, predictions], dim=1)
+    max_len = predictions.shape[1]
+
+    # Position of the first </s>, if not there set to max_len. Weighting the mask with decreasing
+    # values makes the first </s> the unique maximum for argmax.
+    positions = torch.arange(max_len, device=predictions.device)
+    is_eos = predictions == eos_token_id
+    first_eos = (is_eos.long() * (max_len - positions).unsqueeze(0)).argmax(dim=1)
+    lens = torch.where(is_eos.any(dim=1), first_eos, torch.full_like(first_eos, max_len))
+
+    # Mask everything after the eos_token_id, pad the predictions there
+    mask = positions.unsqueeze(0) <= lens.unsqueeze(1)
+    predictions = predictions.masked_fill(~mask, pad_token_id)
+
+    # Trim to the longest sequence (incl. </s>) so nothing downstream processes only padding
+    trimmed_len = min(int(lens.max().item()) + 1, max_len)
+
+    return predictions[:, :trimmed_len], mask[:, :trimmed_len], lens
+
+
+def posterior_batch_stats(mu, logvar):
+    """
+    Batch averaged statistics of the posterior means and standard deviations, moved to the host in one transfer.
+        - *_z_*: the statistic over the latent dimensions, averaged over the batch
+        - *_x_*: the statistic over the batch, averaged over the latent dimensions
+
+    Args:
+        mu: Tensor [batch, latent_dim]
+        logvar: Tensor [batch, latent_dim]
+    Returns:
+        stats_dict: Dict[str, float]
+    """
+    std = torch.exp(0.5 * logvar)
+
+    stats = torch.stack([mu.mean(dim=1).mean(), torch.std(mu, dim=1).mean(),
+                         std.mean(dim=1).mean(), torch.std(std, dim=1).mean(),
+                         mu.mean(dim=0).mean(), torch.std(mu, dim=0).mean(),
+                         std.mean(dim=0).mean(), torch.std(std, dim=0).mean()]).detach().cpu().tolist()
+
+    names = ["mean_z_mu", "std_z_mu", "mean_z_std", "std_z_std", "mean_x_mu", "std_x_mu", "mean_x_std", "std_x_std"]
+
+    return dict(zip(names, stats))
+
+
+class PosteriorStatsAccumulator:
+    def __init__(self, active_units_threshold=0.01):
+        """
+        Streaming, exact split level posterior statistics per latent dimension. Per batch the mean and the sum of
+        squared deviations (M2) of mu, std are computed on the device and merged into the running moments with
+        Chan et al.'s parallel update (Welford for batches), which is also how the accumulators of the DDP ranks
+        are merged (all_reduce). Nothing is moved to the host until results() is called.
+
+        Statistics:
+            - var_x_mu [latent_dim]: variance over x of the posterior means, the activity of a dimension
+            - active_units: number of dimensions with var_x_mu > active_units_threshold (Burda et al., 2016)
+            - dim_kl [latent_dim]: mean analytical KL(q(z_d|x) || p(z_d))
+            - mean_x_std, std_x_std [latent_dim]: mean and standard deviation over x of the posterior std
+
+        Args:
+            active_units_threshold: float
+        """
+        self.active_units_threshold = active_units_threshold
+
+        # Allocated on the first update, all [latent_dim] float64, on the device of the posteriors
+        self.n = 0
+        self.mean_mu, self.m2_mu = None, None
+        self.mean_std, self.m2_std = None, None
+        self.sum_kl = None
+
+        # Sums over x of the std over the latent dimensions (the *_z_* batch statistics) [2]
+        self.sum_z_std = None
+
+    @staticmethod
+    def merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+        """
+        Chan et al. parallel merge of (count, mean, M2) of two sets of observations.
+        """
+        n = n_a + n_b
+        delta = mean_b - mean_a
+        mean = mean_a + delta * (n_b / n)
+        m2 = m2_a + m2_b + delta ** 2 * (n_a * n_b / n)
+        return n, mean, m2
+
+    @torch.no_grad()
+    def update(self, mu, logvar):
+        """
+        Args:
+            mu: Tensor [batch, latent_dim]
+            logvar: Tensor [batch, latent_dim]
+        """
+        mu, logvar = mu.detach().double(), logvar.detach().double()
+        std = torch.exp(0.5 * logvar)
+        n_b = mu.shape[0]
+
+        mean_mu_b, mean_std_b = mu.mean(dim=0), std.mean(dim=0)
+        m2_mu_b = ((mu - mean_mu_b) ** 2).sum(dim=0)
+        m2_std_b = ((std - mean_std_b) ** 2).sum(dim=0)
+        kl_b = gaussian_kl_standard_normal(mu, logvar).sum(dim=0)
+        sum_z_std_b = torch.stack([torch.std(mu, dim=1).sum(), torch.std(std, dim=1).sum()])
+
+        self.merge(n_b, mean_mu_b, m2_mu_b, mean_std_b, m2_std_b, kl_b, sum_z_std_b)
+
+    def merge(self, n_b, mean_mu_b, m2_mu_b, mean_std_b, m2_std_b, kl_b, sum_z_std_b):
+        if n_b == 0:
+            return
+
+        if self.n == 0:
+            self.n = n_b
+            self.mean_mu, self.m2_mu, self.mean_std, self.m2_std = mean_mu_b, m2_mu_b, mean_std_b, m2_std_b
+            self.sum_kl, self.sum_z_std = kl_b, sum_z_std_b
+            return
+
+        _, self.mean_mu, self.m2_mu = self.merge_moments(self.n, self.mean_mu, self.m2_mu, n_b, mean_mu_b, m2_mu_b)
+        self.n, self.mean_std, self.m2_std = self.merge_moments(self.n, self.mean_std, self.m2_std,
+                                                                n_b, mean_std_b, m2_std_b)
+        self.sum_kl = self.sum_kl + kl_b
+        self.sum_z_std = self.sum_z_std + sum_z_std_b
+
+    def pack(self):
+        # [1 + 5 * latent_dim + 2]
+        return torch.cat([torch.tensor([float(self.n)], dtype=torch.float64, device=self.mean_mu.device),
+                          self.mean_mu, self.m2_mu, self.mean_std, self.m2_std, self.sum_kl, self.sum_z_std])
+
+    def merge_packed(self, packed):
+        mean_mu_b, m2_mu_b, mean_std_b, m2_std_b, kl_b = packed[1:-2].chunk(5)
+        self.merge(int(round(packed[0].item())), mean_mu_b, m2_mu_b, mean_std_b, m2_std_b, kl_b, packed[-2:])
+
+    def all_reduce(self, latent_dim, device_name="cuda:0"):
+        """
+        Merge the accumulators of all DDP ranks (in place, on every rank). Every rank needs to call this,
+        also ranks that have not seen any data (latent_dim is needed for those).
+        """
+        import torch.distributed as dist
+
+        if self.n == 0:
+            packed = torch.zeros(1 + 5 * latent_dim + 2, dtype=torch.float64, device=device_name)
+        else:
+            packed = self.pack()
+
+        gathered = [torch.zeros_like(packed) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, packed)
+
+        self.n = 0
+        for packed_rank in gathered:
+            self.merge_packed(packed_rank)
+
+    def results(self):
+        """
+        Returns:
+            results: Dict[str, Union[int, float, np.ndarray]]
+                per dimension statistics as numpy arrays [latent_dim], summaries as floats
+        """
+        assert self.n > 1, "PosteriorStatsAccumulator needs at least two observations for results. Aborting."
+
+        var_x_mu = self.m2_mu / (self.n - 1)
+        var_x_std = self.m2_std / (self.n - 1)
+        dim_kl = self.sum_kl / self.n
+        mean_z_std = self.sum_z_std / self.n
+
+        results = {
+            "n": self.n,
+            "active_units": int((var_x_mu > self.active_units_threshold).sum().item()),
+            "kl": dim_kl.sum().item(),
+            "mean_z_mu": self.mean_mu.mean().item(),
+            "std_z_mu": mean_z_std[0].item(),
+            "mean_z_std": self.mean_std.mean().item(),
+            "std_z_std": mean_z_std[1].item(),
+            "mean_x_mu": self.mean_mu.mean().item(),
+            "std_x_mu": var_x_mu.sqrt().mean().item(),
+            "mean_x_std": self.mean_std.mean().item(),
+            "std_x_std": var_x_std.sqrt().mean().item(),
+            "dim_kl": dim_kl.cpu().numpy(),
+            "var_x_mu": var_x_mu.cpu().numpy(),
+            "mean_x_mu_per_dim": self.mean_mu.cpu().numpy(),
+            "mean_x_std_per_dim": self.mean_std.cpu().numpy(),
+            "std_x_std_per_dim": var_x_std.sqrt().cpu().numpy()
+        }
+
+        return results
+
+
+class AggregatePosteriorBank:
+    def __init__(self, bank_size=4096, staleness_decay=1.0):
+        """
+        FIFO memory bank of the (detached) posterior parameters mu, logvar of recent training steps. The bank
+        entries are used as extra mixture components of the aggregate posterior q(z) when approximating log q(z)
+        and log prod_d q(z_d) (approximate_log_q_z), so that the estimates of MI, TC and dim-KL rely on many more
+        components than a single batch provides. Only the current batch receives gradients.
+
+        As the encoder changes during training, older entries can be down weighted: an entry that was pushed
+        `age` pushes ago has weight staleness_decay ** age (the current batch has weight 1).
+
+        Args:
+            bank_size: int
+                Maximum number of (mu, logvar) rows kept
+            staleness_decay: float
+                In (0, 1], 1 means all components are weighted equally
+        """
+        assert bank_size > 0, "bank_size of the AggregatePosteriorBank must be > 0. Aborting."
+        assert 0.0 < staleness_decay <= 1.0, "staleness_decay must be in (0, 1]. Aborting."
+
+        self.bank_size = bank_size
+        self.staleness_decay = staleness_decay
+
+        # Allocated on the first push: [bank_size, latent_dim], [bank_size, latent_dim], [bank_size]
+        self.mu, self.logvar, self.push_step = None, None, None
+
+        self.n_pushes = 0
+        self.n_filled = 0
+        self.write_ptr = 0
+
+    def __len__(self):
+        return self.n_filled
+
+    @torch.no_grad()
+    def push(self, mu, logvar):
+        """
+        Add the posterior parameters of a batch to the bank, overwriting the oldest entries once full.
+
+        Args:
+            mu: Tensor [batch, latent_dim]
+            logvar: Tensor [batch, latent_dim]
+        """
+        if self.mu is None:
+            self.mu = torch.zeros((self.bank_size, mu.shape[1]), dtype=mu.dtype, device=mu.device)
+            self.logvar = torch.zeros_like(self.mu)
+            self.push_step = torch.zeros(self.bank_size, dtype=torch.long, device=mu.device)
+
+        # If the batch is larger than the bank, only the last rows are kept
+        mu, logvar = mu.detach()[-self.bank_size:], logvar.detach()[-self.bank_size:]
+        n = mu.shape[0]
+
+        idx = (self.write_ptr + torch.arange(n, device=self.mu.device)) % self.bank_size
+        self.mu[idx] = mu.to(self.mu.dtype)
+        self.logvar[idx] = logvar.to(self.logvar.dtype)
+        self.push_step[idx] = self.n_pushes
+
+        self.write_ptr = (self.write_ptr + n) % self.bank_size
+        self.n_filled = min(self.n_filled + n, self.bank_size)
+        self.n_pushes += 1
+
+    def components(self, mu, logvar):
+        """
+        The mixture components for approximate_log_q_z: the current batch followed by the bank entries.
+
+        Args:
+            mu: Tensor [batch, latent_dim]
+            logvar: Tensor [batch, latent_dim]
+        Returns:
+            mu: Tensor [batch + n_filled, latent_dim]
+            logvar: Tensor [batch + n_filled, latent_dim]
+            log_weights: Tensor [batch + n_filled] or None (if all weights are equal)
+        """
+        if self.n_filled == 0:
+            return mu, logvar, None
+
+        bank_mu = self.mu[:self.n_filled].to(mu.dtype)
+        bank_logvar = self.logvar[:self.n_filled].to(logvar.dtype)
+
+        mu = torch.cat([mu, bank_mu], dim=0)
+        logvar = torch.cat([logvar, bank_logvar], dim=0)
+
+        if self.staleness_decay == 1.0:
+            return mu, logvar, None
+
+        # age >= 1 for the bank, 0 for the current batch
+        age = self.n_pushes - self.push_step[:self.n_filled]
+        log_weights = torch.cat([torch.zeros(mu.shape[0] - self.n_filled, dtype=mu.dtype, device=mu.device),
+                                 age.to(mu.dtype) * math.log(self.staleness_decay)])
+
+        return mu, logvar, log_weights
+
+
+class PriorSamplePool:
+    def __init__(self, pool_size=1024, batch_size=64, max_seq_len=64, seed=0):
+        """
+        A pool of samples from the generative model (ancestral sampling from the prior) for the evaluation of
+        log p(x_gen) during validation. At the start of a validation epoch (refresh) the pool is sized to one
+        batch per validation step, so no batch is evaluated twice. The samples are generated in rounds of
+        pool_size samples: the sequences of a round are sorted by length and cut into batches (little padding),
+        which are then published in a random order. Every published batch thus belongs to a complete round, an
+        unbiased sample of the model, and the validation steps do not see the short sequences (which finish
+        first) before the long ones. A validation step only waits for the round of its batch.
+
+        Args:
+            pool_size: int
+                The number of samples that are generated and sorted together (rounded to a multiple of batch_size)
+            batch_size: int
+                The batch size of the batches that are handed out (and of the running decode batch)
+            max_seq_len: int
+                Maximum length of generated sequences
+            seed: int
+                Seed of the order in which the batches of a round are published
+        """
+        self.round_size = max(1, pool_size // batch_size) * batch_size
+        self.batch_size = batch_size
+        self.max_seq_len = max_seq_len
+        self.generator = torch.Generator().manual_seed(seed)
+
+        # Published batches, guarded by the condition (notified for every new batch and at the end)
+        self.batches = []
+        self.n_batches = 0
+        self.next_batch_i = 0
+        self.done = True
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.error = None
+
+    def refresh(self, vae_model, n_batches, device_name="cuda:0", background=True):
+        """
+        (Re)generate the pool with the current state of the model. If background is True the generation runs
+        in a separate thread (and CUDA stream), concurrently with the observed data validation steps.
+        Make sure the model is in eval mode, and call stop() at the end of the validation phase.
+
+        Args:
+            vae_model: NewsVAE
+            n_batches: int
+                The number of validation steps of this epoch
+            device_name: str
+            background: bool
+        """
+        # A previous refresh should be stopped at the end of its validation phase
+        self.stop()
+
+        with self.condition:
+            self.batches, self.n_batches, self.next_batch_i = [], n_batches, 0
+            self.done, self.stopped, self.error = False, False, None
+
+        if background:
+            self.thread = threading.Thread(target=self.fill, args=(vae_model, device_name), daemon=True)
+            self.thread.start()
+        else:
+            self.thread = None
+            self.fill(vae_model, device_name)
+
+    def stop(self):
+        """
+        Stop generating (e.g. validation ended before all batches were used) and wait for the thread to finish,
+        so that it does not decode with a model that is training again.
+        """
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def fill(self, vae_model, device_name):
+        try:
+            # Grad mode is thread local, so disable it here
+            with torch.no_grad():
+                use_side_stream = "cuda" in str(device_name)
+                stream = torch.cuda.Stream(device=device_name) if use_side_stream else None
+
+                with torch.cuda.stream(stream) if use_side_stream else contextlib.nullcontext():
+                    # Decode with the same amount of decode slots as a validation batch
+                    generator = ContinuousBatchingGenerator(vae_model.decoder, max_batch_size=self.batch_size,
+                                                            max_seq_len=self.max_seq_len, device_name=device_name)
+
+                    n_samples = self.n_batches * self.batch_size
+                    for round_start in range(0, n_samples, self.round_size):
+                        latent_z = vae_model.sample_from_prior(latent_size=vae_model.decoder.latent_size,
+                                                               n_samples=min(self.round_size, n_samples - round_start),
+                                                               device_name=device_name)
+
+                        request = GenerationRequest(latent_z, max_seq_len=self.max_seq_len,
+                                                    nucleus_sampling=True,
+                                                    top_k=0,  # no filtering
+                                                    top_p=1.0)  # no filtering
+                        generator.add_request(request)
+                        while not request.is_done():
+                            if self.stopped:
+                                return
+                            generator.step()
+
+                        input_ids, attention_mask, lens = make_batch_from_model_samples(request.get_predictions())
+
+                        # Sort by length, so that the batches contain as little padding as possible
+                        order = torch.argsort(lens, descending=True)
+                        input_ids, attention_mask, lens = input_ids[order], attention_mask[order], lens[order]
+
+                        batches = []
+                        for lens_b, ids_b, mask_b in zip(lens.split(self.batch_size),
+                                                          input_ids.split(self.batch_size),
+                                                          attention_mask.split(self.batch_size)):
+                            # lens is the position of </s>, which should be included
+                            seq_len = min(int(lens_b.max().item()) + 1, ids_b.shape[1])
+                            batches.append((ids_b[:, :seq_len], mask_b[:, :seq_len]))
+
+                        # The batches are used on the default stream of the validation steps
+                        if stream is not None:
+                            stream.synchronize()
+
+                        # Publish in a random order, so that the batch lengths do not depend on the step
+                        with self.condition:
+                            for i in torch.randperm(len(batches), generator=self.generator).tolist():
+                                self.batches.append(batches[i])
+                            self.condition.notify_all()
+
+        except Exception as e:
+            self.error = e
+
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def next_batch(self):
+        """
+        Returns the next batch of the pool, waits for that batch to be generated if necessary.
+
+        Returns:
+            input_ids: Tensor [batch, seq_len]
+            attention_mask: Tensor [batch, seq_len]
+        """
+        assert self.n_batches > 0, "Call refresh() before next_batch(). Aborting."
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.next_batch_i < len(self.batches) or self.done)
+
+            if self.error is not None:
+                raise self.error
+
+            assert self.next_batch_i < len(self.batches), \
+                f"More validation steps than the x_gen pool was refreshed for ({self.n_batches}). Aborting."
+
+            batch = self.batches[self.next_batch_i]
+            self.next_batch_i += 1
+
+        return batch
+
+
 class LossTermManager(torch.nn.Module):
     """
         This class manages the loss function by keeping track of:
@@ -240,6 +843,33 @@ class LossTermManager(torch.nn.Module):
         self.objective = config.objective
         self.ddp = config.ddp
 
+        # Posterior sampling scheme for the importance weighted log likelihood (iid, antithetic, sobol)
+        self.iw_ll_sampling = config.iw_ll_sampling
+
+        # 1D KDE for the dim marginal KL estimate (pooled or per_dimension)
+        self.kde1d_mode = config.kde1d_mode
+
+        # Memory bank of recent posteriors as extra components of q(z) for log q(z) and log prod q(z_d)
+        if config.posterior_bank_size > 0:
+            self.posterior_bank = AggregatePosteriorBank(bank_size=config.posterior_bank_size,
+                                                         staleness_decay=config.posterior_bank_staleness_decay)
+        else:
+            self.posterior_bank = None
+
+        # Split level posterior statistics, set (reset) by the train loop at the start of a validation phase
+        self.posterior_stats = None
+
+        # MMD estimator (quadratic or linear) for mmd-vae and the tts_mmd of the constraint objectives
+        self.mmd_estimator = config.mmd_estimator
+        self.mmd_vae_lambda = config.mmd_vae_lambda
+
+        # Pool of model samples for the evaluation of log p(x_gen) during validation
+        if config.eval_iw_ll_x_gen and config.x_gen_pool_size > 0:
+            self.x_gen_pool = PriorSamplePool(pool_size=config.x_gen_pool_size, batch_size=config.batch_size,
+                                              max_seq_len=config.max_seq_len_x_gen)
+        else:
+            self.x_gen_pool = None
+
         # TOTAL LOSS
         # scheduler will take care of the actual LR
         self.total_loss_optimiser = torch.optim.AdamW(vae_model.parameters(), lr=1.0)
@@ -514,15 +1144,22 @@ class LossTermManager(torch.nn.Module):
             #       f"\nRate:  target val: {config.rate_constraint_value}, alpha: {config.rate_constraint_alpha}, lr: {config.rate_constraint_lr}")
 
     def multi_sample_vae_forward(self, input_ids, attention_mask, return_exact_match=False,
-                                 n_samples=100, return_attention_to_latent=False):
+                                 n_samples=100, return_attention_to_latent=False, sampling="iid"):
 
-        # Encode these input ids and sample <n_samples> for each x
+        # Encode these input ids and sample <n_samples> for each x (sampling: iid, antithetic or sobol)
         enc_out = self.vae_model.encoder.encode(input_ids, attention_mask,
                                                 n_samples=n_samples,
+                                                sampling=sampling,
                                                 return_log_q_z_x=True,
                                                 return_log_q_z=True,
                                                 return_log_p_z=True,
-                                                return_embeddings=False)
+                                                return_embeddings=False,
+                                                return_kl=True,
+                                                posterior_bank=self.posterior_bank)
+
+        # Only training steps add to the bank (after it has been used, so it never contains the current batch)
+        if self.posterior_bank is not None and torch.is_grad_enabled():
+            self.posterior_bank.push(enc_out["mu"], enc_out["logvar"])
 
         # Unpack the tensors we need, shapes: [batch, n_samples, latent_dim], [batch, n_samples], [batch, n_samples]
         post_samples, post_log_p_z, post_log_q_z_x = enc_out["latent_z"], enc_out["log_p_z"], enc_out["log_q_z_x"]
@@ -572,62 +1209,30 @@ class LossTermManager(torch.nn.Module):
 
     @staticmethod
     def make_batch_from_model_samples(predictions, eos_token_id=2, pad_token_id=1, bos_token_id=0):
-        # Add a <s> token to the predictions
-        bos = torch.zeros_like(predictions)[:, 0].unsqueeze(1)
-        predictions = torch.cat([bos, predictions], dim=1)
-
-        # Make a tensor with position indices per row
-        ind = torch.arange(predictions.shape[1]).repeat(predictions.shape[0], 1)
-
-        # Check where the eos_token is in the predictions, if not there set to max_len
-        lens = torch.tensor(
-            [a.index(eos_token_id) if eos_token_id in a else len(a) for a in predictions.tolist()]).unsqueeze(1)
-
-        # Mask everything after the eos_token_id (set to 0.0)
-        # so where < lens, should be true, all after should be 0.0
-        mask = (ind <= lens)
-
-        # Pad the predictions (setting all tokens after </s> to <pad>)
-        predictions[~mask] = pad_token_id
-
-        return predictions, mask, lens.flatten()
+        return make_batch_from_model_samples(predictions, eos_token_id=eos_token_id, pad_token_id=pad_token_id,
+                                             bos_token_id=bos_token_id)
 
     def get_tts_mmmd(self, latent_z):
-        latent_z = latent_z.squeeze(1)
-        prior_sample = torch.randn(latent_z.shape).to(latent_z.device)
-        alphas = [0.1 * i for i in range(15)]
-
         """
-        torch two samples talks about alpha, while this paper talks about estimating kernel width (is that gamma?)
-        paper: https://papers.nips.cc/paper/2012/file/dbe272bab69f8e13f14b405e038deb64-Paper.pdf
-        kernel width might be
-
-        from torch_two_sample import util
+        Multi kernel MMD between the latents and a prior sample over the bandwidths MMD_ALPHAS
+        (formerly computed with torch_two_sample.statistics_diff.MMDStatistic, same estimate).
 
-        sample_12 = torch.cat((latents_1, latents_2), 0)
-        distances = util.pdist(sample_12, sample_12, norm=2)
-        plt.hist(distances.flatten().numpy(), bins=30)
-        gamma = median_distance = torch.median(distances).item()
-        alpha = 1 / (2 * gamma**2)
-        print(alpha)
+        paper: https://papers.nips.cc/paper/2012/file/dbe272bab69f8e13f14b405e038deb64-Paper.pdf
         """
+        latent_z = latent_z.squeeze(1)
+        prior_sample = torch.randn_like(latent_z)
 
-        # print(prior_sample.shape, latent_z.shape)
-
-        n_1, n_2 = len(latent_z), len(prior_sample)
-        MMD_stat = torch_two_sample.statistics_diff.MMDStatistic(n_1, n_2)
-        tts_mmd = MMD_stat(latent_z, prior_sample, alphas, ret_matrix=False)
-
-        # print("**** TORCH TWO SAMPLE MMD", tts_mmd)
+        if self.mmd_estimator == "linear":
+            tts_mmd = mmd_linear(latent_z, prior_sample, MMD_ALPHAS)
+        else:
+            tts_mmd = mmd_quadratic(latent_z, prior_sample, MMD_ALPHAS)
 
         return tts_mmd
 
     @staticmethod
-    def get_1d_kde_dim_marg_kl_estimate(latents, log_p_z, bw="scott", device="cuda:0"):
-        latents_1D = latents.reshape(-1, 1)
-        kde = GaussianKDE(X=latents_1D, bw=bw, device=device)
-        log_q_z_kde = kde.score_samples(Y=latents_1D)
-        log_q_z_kde = log_q_z_kde.reshape(latents.shape)
+    def get_1d_kde_dim_marg_kl_estimate(latents, log_p_z, bw="scott", mode="pooled"):
+        # [batch, latent_dim] log q(z_d) with (blocked, separable) 1D KDEs
+        log_q_z_kde = kde_1d_dim_marginal_log_density(latents, mode=mode, bw=bw)
         log_q_z_kde = log_q_z_kde.sum(dim=1).mean(dim=0)
 
         #print("log_q_z_kde", log_q_z_kde)
@@ -662,9 +1267,10 @@ class LossTermManager(torch.nn.Module):
         else:
             vae_out = self.multi_sample_vae_forward(input_ids=input_ids, attention_mask=attention_mask,
                                                     return_exact_match=return_exact_match, n_samples=iw_ll_n_samples,
-                                                    return_attention_to_latent=return_attention_to_latent)
+                                                    return_attention_to_latent=return_attention_to_latent,
+                                                    sampling=self.iw_ll_sampling)
 
-            if self.objective == "elbo-constraint-optim" or "mmd-constraint-optim":
+            if self.objective in ["elbo-constraint-optim", "mmd-constraint-optim"]:
                 if vae_out["latent_z"].dim() == 3:
                     latents = vae_out["latent_z"][:, 0, :]
                 else:
@@ -672,26 +1278,36 @@ class LossTermManager(torch.nn.Module):
                 tts_mmd = self.get_tts_mmmd(latents)
                 kde_1d_marginal_kl = self.get_1d_kde_dim_marg_kl_estimate(latents=latents,
                                                                           log_p_z=vae_out["log_p_z"].mean(),
-                                                                          bw="scott", device=device_name)
+                                                                          bw="scott", mode=self.kde1d_mode)
             else:
                 tts_mmd = None
                 kde_1d_marginal_kl = None
 
+            if self.objective == "mmd-vae":
+                mmd = maximum_mean_discrepancy(vae_out["latent_z"][:, 0, :], estimator=self.mmd_estimator)
+            else:
+                mmd = None
+
             if return_posterior_stats:
                 post_stats = self.vae_model.calc_posterior_stats(mu=vae_out["mu"], logvar=vae_out["logvar"])
                 vae_out = {**vae_out, **post_stats}
 
+                # Streaming split level statistics (validation)
+                if self.posterior_stats is not None and not torch.is_grad_enabled():
+                    self.posterior_stats.update(vae_out["mu"], vae_out["logvar"])
+
             # Shapes at this point
             # vae_out["reconstruction_loss"] (- log p_x_z), log_q_z_x, log_p_z = [batch, n_samples]
             # log_q_z, log_q_z_prod_marg = 0-dim (number)
             loss_dict = self.assemble_loss(reconstruction_loss=vae_out["reconstruction_loss"].mean(),
                                            mu=vae_out["mu"], logvar=vae_out["logvar"],
+                                           kl=vae_out.pop("kl"),
                                            log_p_z=vae_out["log_p_z"].mean(),
                                            log_q_z_x=vae_out["log_q_z_x"].mean(),
                                            log_q_z=vae_out["log_q_z"],
                                            tts_mmd=tts_mmd,
                                            log_q_z_prod_marg=vae_out["log_q_z_prod_marg"],
-                                           mmd=None,
+                                           mmd=mmd,
                                            kde_1d_marginal_kl=kde_1d_marginal_kl)
 
             vae_out = {**vae_out, **loss_dict}
@@ -718,29 +1334,36 @@ class LossTermManager(torch.nn.Module):
             # Evaluate the likelihood given to samples that originate from the generative model
             # i.w. log p(x_gen)
             if eval_iw_ll_x_gen:
-                # Without grad, because used as 'external' to the model
-                with torch.no_grad():
-                    # Sample from the model by decoding from prior auto-regressively with sampling
-                    out = self.vae_model(return_reconstruction_loss=False,
-                                         return_posterior_stats=False,
-                                         auto_regressive=True,
-                                         max_seq_len=max_seq_len_x_gen,
-                                         return_predictions=True,
-                                         nucleus_sampling=True,
-                                         top_k=0,  # no filtering
-                                         top_p=1.0,  # no filtering
-                                         decode_sample_from_prior=True,
-                                         n_prior_samples=input_ids.shape[0],
-                                         device_name=device_name)
-
-                    # this prepares the predictions as input samples
-                    padded_predictions, mask, lens = self.make_batch_from_model_samples(out["predictions"])
+                # Take the next batch of the pool that is generated once per validation epoch
+                if self.x_gen_pool is not None:
+                    input_ids_x_gen, attention_mask_x_gen = self.x_gen_pool.next_batch()
+
+                else:
+                    # Without grad, because used as 'external' to the model
+                    with torch.no_grad():
+                        # Sample from the model by decoding from prior auto-regressively with sampling
+                        out = self.vae_model(return_reconstruction_loss=False,
+                                             return_posterior_stats=False,
+                                             auto_regressive=True,
+                                             max_seq_len=max_seq_len_x_gen,
+                                             return_predictions=True,
+                                             nucleus_sampling=True,
+                                             top_k=0,  # no filtering
+                                             top_p=1.0,  # no filtering
+                                             decode_sample_from_prior=True,
+                                             n_prior_samples=input_ids.shape[0],
+                                             device_name=device_name)
+
+                        # this prepares the predictions as input samples
+                        input_ids_x_gen, attention_mask_x_gen, _ = self.make_batch_from_model_samples(
+                            out["predictions"])
 
                 # Should use gradients, but for now only used in
-                vae_out_x_gen = self.multi_sample_vae_forward(input_ids=padded_predictions.to(device_name),
-                                                              attention_mask=mask.to(device_name),
-                                                              return_exact_match=False, n_samples=eval_iw_ll_x_gen,
-                                                              return_attention_to_latent=False)
+                vae_out_x_gen = self.multi_sample_vae_forward(input_ids=input_ids_x_gen.to(device_name),
+                                                              attention_mask=attention_mask_x_gen.to(device_name),
+                                                              return_exact_match=False, n_samples=iw_ll_n_samples,
+                                                              return_attention_to_latent=False,
+                                                              sampling=self.iw_ll_sampling)
 
                 # Log the mean of the batch as well as the values to add to histogram
                 vae_out["iw_ll_x_gen_mean"] = vae_out_x_gen["iw_ll_mean"]
@@ -793,12 +1416,13 @@ class LossTermManager(torch.nn.Module):
         iw_likelihood = torch.logsumexp(iw_frac, dim=-1) - np.log(n_samples)
         return iw_likelihood
 
-    def assemble_loss(self, reconstruction_loss, mu, logvar,
+    def assemble_loss(self, reconstruction_loss, mu, logvar, kl=None,
                       log_p_z=None, log_q_z_x=None, tts_mmd=None,
                       log_q_z=None, log_q_z_prod_marg=None, mmd=None, kde_1d_marginal_kl=None):
         """
         # log_p_x_z, log_q_z_x, log_p_z = [batch, n_samples]
         # log_q_z, log_q_z_prod_marg = 0-dim (numbers)
+        # kl = [batch, latent_dim] (optional, the analytical KL per dimension computed by the encoder)
 
         """
 
@@ -807,7 +1431,7 @@ class LossTermManager(torch.nn.Module):
         # Calculate the KL divergence analytically
         kl_analytical, fb_kl_analytical = kl_divergence(mu, logvar,
                                                         hinge_kl_loss_lambda=self.free_bits_pd,
-                                                        average_batch=True, sum_latent=True)
+                                                        average_batch=True, sum_latent=True, kl_loss=kl)
 
         # Non-analytical KL computation
         # kl_loss = log_q_z_x - log_p_z
@@ -967,7 +1591,8 @@ class LossTermManager(torch.nn.Module):
 
         # MMD-VAE
         elif self.objective == "mmd-vae":
-            total_loss = reconstruction_loss + mmd
+            total_loss = reconstruction_loss + self.mmd_vae_lambda * mmd
+            loss_dict["mmd"] = mmd
 
         # HOFFMAN VAE
         elif self.objective == "hoffman":
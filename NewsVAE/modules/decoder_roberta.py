@@ -164,6 +164,24 @@ class RobertaEmbeddings(nn.Module):
         embeddings = self.dropout(embeddings)
         return embeddings
 
+    def step(self, input_ids, positions):
+        """
+        Embeddings for a single decode step, position ids are derived from the token index directly
+        (no cumsum over the input) and there is only one token type.
+
+        Args:
+            input_ids: Tensor [batch]
+            positions: Tensor [batch]
+                Index of the current token in the sequence (<s> = 0)
+        Returns:
+            embeddings: Tensor [batch, hidden_size]
+        """
+        embeddings = self.word_embeddings(input_ids) + self.token_type_embeddings.weight[0]
+        embeddings += self.position_embeddings(positions + self.padding_idx + 1)
+        embeddings = self.LayerNorm(embeddings)
+        embeddings = self.dropout(embeddings)
+        return embeddings
+
     def create_position_ids_from_inputs_embeds(self, inputs_embeds):
         """
         We are provided embeddings directly. We cannot infer which are padded so just generate sequential position ids.
@@ -540,6 +558,64 @@ class VaeDecoderRobertaSelfAttention(nn.Module):
         return out_dict
 
 
+    def step(self, hidden_states, attention_mask, key_cache, value_cache, slots, positions,
+             latent_layer_memory_i=None, proj_latent_i=None, gating=False):
+        """
+        Single token version of forward for incremental decoding with a pre-allocated KV cache pool.
+        The key and value of the current token are written into the pool in place, after which the query
+        attends over the first N_keys positions of its row in the pool. The latent memory is attended to
+        separately, so the attention mask does not need to be extended for it. No dropout, head mask or
+        attention probabilities (inference only).
+
+        Shapes:
+            hidden_states:          [Batch, 1, Hidden_size]
+            attention_mask:         [Batch, 1, 1, N_keys], additive (0.0 for cached tokens, -10000.0 masked)
+            key_cache:              [Pool_size, N_heads, Max_seq_len, Head_size]
+            value_cache:            ,,
+            slots:                  [Batch], rows of the pool
+            positions:              [Batch], index of the current token in the pool
+            latent_layer_memory_i:  [Batch, 1, Hidden_size]
+            context_layer:          [Batch, 1, Hidden_size]
+        """
+        n_keys = attention_mask.shape[-1]
+
+        query_layer = self.transpose_for_scores(self.query_module(hidden_states, proj_latent=proj_latent_i))
+        key_layer = self.transpose_for_scores(self.key_module(hidden_states, proj_latent=proj_latent_i))
+        value_layer = self.transpose_for_scores(self.value_module(hidden_states, proj_latent=proj_latent_i))
+
+        key_cache[slots, :, positions] = key_layer[:, :, 0]
+        value_cache[slots, :, positions] = value_layer[:, :, 0]
+        key_layer = key_cache[slots, :, :n_keys]
+        value_layer = value_cache[slots, :, :n_keys]
+
+        # [Batch, N_heads, 1, N_keys]
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        attention_scores = attention_scores / math.sqrt(self.attention_head_size) + attention_mask
+
+        if latent_layer_memory_i is None:
+            context_layer = torch.matmul(nn.functional.softmax(attention_scores, dim=-1), value_layer)
+
+        else:
+            # The latent is both key and value: [Batch, N_heads, 1, Head_size]
+            latent_layer = self.transpose_for_scores(latent_layer_memory_i)
+            latent_scores = torch.matmul(query_layer, latent_layer.transpose(-1, -2))
+            latent_scores = latent_scores / math.sqrt(self.attention_head_size)
+
+            if gating is True:
+                latent_attention_probs = torch.sigmoid(latent_scores)
+                context_layer = torch.matmul(nn.functional.softmax(attention_scores, dim=-1), value_layer)
+                context_layer = ((1.0 - latent_attention_probs) * context_layer) + (
+                        latent_attention_probs * latent_layer)
+            else:
+                attention_probs = nn.functional.softmax(torch.cat([latent_scores, attention_scores], dim=-1), dim=-1)
+                context_layer = torch.matmul(attention_probs[:, :, :, 1:], value_layer) + (
+                        attention_probs[:, :, :, :1] * latent_layer)
+
+        context_layer = context_layer.permute(0, 2, 1, 3).reshape(hidden_states.shape[0], 1, self.all_head_size)
+
+        return context_layer
+
+
 # Copied from transformers.models.bert.modeling_bert.BertSelfOutput
 class RobertaSelfOutput(nn.Module):
     def __init__(self, config):
@@ -740,6 +816,23 @@ class VaeDecoderRobertaLayer(nn.Module):
 
         return out_dict
 
+    def step(self, hidden_states, attention_mask, key_cache, value_cache, slots, positions,
+             latent_memory_i=None, latent_cross_i=None, proj_latent_i=None, gating=False):
+        """
+        Single token version of forward, see VaeDecoderRobertaSelfAttention.step.
+        """
+        context_layer = self.attention.self.step(hidden_states, attention_mask, key_cache, value_cache, slots,
+                                                 positions, latent_layer_memory_i=latent_memory_i,
+                                                 proj_latent_i=proj_latent_i, gating=gating)
+        attention_output = self.attention.output(context_layer, hidden_states)
+
+        # A single query attends to the latent and itself, so the cross attention needs no mask
+        if latent_cross_i is not None:
+            attention_output = self.crossattention(hidden_states=attention_output,
+                                                   latent_layer_cross_i=latent_cross_i)["attention_output"]
+
+        return self.feed_forward_chunk(attention_output)
+
     def feed_forward_chunk(self, attention_output):
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
@@ -1113,6 +1206,32 @@ class VaeDecoderRobertaModel(RobertaPreTrainedModel):
             cross_attentions=encoder_outputs.cross_attentions,
         )
 
+    def step(self, input_ids, positions, attention_mask, key_cache, value_cache, slots,
+             latent_layer_memory=None, latent_embedding=None, latent_matrix_proj=None, latent_layer_cross=None,
+             gating=False):
+        """
+        Single token version of forward, see VaeDecoderRobertaForCausalLM.step_forward.
+
+        Returns:
+            last_hidden_state: Tensor [batch, hidden_size]
+        """
+        hidden_states = self.embeddings.step(input_ids, positions)
+
+        if latent_embedding is not None:
+            hidden_states = hidden_states + latent_embedding
+
+        hidden_states = hidden_states.unsqueeze(1)
+
+        for i, layer_module in enumerate(self.encoder.layer):
+            hidden_states = layer_module.step(
+                hidden_states, attention_mask, key_cache[i], value_cache[i], slots, positions,
+                latent_memory_i=latent_layer_memory[i] if latent_layer_memory is not None else None,
+                latent_cross_i=latent_layer_cross[i] if latent_layer_cross is not None else None,
+                proj_latent_i=latent_matrix_proj[i] if latent_matrix_proj is not None else None,
+                gating=gating)
+
+        return hidden_states[:, 0]
+
 
 class VaeDecoderRobertaForCausalLM(RobertaPreTrainedModel):
     _keys_to_ignore_on_load_missing = [r"position_ids", r"lm_head.decoder.bias"]
@@ -1427,6 +1546,53 @@ class VaeDecoderRobertaForCausalLM(RobertaPreTrainedModel):
         return return_dict
         # <<<< Claartje code
 
+    def step_forward(self, input_ids, positions, attention_mask, key_cache, value_cache, slots,
+                     latent_to_decoder_output=None, gating=False):
+        """
+        Incremental decoding: predict the next token logits for one input token per sequence, using a
+        pre-allocated KV cache pool instead of past_key_values. Compared to forward (with use_cache), this
+        skips building the extended (causal) attention mask, the position id cumsum, the token type allocation,
+        the latent memory mask extension in every layer and all the teacher-forcing (loss) machinery.
+
+        Args:
+            input_ids: Tensor [batch]
+                The current input token of every sequence
+            positions: Tensor [batch]
+                The index of the current token in its sequence (<s> = 0), which is also where its key and value
+                are written in the pool
+            attention_mask: Tensor [batch, 1, 1, n_keys]
+                Additive mask over the first n_keys positions of the pool (0.0 for the cached tokens and the
+                current token, -10000.0 for the rest). The latent memory (if used) is always attended to.
+            key_cache: List[Tensor [pool_size, n_heads, max_seq_len, head_size]]
+                Key cache per layer, written in place
+            value_cache: List[Tensor [pool_size, n_heads, max_seq_len, head_size]]
+                Value cache per layer, written in place
+            slots: Tensor [batch]
+                The rows of the pool that belong to the sequences in this batch
+            latent_to_decoder_output: dict
+                Output of LatentToDecoderNewsVAE for the latents of this batch
+            gating: bool
+
+        Returns:
+            logits: Tensor [batch, vocab_size]
+        """
+        assert self.roberta.embeddings.position_embedding_type == "absolute", \
+            "step_forward is only implemented for absolute position embeddings. Aborting."
+
+        if latent_to_decoder_output is None:
+            latent_to_decoder_output = {}
+
+        last_hidden_state = self.roberta.step(input_ids, positions, attention_mask, key_cache, value_cache, slots,
+                                              latent_layer_memory=latent_to_decoder_output.get('latent_to_memory'),
+                                              latent_embedding=latent_to_decoder_output.get('latent_to_embeddings'),
+                                              latent_matrix_proj=latent_to_decoder_output.get('latent_matrix_proj'),
+                                              latent_layer_cross=latent_to_decoder_output.get('latent_to_cross'),
+                                              gating=gating)
+
+        logits, _ = self.lm_head(last_hidden_state)
+
+        return logits
+
     # >>>> Claartje code
     @staticmethod
     def reduce_correct(some_tensor, reduction_type, reduction_dim, label_mask):
@@ -3,6 +3,7 @@ import torch
 import math
 from modules.encoder_roberta import VAE_Encoder_RobertaModel
 from loss_and_optimisation import *
+from utils_gaussian import posterior_prior_log_probs
 
 
 class EncoderNewsVAE(torch.nn.Module):
@@ -66,9 +67,15 @@ class EncoderNewsVAE(torch.nn.Module):
         return return_dict
 
     def encode(self, input_ids, attention_mask, n_samples=1, dataset_size=10000,
-               return_log_q_z_x=True, return_log_p_z=True, return_log_q_z=True, return_embeddings=False):
+               return_log_q_z_x=True, return_log_p_z=True, return_log_q_z=True, return_embeddings=False,
+               sampling="iid", return_mmd=False, posterior_bank=None, return_kl=False):
         """
         This function encodes samples into latents by sampling and returns losses (kl, hinge_kl & mmd).
+        With return_kl the analytical KL per latent dimension [batch, latent_dim] is returned as "kl", computed
+        from the same terms as log_q_z_x and log_p_z.
+        For the posterior sampling schemes (sampling), see reparameterize.
+        If a posterior_bank (AggregatePosteriorBank) is given, its entries are used as extra (detached)
+        mixture components of q(z) for log_q_z and log_q_z_prod_marg.
         """
 
         # Forward
@@ -77,7 +84,7 @@ class EncoderNewsVAE(torch.nn.Module):
         mu, logvar = encoder_out["mu"], encoder_out["logvar"]
 
         # Sample latents from posterior
-        latent_z = self.reparameterize(mu, logvar, n_samples=n_samples)
+        latent_z = self.reparameterize(mu, logvar, n_samples=n_samples, sampling=sampling)
         single_sample_z = latent_z[:, 0, :]
 
         # print("mu.shape", mu.shape)
@@ -88,23 +95,27 @@ class EncoderNewsVAE(torch.nn.Module):
         # return_log_q_z_x = True # TODO; remove this
         # return_log_p_z = True # TODO; remove this
 
-        log_q_z_x, log_p_z, log_q_z, log_q_z_prod_marg = None, None, None, None
-        if return_log_q_z_x:
-            log_q_z_x = sample_log_likelihood(latent_z, mu=mu, logvar=logvar,
-                                              reduce_latent_dim=True, reduce_batch_dim=False)
-
-        if return_log_p_z:
-            log_p_z = sample_log_likelihood(latent_z, mu=None, logvar=None,
-                                            reduce_latent_dim=True, reduce_batch_dim=False)
+        log_q_z_x, log_p_z, kl, log_q_z, log_q_z_prod_marg = None, None, None, None, None
+        if return_log_q_z_x or return_log_p_z or return_kl:
+            log_q_z_x, log_p_z, kl = posterior_prior_log_probs(latent_z, mu, logvar, return_kl=True)
+            log_q_z_x = log_q_z_x if return_log_q_z_x else None
+            log_p_z = log_p_z if return_log_p_z else None
+            kl = kl if return_kl else None
 
         if return_log_q_z:
             # NB: only implemented with a single posterior sample
-            log_q_z, log_q_z_prod_marg = approximate_log_q_z(mu, logvar, single_sample_z, method="chen",
+            if posterior_bank is not None:
+                mu_q_z, logvar_q_z, log_weights = posterior_bank.components(mu, logvar)
+            else:
+                mu_q_z, logvar_q_z, log_weights = mu, logvar, None
+
+            log_q_z, log_q_z_prod_marg = approximate_log_q_z(mu_q_z, logvar_q_z, single_sample_z, method="chen",
                                                              dataset_size=dataset_size,
-                                                             prod_marginals=True)
-        # Calculate the Maximum Mean Discrepancy
+                                                             prod_marginals=True,
+                                                             log_weights=log_weights)
+        # Calculate the Maximum Mean Discrepancy (the mmd-vae objective computes its own in the LossTermManager)
         # NB: only implemented with a single posterior sample
-        mmd_loss = maximum_mean_discrepancy(single_sample_z)
+        mmd_loss = maximum_mean_discrepancy(single_sample_z) if return_mmd else None
 
         # print("log_q_z_x.shape", log_q_z_x.shape)
         # print("log_p_z.shape", log_p_z.shape)
@@ -125,10 +136,13 @@ class EncoderNewsVAE(torch.nn.Module):
             "log_p_z": log_p_z
         }
 
+        if return_kl:
+            return_dict["kl"] = kl
+
         return return_dict
 
     @staticmethod
-    def reparameterize(mu, logvar, n_samples=1):
+    def reparameterize(mu, logvar, n_samples=1, sampling="iid"):
         """
         Sample from posterior Gaussian family
 
@@ -140,11 +154,22 @@ class EncoderNewsVAE(torch.nn.Module):
                 Log variance to ensure positivity
             n_samples: int
                 How many samples z per encoded sample x to return
+            sampling: str
+                How to draw the standard normal noise of the n_samples samples per x:
+                    - "iid": independent samples
+                    - "antithetic": pairs (eps, -eps), with an odd n_samples the last pair is cut in half
+                    - "sobol": randomised quasi-Monte Carlo, a scrambled Sobol sequence with an independent
+                    random shift per x, mapped through the inverse normal CDF. Best with n_samples a power of 2.
+                Every single sample is still distributed as q(z|x), so importance weighted estimates stay
+                unbiased (antithetic and sobol samples are not independent).
         Returns:
             latent_z: Tensor
                 Sampled z with shape (batch, n_samples, nz)
         """
 
+        assert sampling in ["iid", "antithetic", "sobol"], \
+            "Unknown sampling scheme '{}', choose from: iid, antithetic, sobol. Aborting.".format(sampling)
+
         batch_size, nz = mu.size()
         std = logvar.mul(0.5).exp()  # logvar -> std
 
@@ -152,8 +177,28 @@ class EncoderNewsVAE(torch.nn.Module):
         mu_expd = mu.unsqueeze(1).expand(batch_size, n_samples, nz)
         std_expd = std.unsqueeze(1).expand(batch_size, n_samples, nz)
 
+        if sampling == "iid":
+            eps = torch.zeros_like(std_expd).normal_()
+
+        elif sampling == "antithetic":
+            eps = torch.zeros((batch_size, (n_samples + 1) // 2, nz), dtype=mu.dtype, device=mu.device).normal_()
+            eps = torch.cat([eps, -eps], dim=1)[:, :n_samples, :]
+
+        else:  # sobol
+            # Seed the engine from the torch RNG, so that seeding torch makes this reproducible
+            seed = int(torch.randint(0, 2 ** 31 - 1, (1,)).item())
+            sobol = torch.quasirandom.SobolEngine(dimension=nz, scramble=True, seed=seed)
+            points = sobol.draw(n_samples, dtype=torch.float64).to(mu.device)
+
+            # Cranley-Patterson rotation: an independent uniform shift (mod 1) per x
+            shift = torch.rand((batch_size, 1, nz), dtype=torch.float64, device=mu.device)
+            uniform = torch.remainder(points.unsqueeze(0) + shift, 1.0)
+
+            # Inverse normal CDF, clamped to stay away from +/- inf
+            uniform = uniform.clamp(min=1e-12, max=1.0 - 1e-12)
+            eps = (math.sqrt(2.0) * torch.erfinv(2.0 * uniform - 1.0)).to(mu.dtype)
+
         # Reparameterize: transform basic noise sample into complex sample
-        eps = torch.zeros_like(std_expd).normal_()
         latent_z = mu_expd + torch.mul(eps, std_expd)
 
         return latent_z
@@ -1,7 +1,7 @@
 from utils_external import tie_weights
 # from utils_evaluation import tokenizer_batch_decode
 import torch
-from loss_and_optimisation import LossTermManager
+from loss_and_optimisation import LossTermManager, posterior_batch_stats
 from modules.decoder import DecoderNewsVAE
 from modules.encoder import EncoderNewsVAE
 import copy
@@ -274,31 +274,7 @@ class NewsVAE(torch.nn.Module):
 
     @staticmethod
     def calc_posterior_stats(mu, logvar):
-        stats_dict = {}
-        std = torch.sqrt(logvar.exp())
-
-        mean_z_mu = mu.mean(dim=1).mean()
-        std_z_mu = torch.std(mu, dim=1).mean()
-
-        mean_z_std = std.mean(dim=1).mean()
-        std_z_std = torch.std(std, dim=1).mean()
-
-        mean_x_mu = mu.mean(dim=0).mean()
-        std_x_mu = torch.std(mu, dim=0).mean()
-
-        mean_x_std = std.mean(dim=0).mean()
-        std_x_std = torch.std(std, dim=0).mean()
-
-        stats_dict["mean_z_mu"] = mean_z_mu.item()
-        stats_dict["std_z_mu"] = std_z_mu.item()
-        stats_dict["mean_z_std"] = mean_z_std.item()
-        stats_dict["std_z_std"] = std_z_std.item()
-        stats_dict["mean_x_mu"] = mean_x_mu.item()
-        stats_dict["std_x_mu"] = std_x_mu.item()
-        stats_dict["mean_x_std"] = mean_x_std.item()
-        stats_dict["std_x_std"] = std_x_std.item()
-
-        return stats_dict
+        return posterior_batch_stats(mu, logvar)
 
     @staticmethod
     def calculate_embedding_space_loss(input_ids, in_w_emb, out_w_emb,
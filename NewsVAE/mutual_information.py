@@ -1,54 +1,42 @@
 import os
-from train import get_model_on_device
-from utils_evaluation import valid_dataset_loader_tokenizer
 import torch
 from utils_train import load_from_checkpoint, transfer_batch_to_device
+from utils_storage import cached_result
+from utils_gaussian import gaussian_log_density_matrix
+from dataset_wrappper import NewsData
 import numpy as np
-from torch.distributions import MultivariateNormal, Normal
-from torch.distributions.categorical import Categorical
+from torch.distributions import Normal
 import pickle
-from modules.encoder import EncoderNewsVAE
 import math
-from scipy.stats import gaussian_kde
+from utils_latent_analysis_optimisation import GaussianKDE
 
 """
 Functions in this file:
     - log_prob_pairs(dists, sample_batch)
-    - mi_lower_bound(samples, dists)
-    - mi_upper_bound(samples, dists)
+    - gaussian_log_prob_pairs(samples, mu, logvar)
+    - mi_lower_bound(samples, dists) / mi_lower_bound_from_log_probs(log_probs_pairs)
+    - mi_upper_bound(samples, dists) / mi_upper_bound_from_log_probs(log_probs_pairs)
     - calc_upper_and_lower_bound_representational_mi(batch_latent_samples, batch_mu_logvars, gauss_dists=None)
     - calc_upper_and_lower_bound_generative_mi(batch_probs, cat_dists=None)
+    - categorical_mi_bounds(probs, samples)
     
     - main(model_path) <- executes calculation of MI bounds for whole validation set
 """
 
 
-def _gaussian_log_likelihood(sample, mask, dim, mu=None, var=None):
-    """Computes the log likelihood of a given sample under a gaussian with given parameters.
-    If mu or var is not given they are assumed to be standard.
-    """
-
-
-    if mu is None and var is None:
-        # log_q_z_x = (-0.5 * ((dev ** 2) / var) - 0.5 * (math.log(2 * math.pi) - logvar)).sum(dim=-1)
-        return -0.5 * torch.sum((torch.log(sample.new_tensor(2 * np.pi)) + sample ** 2) * mask.unsqueeze(dim), dim=dim)
-    elif mu is None:
-        return -0.5 * torch.sum((torch.log(2 * np.pi * var) + sample ** 2 / var) * mask.unsqueeze(dim), dim=dim)
-    elif var is None:
-        return -0.5 * torch.sum((torch.log(sample.new_tensor(2 * np.pi)) + (sample - mu) ** 2)
-                                * mask.unsqueeze(dim), dim=dim)
-    else:
-        return -0.5 * torch.sum((torch.log(2 * np.pi * var) + (sample - mu) ** 2 / var) * mask.unsqueeze(dim), dim=dim)
+def q_z_estimate(z, mu, var):
+    """Computes an estimate of q(z), the marginal posterior, as the mixture of the posteriors (mu, var).
 
-
-def q_z_estimate(z, mu, var, device="cuda:0"):
-    """Computes an estimate of q(z), the marginal posterior."""
-    # z = [S, z_dim], mu = [N, z_dim], var = [N, z_dim], log_q_z = [S, N]
-    log_q_z_x = _gaussian_log_likelihood(sample=z.unsqueeze(1), mask=torch.tensor([[1.]], device=device), dim=2, mu=mu, var=var)
-    # [S,]
-    print("log_q_z_x.shape", log_q_z_x.shape)
-    print('first 10 vals of log_q_z_x in q_z_estimate', log_q_z_x[:10])
-    log_q_z = torch.logsumexp(log_q_z_x.unsqueeze(0), dim=1) - torch.log(torch.tensor(log_q_z_x.shape[1], device=device, dtype=torch.float))
+    Args:
+        z: Tensor [S, z_dim]
+        mu: Tensor [N, z_dim]
+        var: Tensor [N, z_dim]
+    Returns:
+        log_q_z: Tensor [S]
+    """
+    # [S, N]
+    log_q_z_x = gaussian_log_density_matrix(z, mu, var.log())
+    log_q_z = torch.logsumexp(log_q_z_x, dim=1) - math.log(log_q_z_x.shape[1])
     return log_q_z
 
 
@@ -70,28 +58,17 @@ def calc_mi_estimate(log_q_z_x, latents, mu, logvar, log_p_z, avg_KL, log_q_z_me
         marg_KL(float): estimated KL[q(z)||p(z)] given N samples from q(z|x).
     """
 
-    if log_q_z_method is "kernel":
-        print("kernel method for calculating log_q_z of latents")
-        # log_q_z = kde_gauss(samples, kde_method)
-        samples_cpu = latents.cpu().numpy().transpose()
-        print("samples_cpu.shape", samples_cpu.shape)
-        kde = gaussian_kde(samples_cpu)
-        # [num] with p(samples) under kernels
-        print("first 10 vals of scikit gauss kde", kde.logpdf(samples_cpu)[:10])
-
-        log_q_z = torch.log(EncoderNewsVAE.gaussian_kernel(latents, latents).mean(dim=1) + 1e-80)
-        print("first 10 vals of pytorch gauss kde", log_q_z[:10])
-    elif log_q_z_method is "aggregate_posterior":
+    if log_q_z_method == "kernel":
+        # [N] log q(z) of the samples under a Gaussian KDE fit to the samples (scipy gaussian_kde equivalent)
+        kde = GaussianKDE(latents, bw="scott", covariance="full")
+        log_q_z = kde.score_samples(latents)
+    elif log_q_z_method == "aggregate_posterior":
         log_q_z = torch.logsumexp(log_q_z_x, dim=0) - math.log(len(log_q_z_x))
     else:
         raise NotImplementedError
 
-    print(log_q_z.shape, log_p_z.shape)
-    print(log_q_z, log_p_z.mean())
-
-
     # KL(q||p) = E_q[log q / log p] = E_q[log_q] - E_q[log_p]
-    marg_KL = (log_q_z - log_p_z.mean())
+    marg_KL = (log_q_z.mean() - log_p_z.mean())
 
     if mi_method == 'zhao':  # https://arxiv.org/pdf/1806.06514.pdf (Lagrangian VAE)
         # recall that avg_h = log_q_z_x.mean()
@@ -132,6 +109,27 @@ def log_prob_pairs(dists, sample_batch):
     return log_probs_pairs
 
 
+def gaussian_log_prob_pairs(samples, mu, logvar):
+    """
+    Closed form of log_prob_pairs for diagonal Gaussians N(mu_i, diag(exp(logvar_i))): the log densities of
+    all samples under all distributions with a few matrix multiplies (see gaussian_log_density_matrix),
+    on the device of the inputs. Computed in double precision, as the expanded square cancels for
+    narrow posteriors.
+
+    Args:
+        samples: Tensor [batch, latent_size]
+        mu: Tensor [batch, latent_size]
+        logvar: Tensor [batch, latent_size]
+
+    Returns:
+        log_probs_pairs: Tensor [batch, batch]
+            Row dimension is the x (distribution) dimension, column dimension is the z (sample) dimension
+    """
+    log_dens = gaussian_log_density_matrix(samples.double(), mu.double(), logvar.double())
+
+    return log_dens.t().to(samples.dtype)
+
+
 def mi_lower_bound(samples, dists):
     """
     Calculates the InfoTNCE lower bound of MI (Poole et al., 2019)
@@ -153,13 +151,19 @@ def mi_lower_bound(samples, dists):
           InfoTNCE lower bound of MI
     """
 
-    K = samples.shape[0]
-
     # Log probabilities between all latents and distributions
     # so for every distribution there is 1 positive sample where the latent was actually sampled
     # from that distribution and K-1 negative samples
     # -> diagonals are positive, off-diagonal are negative samples
-    log_probs_pairs = log_prob_pairs(dists, samples)
+    return mi_lower_bound_from_log_probs(log_prob_pairs(dists, samples))
+
+
+def mi_lower_bound_from_log_probs(log_probs_pairs):
+    """
+    InfoTNCE lower bound of MI (see mi_lower_bound) from the matrix of log probabilities of all pairs
+    [x, z] (see log_prob_pairs, gaussian_log_prob_pairs).
+    """
+    K = log_probs_pairs.shape[0]
 
     # Get the diagonal elements of log_probs_pairs for numerator
     log_prob_for_matching_x_z = torch.diag(log_probs_pairs)
@@ -193,18 +197,25 @@ def mi_upper_bound(samples, dists):
         mi_upper_mbu: float:
           MBU upper bound of MI
     """
-    K = samples.shape[0]
-
     # Log probability of samples under all distributions of the batch
     # diagonal elements are matching distributions and samples
     # off diagonal elements are 'negative' samples
-    log_probs_pairs = log_prob_pairs(dists, samples)
+    return mi_upper_bound_from_log_probs(log_prob_pairs(dists, samples))
+
+
+def mi_upper_bound_from_log_probs(log_probs_pairs):
+    """
+    MBU upper bound of MI (see mi_upper_bound) from the matrix of log probabilities of all pairs
+    [x, z] (see log_prob_pairs, gaussian_log_prob_pairs).
+    """
+    K = log_probs_pairs.shape[0]
 
     # Get the diagonal elements of log_probs_pairs for numerator
     log_prob_for_matching_x_z = torch.diag(log_probs_pairs)
 
     # Get the log mean probability for non matching pairs x and z, use the logsumexp trick for this
-    select_offdiagonal = log_probs_pairs - torch.diag(np.inf * torch.ones(K))  # exp(-inf) -> 0
+    diagonal = torch.eye(K, dtype=torch.bool, device=log_probs_pairs.device)
+    select_offdiagonal = log_probs_pairs.masked_fill(diagonal, -np.inf)  # exp(-inf) -> 0
     logsumexp_offdiagonal = torch.logsumexp(select_offdiagonal, 0)  # the exp for log prob to prob
 
     marginal = logsumexp_offdiagonal - np.log(K - 1)
@@ -225,6 +236,7 @@ def calc_upper_and_lower_bound_representational_mi(batch_latent_samples, batch_m
         batch_latent_samples: Tensor [batch, latent_size]
         batch_mu_logvars: Tensor [batch, 2*latent_size]
         gauss_dists: List[torch.distributions.MultivariateNormal] [batch]
+            If not given, the log probabilities are computed in closed form (gaussian_log_prob_pairs)
 
     Returns:
         lower: float
@@ -232,45 +244,50 @@ def calc_upper_and_lower_bound_representational_mi(batch_latent_samples, batch_m
 
     """
 
-    K = batch_latent_samples.shape[0]
+    if gauss_dists:
+        lower = mi_lower_bound(batch_latent_samples, gauss_dists)
+        upper = mi_upper_bound(batch_latent_samples, gauss_dists)
+
+        return lower, upper
 
-    if not gauss_dists:
-        # Chunk the parameters in two and transform logvar into std
-        mu, logvar = torch.chunk(batch_mu_logvars, 2, dim=1)
-        std = torch.exp(0.5 * logvar)
+    # Chunk the parameters in two, the posteriors are N(mu, diag(exp(logvar)))
+    mu, logvar = torch.chunk(batch_mu_logvars, 2, dim=1)
 
-        # Make distribution objects for the batch of mu, std
-        gauss_dists = [MultivariateNormal(mu[i, :], torch.diag(std[i, :])) for i in range(K)]
+    # [batch, batch] closed form log probabilities of all (distribution, sample) pairs
+    log_probs_pairs = gaussian_log_prob_pairs(batch_latent_samples.reshape(mu.shape), mu, logvar)
 
-    lower = mi_lower_bound(batch_latent_samples, gauss_dists)
-    upper = mi_upper_bound(batch_latent_samples, gauss_dists)
+    lower = mi_lower_bound_from_log_probs(log_probs_pairs)
+    upper = mi_upper_bound_from_log_probs(log_probs_pairs)
 
     return lower, upper
 
 
-def calc_upper_and_lower_bound_generative_mi(batch_probs, cat_dists=None):
+def calc_upper_and_lower_bound_generative_mi(batch_probs, cat_dists=None, block_size=1024):
     """
     This function calculates the Info TNCE lower bound and MBU upper bound
     on mutual information latents x and sampled predictions with
     tractable conditional (decoder) as a critic (Poole et al., 2019).
 
+    Without cat_dists, the log probabilities of all (distribution, sample) pairs are gathered from the
+    probabilities directly, log probs[:, samples], in blocks of block_size samples, on the device of
+    batch_probs (see categorical_mi_bounds).
+
     Args:
-        batch_probs: Tensor [batch, seq_len, vocab_size]
+        batch_probs: Tensor [batch, seq_len, vocab_size] or [batch x seq_len, vocab_size]
         cat_dists: List[torch.distributions.Categorical] [batch]
+        block_size: int
     Returns:
         lower: float
         upper: float
 
     """
 
-    K = batch_probs.shape[0]
-
     batch_probs = batch_probs.reshape(-1, batch_probs.shape[-1])
+
     sampled_predictions = torch.multinomial(batch_probs, num_samples=1).squeeze(1)
 
     if not cat_dists:
-        # Make distribution objects for the batch probabilities
-        cat_dists = [Categorical(probs=batch_probs[i, :]) for i in range(K)]
+        return categorical_mi_bounds(batch_probs, sampled_predictions, block_size=block_size)
 
     lower = mi_lower_bound(sampled_predictions, cat_dists)
     upper = mi_upper_bound(sampled_predictions, cat_dists)
@@ -278,6 +295,52 @@ def calc_upper_and_lower_bound_generative_mi(batch_probs, cat_dists=None):
     return lower, upper
 
 
+def categorical_mi_bounds(probs, samples, block_size=1024):
+    """
+    InfoTNCE lower and MBU upper bound (see mi_lower_bound, mi_upper_bound) for categorical distributions,
+    without making the [K, K] matrix of log probabilities at once: for a block of samples the log
+    probabilities under all K distributions are gathered (log probs[:, samples]) and reduced over the
+    distributions right away. Probabilities are normalised and clamped like torch.distributions.Categorical.
+
+    Args:
+        probs: Tensor [K, n_classes]
+        samples: Tensor [K]
+            Sample i is drawn from distribution i
+        block_size: int
+    Returns:
+        lower: float
+        upper: float
+    """
+    K = probs.shape[0]
+
+    eps = torch.finfo(probs.dtype).eps
+    log_probs = torch.log((probs / probs.sum(dim=-1, keepdim=True)).clamp(min=eps, max=1 - eps))
+
+    # [K] log p(y_i|x_i)
+    log_prob_matching = log_probs.gather(1, samples.unsqueeze(1)).squeeze(1)
+
+    logsumexp_all, logsumexp_offdiagonal = [], []
+    for start in range(0, K, block_size):
+        block_samples = samples[start:start + block_size]
+
+        # [K, block] log p(y_j|x_i) for the samples j of this block
+        log_probs_pairs = log_probs[:, block_samples]
+        logsumexp_all.append(torch.logsumexp(log_probs_pairs, dim=0))
+
+        # Leave out the matching pairs
+        cols = torch.arange(len(block_samples), device=probs.device)
+        log_probs_pairs[start + cols, cols] = -np.inf
+        logsumexp_offdiagonal.append(torch.logsumexp(log_probs_pairs, dim=0))
+
+    logsumexp_all, logsumexp_offdiagonal = torch.cat(logsumexp_all), torch.cat(logsumexp_offdiagonal)
+
+    lower = (log_prob_matching - (logsumexp_all - np.log(K))).mean().item()
+    upper = (log_prob_matching - (logsumexp_offdiagonal - np.log(K - 1))).mean().item()
+
+    return lower, upper
+
+
+@cached_result(version=3, key_args=("max_batches", "auto_regressive"))
 def calc_all_mi_bounds(vae_model, valid_loader, device_name="cuda:0", max_batches=10, batch_size=128,
                        auto_regressive=False):
 
@@ -320,8 +383,9 @@ def calc_all_mi_bounds(vae_model, valid_loader, device_name="cuda:0", max_batche
             # REPRESENTATIONAL MUTUAL INFORMATION BOUNDS #
             # -------------------------------------------#
 
-            lower_rep_mi, upper_rep_mi = calc_upper_and_lower_bound_representational_mi(vae_output["latents"].cpu(),
-                                                                                        vae_output["mu_logvar"].cpu())
+            mu_logvar = torch.cat([vae_output["mu"], vae_output["logvar"]], dim=1)
+            lower_rep_mi, upper_rep_mi = calc_upper_and_lower_bound_representational_mi(vae_output["latents"],
+                                                                                        mu_logvar)
             lower_rep_mi_all.append(lower_rep_mi)
             upper_rep_mi_all.append(upper_rep_mi)
 
@@ -329,9 +393,9 @@ def calc_all_mi_bounds(vae_model, valid_loader, device_name="cuda:0", max_batche
             # GENERATIVE MUTUAL INFORMATION BOUNDS #
             # -------------------------------------#
 
-            # Merge sequence dimension in the batch dimension
+            # Merge sequence dimension in the batch dimension (stays on the device)
             batch_size, seq_len, vocab_size = vae_output["probabilities"].shape
-            probs = vae_output["probabilities"].reshape(-1, vocab_size).cpu()
+            probs = vae_output["probabilities"].reshape(-1, vocab_size)
 
             # Calculate lower and upper bounds
             lower_gen_mi, upper_gen_mi = calc_upper_and_lower_bound_generative_mi(probs, cat_dists=None)
@@ -373,18 +437,16 @@ if __name__ == "__main__":
     run_names_paths_to_evaluate = list(zip(runs_29DEC_names, runs_29DEC_paths))
 
     # Get validation data
-    _, _, VALID_LOADER = valid_dataset_loader_tokenizer(batch_size=BATCH_SIZE, num_workers=NUM_WORKERS)
+    VALID_LOADER = NewsData("cnn_dailymail", "roberta", batch_size=BATCH_SIZE,
+                            num_workers=NUM_WORKERS, device=DEVICE_NAME).val_dataloader()
 
     # Calculate MI bounds for these models
     mutual_information_results = {}
     for name, path in run_names_paths_to_evaluate:
 
-        vae_model = get_model_on_device(device_name=DEVICE_NAME, latent_size=768, gradient_checkpointing=False,
-                                        add_latent_via_memory=True, add_latent_via_embeddings=True,
-                                        do_tie_weights=True, world_master=True)
-
-        _, _, vae_model, _, _, _, _ = load_from_checkpoint(vae_model, path, world_master=True, ddp=False,
-                                                           use_amp=False)
+        vae_model = load_from_checkpoint(path, world_master=True, ddp=False, device_name=DEVICE_NAME,
+                                         latent_size=768, add_latent_via_memory=True,
+                                         add_latent_via_embeddings=True, do_tie_weights=True, evaluation=True)
 
         mi_results = calc_all_mi_bounds(vae_model, VALID_LOADER, device_name=DEVICE_NAME, max_batches=MAX_BATCHES, batch_size=BATCH_SIZE)
 
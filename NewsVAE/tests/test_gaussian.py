@@ -0,0 +1,48 @@
+import sys
+import math
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import pytest
+import torch
+from utils_gaussian import gaussian_log_density_matrix
+
+
+def direct_log_density_matrix(latent_z, mu, logvar):
+    """
+    The log densities with the [z_batch, x_batch, latent_dim] differences, in float64.
+    """
+    latent_z, mu, logvar = latent_z.double(), mu.double(), logvar.double()
+    square = (latent_z.unsqueeze(1) - mu.unsqueeze(0)) ** 2 * torch.exp(-logvar).unsqueeze(0)
+    return - 0.5 * (square + logvar.unsqueeze(0) + math.log(2 * math.pi)).sum(dim=-1)
+
+
+def posteriors(std, offset, n_x=256, n_z=64, latent_dim=32):
+    torch.manual_seed(0)
+    mu = torch.randn(n_x, latent_dim) + offset
+    logvar = 2 * math.log(std) + 0.1 * torch.randn(n_x, latent_dim)
+    latent_z = mu[:n_z] + std * torch.randn(n_z, latent_dim)
+    return latent_z, mu, logvar
+
+
+def max_relative_error(log_dens, reference):
+    return ((log_dens.double() - reference).abs() / reference.abs().clamp(min=1.0)).max().item()
+
+
+@pytest.mark.parametrize("std, offset, rtol", [(1.0, 0.0, 1e-5), (0.1, 3.0, 1e-4), (0.01, 3.0, 1e-2)])
+def test_float32_matches_direct_formula(std, offset, rtol):
+    latent_z, mu, logvar = posteriors(std, offset)
+
+    log_dens = gaussian_log_density_matrix(latent_z, mu, logvar)
+
+    assert log_dens.dtype == torch.float32
+    assert max_relative_error(log_dens, direct_log_density_matrix(latent_z, mu, logvar)) < rtol
+
+
+@pytest.mark.parametrize("std, offset", [(0.01, 3.0), (1e-3, 5.0), (1e-3, 0.0)])
+def test_double_precision_matches_direct_formula_for_narrow_posteriors(std, offset):
+    latent_z, mu, logvar = posteriors(std, offset)
+
+    log_dens = gaussian_log_density_matrix(latent_z, mu, logvar, double_precision=True)
+
+    assert log_dens.dtype == torch.float32
+    assert max_relative_error(log_dens, direct_log_density_matrix(latent_z, mu, logvar)) < 1e-4
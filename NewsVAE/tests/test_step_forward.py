@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import pytest
+import torch
+from transformers import RobertaConfig
+from modules.decoder_roberta import VaeDecoderRobertaForCausalLM
+from modules.decoder import LatentToDecoderNewsVAE
+
+LATENT_SIZE = 8
+
+# The ways the latent is injected into the decoder
+LATENT_MODES = {
+    "memory": dict(add_latent_via_memory=True),
+    "embeddings": dict(add_latent_via_embeddings=True),
+    "memory_embeddings": dict(add_latent_via_memory=True, add_latent_via_embeddings=True),
+    "gating": dict(add_latent_via_gating=True),
+    "matrix_influence": dict(add_latent_via_memory=True, add_latent_w_matrix_influence=True),
+}
+
+
+def tiny_decoder(add_latent_via_memory=False, add_latent_via_embeddings=False, add_latent_via_gating=False,
+                 add_latent_w_matrix_influence=False):
+    """
+    A randomly initialised small decoder (and latent projections), built the way DecoderNewsVAE builds them.
+    """
+    config = RobertaConfig(vocab_size=50, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                           intermediate_size=64, max_position_embeddings=40, pad_token_id=1, bos_token_id=0,
+                           eos_token_id=2)
+
+    model = VaeDecoderRobertaForCausalLM(config, add_latent_w_matrix_influence=add_latent_w_matrix_influence,
+                                         latent_size=LATENT_SIZE)
+    latent_to_decoder = LatentToDecoderNewsVAE(add_latent_via_memory=add_latent_via_memory,
+                                               add_latent_via_embeddings=add_latent_via_embeddings,
+                                               add_latent_via_gating=add_latent_via_gating,
+                                               add_latent_w_matrix_influence=add_latent_w_matrix_influence,
+                                               latent_size=LATENT_SIZE, hidden_size=config.hidden_size,
+                                               n_layers=config.num_hidden_layers,
+                                               initializer_range=config.initializer_range)
+
+    return model.eval(), latent_to_decoder.eval()
+
+
+@pytest.mark.parametrize("mode", LATENT_MODES.keys())
+def test_step_forward_matches_teacher_forced_forward(mode):
+    torch.manual_seed(0)
+    model, latent_to_decoder = tiny_decoder(**LATENT_MODES[mode])
+    gating = LATENT_MODES[mode].get("add_latent_via_gating", False)
+    config = model.config
+
+    batch_size, seq_len = 3, 10
+    latent_z = torch.randn(batch_size, LATENT_SIZE)
+    input_ids = torch.cat([torch.zeros(batch_size, 1, dtype=torch.long),
+                           torch.randint(3, config.vocab_size, (batch_size, seq_len - 1))], dim=1)
+
+    with torch.no_grad():
+        latent_to_decoder_output = latent_to_decoder(latent_z)
+
+        full_logits = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                            latent_to_decoder_output=latent_to_decoder_output, gating=gating,
+                            return_cross_entropy=False, return_reconstruction_loss=False,
+                            return_logits=True)["logits"]
+
+        pool_shape = (batch_size, config.num_attention_heads, seq_len,
+                      config.hidden_size // config.num_attention_heads)
+        key_cache = [torch.zeros(pool_shape) for _ in range(config.num_hidden_layers)]
+        value_cache = [torch.zeros(pool_shape) for _ in range(config.num_hidden_layers)]
+        slots = torch.arange(batch_size)
+
+        # Feed the sequence one token at a time, the full forward does not return the logits of the last position
+        for t in range(seq_len - 1):
+            attention_mask = torch.zeros((batch_size, 1, 1, t + 1))
+            positions = torch.full((batch_size,), t, dtype=torch.long)
+
+            step_logits = model.step_forward(input_ids[:, t], positions, attention_mask, key_cache, value_cache,
+                                             slots, latent_to_decoder_output=latent_to_decoder_output,
+                                             gating=gating)
+
+            assert torch.allclose(step_logits, full_logits[:, t], atol=1e-4), \
+                f"step_forward deviates from the forward at position {t}"
@@ -1,4 +1,3 @@
-import torch.distributed as dist
 from torch.cuda.amp import autocast
 import torch.multiprocessing as mp
 from pytorch_lightning import seed_everything
@@ -6,7 +5,7 @@ import multiprocessing
 from constraintoptim.constraint import *
 import utils_train
 import modules.vae as vae
-from loss_and_optimisation import ParameterScheduler, LossTermManager
+from loss_and_optimisation import ParameterScheduler, LossTermManager, PosteriorStatsAccumulator
 import pickle
 import os
 
@@ -144,10 +143,14 @@ def train(device_rank, config, run_name):
     print("**** DEVICE: ", device_rank)
 
     # Device
-    device_name = utils_train.set_device(device_rank)
+    n_processes = config.n_gpus if config.device_type == "cuda" else config.n_cpu_processes
+    device_name = utils_train.set_device(device_rank, device_type=config.device_type,
+                                         n_threads=config.n_threads_per_process, world_size=n_processes)
 
     # Determine world size and whether this device is world master
-    world_master, world_size = utils_train.get_world_specs(config.n_gpus, config.n_nodes, device_name)
+    world_master, world_size = utils_train.get_world_specs(config.n_gpus, config.n_nodes, device_name,
+                                                           n_cpu_processes=config.n_cpu_processes,
+                                                           device_rank=device_rank)
 
     # Determine the maximum number of steps for this device
     global_max_steps, global_max_grad_steps = utils_train.determine_global_max_steps(config.max_global_train_steps,
@@ -158,8 +161,7 @@ def train(device_rank, config, run_name):
     if config.ddp:
         if world_master: print("Init process group...")
         if world_master: print(f"--> CPU count {multiprocessing.cpu_count()}")
-        dist.init_process_group(backend='nccl', init_method='env://',
-                                world_size=int(config.n_gpus * config.n_nodes), rank=device_rank)
+        utils_train.init_process_group(device_rank, world_size, device_type=config.device_type)
 
     # Seed everything
     seed_everything(config.seed)
@@ -212,8 +214,10 @@ def train(device_rank, config, run_name):
     if config.ddp:
         # Wrap both the model and constraints etc in a loss_term_manager nn.Module as suggested here:
         # https://discuss.pytorch.org/t/multiple-modules-with-distributed-data-parallel/115621
+        # On CPU (gloo) DDP should not get device ids
+        device_ids = [device_rank] if "cuda" in device_name else None
         loss_term_manager = torch.nn.parallel.DistributedDataParallel(loss_term_manager,
-                                                                      device_ids=[device_rank],
+                                                                      device_ids=device_ids,
                                                                       find_unused_parameters=False) # not needed to check
         print(f"-> Turned on DDP for device rank {device_rank}")
 
@@ -250,6 +254,23 @@ def train(device_rank, config, run_name):
                 samplers[phase].set_epoch(epoch)  # needed to explicitly shuffle
 
             max_steps = max_train_steps_epoch_per_rank if phase == 'train' else max_valid_steps_epoch_per_rank
+
+            # Generate the samples for the log p(x_gen) evaluation once for this validation epoch
+            if phase == 'validation' and config.eval_iw_ll_x_gen and not config.decoder_only:
+                manager_module = loss_term_manager.module if config.ddp else loss_term_manager
+                if manager_module.x_gen_pool is not None:
+                    manager_module.vae_model.eval()
+                    # One pool batch per validation step (the loop below breaks after step max_steps)
+                    n_valid_steps = min(len(data_loaders[phase]), max_steps + 1)
+                    manager_module.x_gen_pool.refresh(manager_module.vae_model, n_batches=n_valid_steps,
+                                                      device_name=device_name,
+                                                      background=config.x_gen_pool_background)
+
+            # Exact split level posterior statistics (active units, dim KL, ...), accumulated in the validation steps
+            if phase == 'validation' and not config.decoder_only:
+                manager_module = loss_term_manager.module if config.ddp else loss_term_manager
+                manager_module.posterior_stats = PosteriorStatsAccumulator()
+
             atts_to_latent, masks, = [], []
             # latents = []
 
@@ -333,6 +354,24 @@ def train(device_rank, config, run_name):
             # END OF TRAIN / VALID PHASE
             # ----------------------------------------------------------------------------------------------------
 
+            # Stop generating samples for log p(x_gen), the model goes back to training
+            if phase == 'validation' and config.eval_iw_ll_x_gen and not config.decoder_only:
+                manager_module = loss_term_manager.module if config.ddp else loss_term_manager
+                if manager_module.x_gen_pool is not None:
+                    manager_module.x_gen_pool.stop()
+
+            # SPLIT LEVEL POSTERIOR STATISTICS (merged over the ranks)
+            if phase == 'validation' and not config.decoder_only:
+                manager_module = loss_term_manager.module if config.ddp else loss_term_manager
+                if config.ddp:
+                    manager_module.posterior_stats.all_reduce(latent_dim=config.latent_size, device_name=device_name)
+                if world_master and manager_module.posterior_stats.n > 1:
+                    split_stats = manager_module.posterior_stats.results()
+                    for stat_name in ["active_units", "kl", "mean_z_mu", "std_z_mu", "mean_z_std", "std_z_std",
+                                      "mean_x_mu", "std_x_mu", "mean_x_std", "std_x_std"]:
+                        stats[epoch][phase]["split_" + stat_name] = [split_stats[stat_name]]
+                manager_module.posterior_stats = None
+
             # BEST MODEL CHECKPOINT
             if phase == 'validation' and world_master:
                 val_epoch_stats = stats[epoch]["validation"]
@@ -397,12 +436,13 @@ def main(config):
 
     # DDP
     if config.ddp:
-        print(f"*** Using DDP, spawing {config.n_gpus * config.n_nodes} processes")
+        n_processes = config.n_gpus if config.device_type == "cuda" else config.n_cpu_processes
+        print(f"*** Using DDP ({config.device_type}), spawing {n_processes * config.n_nodes} processes")
         utils_train.set_ddp_environment_vars()
-        mp.spawn(train, nprocs=int(config.n_gpus * config.n_nodes), args=(config, run_name))
+        mp.spawn(train, nprocs=int(n_processes * config.n_nodes), args=(config, run_name))
 
     # Single GPU
-    elif not config.ddp and config.n_gpus > 0:
+    elif not config.ddp and config.n_gpus > 0 and config.device_type == "cuda":
         print(f"*** Not using DDP, only using device: {torch.cuda.current_device()}")
         train(torch.cuda.current_device(), config, run_name)
         # train(2, config, run_name)
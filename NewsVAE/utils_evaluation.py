@@ -1,9 +1,14 @@
 import torch
-from utils_train import transfer_batch_to_device, load_from_checkpoint, cat_pad_uneven
+from utils_train import transfer_batch_to_device, load_from_checkpoint, cat_pad_uneven, restore_original_order, \
+    all_gather_results
+from generation_engine import ContinuousBatchingGenerator
+from loss_and_optimisation import make_batch_from_model_samples, posterior_batch_stats, PosteriorStatsAccumulator
+from utils_gaussian import gaussian_log_density_matrix, logsumexp_marginal_densities, posterior_prior_log_probs, \
+    gaussian_log_prob, standard_normal_log_prob, gaussian_kl_standard_normal
+import json
+from utils_storage import cached_result
 import os
-import copy
 import numpy as np
-from scipy import stats
 import sys
 import pickle
 
@@ -16,8 +21,29 @@ else:
 # PRIOR POSTERIOR PERFORMANCE DROP
 # ----------------------------------------------------------------------------------------------------
 
+@cached_result(version=2, key_args=("max_batches", "N_bins"))
 def acc_drop_over_relative_seq_len(data_loader, model=None, path=None, device="cuda:0",
                                    max_batches=-1, N_bins=30):
+    """
+    Drop in (teacher-forced) exact match accuracy when decoding from a prior sample instead of a posterior
+    sample, binned over the relative position in the sequence.
+
+    Per batch, the posterior and prior latents are stacked into one [posterior; prior] batch that goes through
+    the decoder in a single teacher-forced pass. Everything stays on the device until the end, the binning
+    matches scipy.stats.binned_statistic(..., statistic="mean", bins=N_bins).
+
+    Args:
+        data_loader: DataLoader
+        model: NewsVAE
+        path: str
+            Checkpoint to load the model from (if no model is given)
+        device: str
+        max_batches: int
+        N_bins: int
+    Returns:
+        return_dict: Dict
+            bin_means, bin_edges (np.ndarray) and acc_drops, prior_accs, posterior_accs (Tensor, masked)
+    """
     N = max_batches if max_batches > 0 else len(data_loader)
     assert not (model is None and path is None), "Either supply model or a path. Aborting."
 
@@ -31,47 +57,37 @@ def acc_drop_over_relative_seq_len(data_loader, model=None, path=None, device="c
     for batch_i, batch in enumerate(data_loader):
         print("Batch {:3d}/{:3d}".format(batch_i + 1, N), end="\r")
 
-        # save mask
-        labels = batch["input_ids"][:, 1:].contiguous()  # skip <s> token
-        label_mask = (labels != 1).float()  # pad token is int 1
-        masks.append(label_mask)
-
         # transfer batch to device
         batch = transfer_batch_to_device(batch, device)
+        input_ids, attention_mask = batch["input_ids"], batch["attention_mask"]
+        batch_size = input_ids.shape[0]
 
-        # save acc stats of experiments for batch
-        for decode_prior_samples in [True, False]:
-            with torch.no_grad():
-                preds = model(input_ids=batch["input_ids"],
-                              attention_mask=batch["attention_mask"],
-
-                              auto_regressive=False,
-                              max_seq_len=64,
-
-                              return_exact_match=True,
-                              return_cross_entropy=False,
-                              return_reconstruction_loss=False,
-
-                              return_posterior_stats=False,
-
-                              reduce_seq_dim_ce="mean",
-                              reduce_seq_dim_exact_match="none",
-                              reduce_batch_dim_exact_match="none",
-                              reduce_batch_dim_ce="none",
-
-                              nucleus_sampling=False,
-                              top_k=0,
-                              top_p=1.0,
-
-                              decode_sample_from_prior=decode_prior_samples,
-                              n_prior_samples=batch["input_ids"].shape[0],
+        # save mask
+        labels = input_ids[:, 1:]  # skip <s> token
+        masks.append((labels != 1).float())  # pad token is int 1
 
-                              device_name=device)
+        with torch.no_grad():
+            # [batch, latent_size] posterior sample, [batch, latent_size] prior sample
+            post_z = model.encoder.encode(input_ids, attention_mask, n_samples=1,
+                                          return_log_q_z_x=False, return_log_p_z=False,
+                                          return_log_q_z=False, return_embeddings=False)["latent_z"]
+            post_z = post_z.reshape(batch_size, -1)
+            prior_z = model.sample_from_prior(latent_size=model.decoder.latent_size, n_samples=batch_size,
+                                              device_name=device)
+
+            # One teacher-forced pass over [posterior; prior]
+            input_ids_2, attention_mask_2 = input_ids.repeat(2, 1), attention_mask.repeat(2, 1)
+            dec_out = model.decoder(torch.cat([post_z, prior_z], dim=0), input_ids_2, attention_mask_2,
+                                    labels=input_ids_2,
+                                    return_exact_match=True,
+                                    return_cross_entropy=False,
+                                    return_reconstruction_loss=False,
+                                    reduce_seq_dim_exact_match="none",
+                                    reduce_batch_dim_exact_match="none")
 
-            if decode_prior_samples is True:
-                prior_accs.append(preds["exact_match"].cpu())
-            else:
-                post_accs.append(preds["exact_match"].cpu())
+            post_acc, prior_acc = dec_out["exact_match"].float().split(batch_size, dim=0)
+            post_accs.append(post_acc)
+            prior_accs.append(prior_acc)
 
         if (batch_i + 1) == max_batches:
             break
@@ -82,7 +98,7 @@ def acc_drop_over_relative_seq_len(data_loader, model=None, path=None, device="c
     seq_lens = masks.sum(dim=1)
 
     n_samples, max_len = prior_accs.shape
-    positions = torch.arange(1, max_len + 1).unsqueeze(0).repeat(n_samples, 1)
+    positions = torch.arange(1, max_len + 1, device=prior_accs.device).unsqueeze(0).expand(n_samples, -1)
     relative_positions = positions / seq_lens.unsqueeze(1)
 
     prior_accs_masked = torch.masked_select(prior_accs, masks == 1.0)
@@ -90,52 +106,112 @@ def acc_drop_over_relative_seq_len(data_loader, model=None, path=None, device="c
     acc_drops = post_accs_masked - prior_accs_masked
     relative_positions_masked = torch.masked_select(relative_positions, masks == 1.0)
 
-    bin_means, bin_edges, bin_ids = stats.binned_statistic(relative_positions_masked.tolist(), acc_drops.tolist(),
-                                                           statistic='mean', bins=N_bins)
+    bin_means, bin_edges = binned_mean(relative_positions_masked, acc_drops, n_bins=N_bins)
 
     return_dict = dict(
-        bin_means=bin_means,
-        bin_edges=bin_edges,
-        acc_drops=acc_drops,
-        prior_accs=prior_accs_masked,
-        posterior_accs=post_accs_masked
+        bin_means=bin_means.cpu().numpy(),
+        bin_edges=bin_edges.cpu().numpy(),
+        acc_drops=acc_drops.cpu(),
+        prior_accs=prior_accs_masked.cpu(),
+        posterior_accs=post_accs_masked.cpu()
     )
 
     return return_dict
 
 
-# ----------------------------------------------------------------------------------------------------
-# IMPORTANCE WEIGHTED LOG LIKELIHOOD log p (x)
-# ----------------------------------------------------------------------------------------------------
+def binned_mean(x, values, n_bins=30):
+    """
+    Mean of values in n_bins equal width bins over the range of x, on the device of x. Same bins and
+    result as scipy.stats.binned_statistic(x, values, statistic="mean", bins=n_bins): the last bin includes
+    its right edge and empty bins are NaN.
+
+    Args:
+        x: Tensor [N]
+        values: Tensor [N]
+        n_bins: int
+    Returns:
+        bin_means: Tensor [n_bins]
+        bin_edges: Tensor [n_bins + 1]
+    """
+    x, values = x.double(), values.double()
 
-def make_batch_from_model_samples(predictions, eos_token_id=2, pad_token_id=1, bos_token_id=0):
-    # Add a <s> token to the predictions
-    bos = torch.zeros_like(predictions)[:, 0].unsqueeze(1)
-    predictions = torch.cat([bos, predictions], dim=1)
+    lo, hi = x.min().item(), x.max().item()
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
 
-    # Make a tensor with position indices per row
-    ind = torch.arange(predictions.shape[1]).repeat(predictions.shape[0], 1)
+    bin_edges = torch.linspace(lo, hi, n_bins + 1, dtype=torch.float64, device=x.device)
 
-    # Check where the eos_token is in the predictions, if not there set to max_len
-    lens = torch.tensor(
-        [a.index(eos_token_id) if eos_token_id in a else len(a) for a in predictions.tolist()]).unsqueeze(1)
+    # Bin i holds edges[i] <= x < edges[i + 1], values on the right most edge go in the last bin
+    bin_ids = torch.bucketize(x, bin_edges, right=True) - 1
+    bin_ids = bin_ids.clamp(max=n_bins - 1)
 
-    # Mask everything after the eos_token_id (set to 0.0)
-    # so where < lens, should be true, all after should be 0.0
-    mask = (ind <= lens)
+    sums = torch.bincount(bin_ids, weights=values, minlength=n_bins)
+    counts = torch.bincount(bin_ids, minlength=n_bins).double()
 
-    # Pad the predictions (setting all tokens after </s> to <pad>)
-    predictions[~mask] = pad_token_id
+    bin_means = sums / counts  # 0 / 0 = NaN for empty bins
 
-    return predictions, mask, lens.flatten()
+    return bin_means, bin_edges
 
 
-def iw_log_p_x(vae_model, batch, n_samples=600, n_chunks=3, verbose=False):
-    batch_size = batch["input_ids"].shape[0]
+# ----------------------------------------------------------------------------------------------------
+# IMPORTANCE WEIGHTED LOG LIKELIHOOD log p (x)
+# ----------------------------------------------------------------------------------------------------
+
+def iw_log_p_x(vae_model, batch, n_samples=600, n_chunks=3, verbose=False, max_tokens=None, sampling="iid",
+               duplicates="none"):
+    """
+    Importance weighted estimate of log p(x) with <n_samples> posterior samples per sentence.
+
+    The (sentence, posterior sample) pairs of the whole batch are flattened and packed into decoder
+    calls of at most <max_tokens> tokens (rows x padded length), where every sentence is trimmed to its
+    own length and sentences of similar length are packed together. The rows of a sentence are expanded
+    views of its input ids, so nothing is repeated or copied per sample.
+
+    Args:
+        vae_model: NewsVAE
+        batch: Dict[str, Tensor]
+            With input_ids and attention_mask [batch, seq_len] (right padded)
+        n_samples: int
+            Number of importance samples per sentence
+        n_chunks: int
+            Only used to set the default token budget: ceil(n_samples / n_chunks) * seq_len,
+            which is the largest decoder batch of the sentence-by-sentence evaluation
+        verbose: bool
+        max_tokens: int
+            Maximum number of tokens (rows x padded length) per decoder call
+        sampling: str
+            Posterior sampling scheme: iid, antithetic or sobol (see EncoderNewsVAE.reparameterize)
+        duplicates: str
+            What to do with sentences that occur more than once in the batch:
+                - none: evaluate every occurrence on its own
+                - reuse: evaluate a sentence once, all occurrences get that estimate
+                - pool: evaluate every occurrence, all occurrences get the estimate of the pooled samples
+    Returns:
+        likelihood: Tensor [batch]
+            Importance weighted log p(x)
+    """
+    assert duplicates in ["none", "reuse", "pool"], f"Unknown duplicates mode: {duplicates}. Aborting."
+
+    input_ids, attention_mask = batch["input_ids"], batch["attention_mask"]
+    batch_size, seq_len = input_ids.shape
+
+    if duplicates != "none":
+        keys = sequence_keys(input_ids, attention_mask)
+
+        if duplicates == "reuse":
+            unique_rows, inverse = deduplicate_sequences(keys)
+            if len(unique_rows) < batch_size:
+                likelihood = iw_log_p_x(vae_model, select_rows(batch, unique_rows), n_samples=n_samples,
+                                        n_chunks=n_chunks, verbose=verbose, max_tokens=max_tokens, sampling=sampling)
+                return likelihood[inverse.to(likelihood.device)]
+
+    if max_tokens is None:
+        max_tokens = int(np.ceil(n_samples / n_chunks)) * seq_len
 
     # Encode these input ids and sample <n_samples> for each x
-    enc_out = vae_model.encoder.encode(batch["input_ids"], batch["attention_mask"],
+    enc_out = vae_model.encoder.encode(input_ids, attention_mask,
                                        n_samples=n_samples,
+                                       sampling=sampling,
                                        return_log_q_z_x=True,
                                        return_log_q_z=False,
                                        return_log_p_z=True,
@@ -145,45 +221,453 @@ def iw_log_p_x(vae_model, batch, n_samples=600, n_chunks=3, verbose=False):
     # [batch, n_samples, latent_dim], [batch, n_samples], [batch, n_samples]
     post_samples, post_log_p_z, post_log_q_z_x = enc_out["latent_z"], enc_out["log_p_z"], enc_out["log_q_z_x"]
 
-    # Now we need to loop again because our batch size was multiplied by n_samples
-    post_log_p_x_z = []
-
-    # For all samples x in batch
-    for sample_i in range(batch_size):
-        # [n_samples, latent_dim]
-        post_samples_i = post_samples[sample_i, :, :]
-
-        # list of [samples_per_chunk, latent_dim]
-        post_samples_i_chunked = list(torch.chunk(post_samples_i, n_chunks, dim=0))
-
-        for chunk_i, post_z in enumerate(post_samples_i_chunked):
-            if verbose is True:
-                print(f"sample i: {sample_i:3d} chunk i: {chunk_i:3d}", end="\r")
-            chunk_size = post_z.shape[0]
-            inputs_i = batch["input_ids"][sample_i, :].unsqueeze(0).repeat(chunk_size, 1)
-            att_m_i = batch["attention_mask"][sample_i, :].unsqueeze(0).repeat(chunk_size, 1)
-
-            dec_out = vae_model.decoder(post_z, inputs_i, att_m_i,
-                                        labels=copy.deepcopy(inputs_i),
-                                        return_reconstruction_loss=False,
-                                        reduce_seq_dim_ce="sum",
-                                        return_cross_entropy=True,
-                                        reduce_batch_dim_ce="None")
-            ll = - dec_out["cross_entropy"]
-            post_log_p_x_z.append(ll)
-
-    # From one big tensor of shape [n_samples * batch_size] to [batch_size, n_samples]
-    post_log_p_x_z = torch.cat(post_log_p_x_z).reshape(batch_size, n_samples)
+    # [batch, n_samples]
+    post_log_p_x_z = packed_log_p_x_z(vae_model, input_ids, attention_mask, post_samples,
+                                      max_tokens=max_tokens, verbose=verbose)
+
     iw_frac = post_log_p_x_z + post_log_p_z - post_log_q_z_x
 
     # Reduce the sample dimension with logsumexp, leaves shape [batch_size]
     likelihood = torch.logsumexp(iw_frac, dim=-1) - np.log(n_samples)
 
+    if duplicates == "pool":
+        likelihood = pool_duplicates(likelihood, keys)
+
     return likelihood
 
 
+def packed_log_p_x_z(vae_model, input_ids, attention_mask, post_samples, max_tokens, verbose=False):
+    """
+    Evaluate log p(x|z) for every (sentence, posterior sample) pair, packed into decoder calls of at most
+    <max_tokens> tokens (see iw_log_p_x).
+
+    Args:
+        vae_model: NewsVAE
+        input_ids: Tensor [batch, seq_len]
+        attention_mask: Tensor [batch, seq_len]
+        post_samples: Tensor [batch, n_samples, latent_dim]
+        max_tokens: int
+        verbose: bool
+    Returns:
+        post_log_p_x_z: Tensor [batch, n_samples]
+    """
+    batch_size, n_samples, _ = post_samples.shape
+
+    post_log_p_x_z = torch.zeros((batch_size, n_samples), dtype=post_samples.dtype, device=post_samples.device)
+
+    sent_lens = attention_mask.sum(dim=1).tolist()
+
+    # Pack (sentence, sample range) segments, shortest sentences first, so that the padded length
+    # of a pack is the length of its last sentence
+    segments, n_rows, n_packs = [], 0, 0
+    for sample_i in sorted(range(batch_size), key=lambda i: sent_lens[i]):
+        sent_len = int(sent_lens[sample_i])
+        start = 0
+
+        while start < n_samples:
+            # At least one row per decoder call, even if a single sentence exceeds the budget
+            capacity = max(max_tokens // sent_len, 1) - n_rows
+
+            if capacity <= 0:
+                _packed_log_p_x_z(vae_model, input_ids, attention_mask, post_samples, segments,
+                                  post_log_p_x_z)
+                n_packs += 1
+                if verbose is True:
+                    print(f"decoder call: {n_packs:4d} rows: {n_rows:5d}", end="\r")
+                segments, n_rows = [], 0
+                continue
+
+            end = min(start + capacity, n_samples)
+            segments.append((sample_i, start, end, sent_len))
+            n_rows += end - start
+            start = end
+
+    if len(segments) > 0:
+        _packed_log_p_x_z(vae_model, input_ids, attention_mask, post_samples, segments, post_log_p_x_z)
+
+    return post_log_p_x_z
+
+
+def _packed_log_p_x_z(vae_model, input_ids, attention_mask, post_samples, segments, post_log_p_x_z):
+    """
+    Evaluate log p(x|z) for a pack of (sentence, sample range) segments in one decoder call and write
+    the results into post_log_p_x_z [batch, n_samples].
+
+    Args:
+        segments: List[Tuple[int, int, int, int]]
+            (sentence index, first sample, last sample (exclusive), sentence length), sorted by length
+    """
+    # Sorted by length, so the last segment determines the padded length
+    pack_len = segments[-1][3]
+
+    inputs, masks, latents = [], [], []
+    for sample_i, start, end, _ in segments:
+        inputs.append(input_ids[sample_i, :pack_len].expand(end - start, pack_len))
+        masks.append(attention_mask[sample_i, :pack_len].expand(end - start, pack_len))
+        latents.append(post_samples[sample_i, start:end])
+
+    # A single segment stays a view
+    if len(segments) > 1:
+        inputs, masks, latents = torch.cat(inputs), torch.cat(masks), torch.cat(latents)
+    else:
+        inputs, masks, latents = inputs[0], masks[0], latents[0]
+
+    # labels are not modified by the decoder, so the inputs can be passed as labels
+    dec_out = vae_model.decoder(latents, inputs, masks,
+                                labels=inputs,
+                                return_reconstruction_loss=False,
+                                reduce_seq_dim_ce="sum",
+                                return_cross_entropy=True,
+                                reduce_batch_dim_ce="None")
+    ll = - dec_out["cross_entropy"]
+
+    row = 0
+    for sample_i, start, end, _ in segments:
+        post_log_p_x_z[sample_i, start:end] = ll[row:row + end - start]
+        row += end - start
+
+
+class OnlineIWEstimate:
+    def __init__(self, batch_size, device_name="cuda:0"):
+        """
+        Streaming importance weighted estimate of log p(x) per sentence. Keeps a running max and the
+        sums of w and w^2 relative to that max, so that log mean(w) = log p(x), the effective sample
+        size and the standard error can be computed at any time, without keeping the log weights.
+
+        Args:
+            batch_size: int
+                Number of sentences
+            device_name: str
+        """
+        self.running_max = torch.full((batch_size,), -float("inf"), device=device_name)
+        self.sum_w = torch.zeros(batch_size, device=device_name)
+        self.sum_w_sq = torch.zeros(batch_size, device=device_name)
+        self.n_samples = torch.zeros(batch_size, dtype=torch.long, device=device_name)
+
+    def update(self, log_w, rows=None):
+        """
+        Add log importance weights log p(x|z) + log p(z) - log q(z|x).
+
+        Args:
+            log_w: Tensor [n_rows, n_new_samples]
+            rows: Tensor [n_rows]
+                The sentences the log weights belong to (default: all)
+        """
+        if rows is None:
+            rows = torch.arange(log_w.shape[0], device=log_w.device)
+
+        old_max = self.running_max[rows]
+        new_max = torch.max(old_max, log_w.max(dim=-1)[0])
+
+        # Rescale the running sums to the new max (exp(-inf) = 0 for the first update)
+        rescale = torch.exp(old_max - new_max)
+        shifted = torch.exp(log_w - new_max.unsqueeze(1))
+
+        self.sum_w[rows] = self.sum_w[rows] * rescale + shifted.sum(dim=-1)
+        self.sum_w_sq[rows] = self.sum_w_sq[rows] * rescale ** 2 + (shifted ** 2).sum(dim=-1)
+        self.running_max[rows] = new_max
+        self.n_samples[rows] += log_w.shape[1]
+
+    def log_p_x(self):
+        """
+        Returns:
+            log_p_x: Tensor [batch], log mean(w)
+        """
+        return self.running_max + torch.log(self.sum_w) - torch.log(self.n_samples.float())
+
+    def effective_sample_size(self):
+        """
+        Returns:
+            ess: Tensor [batch], (sum w)^2 / sum w^2
+        """
+        return self.sum_w ** 2 / self.sum_w_sq
+
+    def std_error(self):
+        """
+        Standard error of log p(x) (delta method): the relative variance of mean(w) is
+        var(w) / (n mean(w)^2) = 1 / ESS - 1 / n.
+
+        Returns:
+            std_error: Tensor [batch]
+        """
+        relative_var = 1.0 / self.effective_sample_size() - 1.0 / self.n_samples.float()
+        return torch.sqrt(relative_var.clamp(min=0.0))
+
+
+def iw_log_p_x_adaptive(vae_model, batch, tolerance=0.05, samples_per_round=100, min_samples=100,
+                        max_samples=600, max_tokens=None, verbose=False, sampling="iid"):
+    """
+    Importance weighted estimate of log p(x) with an adaptive number of samples per sentence: samples are
+    drawn in rounds of <samples_per_round> and a sentence stops drawing samples as soon as the standard
+    error of its estimate is below <tolerance> (nats) after at least <min_samples> samples, or when it
+    reaches <max_samples>. Easy sentences finish early, the budget goes to the hard ones.
+
+    Args:
+        vae_model: NewsVAE
+        batch: Dict[str, Tensor]
+            With input_ids and attention_mask [batch, seq_len] (right padded)
+        tolerance: float
+            Standard error of log p(x) at which a sentence is considered converged
+        samples_per_round: int
+        min_samples: int
+        max_samples: int
+        max_tokens: int
+            Maximum number of tokens per decoder call, default: samples_per_round * seq_len
+        verbose: bool
+        sampling: str
+            Posterior sampling scheme per round: iid, antithetic or sobol
+    Returns:
+        results: Dict[str, Tensor]
+            log_p_x [batch], std_error [batch], ess [batch], n_samples [batch]
+    """
+    input_ids, attention_mask = batch["input_ids"], batch["attention_mask"]
+    batch_size, seq_len = input_ids.shape
+
+    if max_tokens is None:
+        max_tokens = samples_per_round * seq_len
+
+    # Encode once, sample every round
+    enc_out = vae_model.encoder(input_ids, attention_mask, return_embeddings=False)
+    mu, logvar = enc_out["mu"], enc_out["logvar"]
+
+    estimate = OnlineIWEstimate(batch_size, device_name=input_ids.device)
+    active = torch.arange(batch_size, device=input_ids.device)
+
+    round_i = 0
+    while len(active) > 0:
+        n_new = min(samples_per_round, max_samples - int(estimate.n_samples[active].max().item()))
+
+        # [n_active, n_new, latent_dim]
+        post_samples = vae_model.encoder.reparameterize(mu[active], logvar[active], n_samples=n_new,
+                                                        sampling=sampling)
+        post_log_q_z_x, post_log_p_z = posterior_prior_log_probs(post_samples, mu[active], logvar[active])
+        post_log_p_x_z = packed_log_p_x_z(vae_model, input_ids[active], attention_mask[active], post_samples,
+                                          max_tokens=max_tokens)
+
+        estimate.update(post_log_p_x_z + post_log_p_z - post_log_q_z_x, rows=active)
+
+        n_samples = estimate.n_samples[active]
+        converged = (n_samples >= min_samples) & (estimate.std_error()[active] <= tolerance)
+        active = active[~(converged | (n_samples >= max_samples))]
+
+        round_i += 1
+        if verbose is True:
+            print(f"round: {round_i:3d} active sentences: {len(active):4d}", end="\r")
+
+    results = {
+        "log_p_x": estimate.log_p_x(),
+        "std_error": estimate.std_error(),
+        "ess": estimate.effective_sample_size(),
+        "n_samples": estimate.n_samples
+    }
+
+    return results
+
+
+def benchmark_iw_sampling(vae_model, batch, sampling_schemes=("iid", "antithetic", "sobol"),
+                          sample_sizes=(32, 64, 128, 256, 512, 600), reference_n_samples=600, n_repeats=10,
+                          max_tokens=None, verbose=False):
+    """
+    Compare posterior sampling schemes for the importance weighted log p(x): the standard error of the
+    estimate is measured as the standard deviation of <n_repeats> independent estimates per sentence
+    (averaged over the sentences of the batch), for every scheme and number of samples.
+
+    Args:
+        vae_model: NewsVAE
+        batch: Dict[str, Tensor]
+        sampling_schemes: Tuple[str]
+        sample_sizes: Tuple[int]
+        reference_n_samples: int
+            The number of iid samples that defines the standard error to reach
+        n_repeats: int
+        max_tokens: int
+        verbose: bool
+    Returns:
+        results: Dict
+            std_error: Dict[str, Dict[int, float]], per scheme and number of samples
+            mean_log_p_x: Dict[str, Dict[int, float]], per scheme and number of samples
+            reference_std_error: float, of iid sampling with reference_n_samples
+            samples_needed: Dict[str, int], the smallest of sample_sizes that reaches the reference standard
+                error, per scheme (None if none of them does)
+    """
+    assert "iid" in sampling_schemes, "The iid scheme is needed as a reference. Aborting."
+
+    std_error, mean_log_p_x = {}, {}
+
+    for sampling in sampling_schemes:
+        std_error[sampling], mean_log_p_x[sampling] = {}, {}
+
+        sizes = sorted(set(sample_sizes) | {reference_n_samples}) if sampling == "iid" else sorted(sample_sizes)
+        for n_samples in sizes:
+            if verbose:
+                print(f"sampling: {sampling:10s} n_samples: {n_samples:4d}")
+
+            # [n_repeats, batch]
+            estimates = torch.stack([iw_log_p_x(vae_model, batch, n_samples=n_samples, max_tokens=max_tokens,
+                                                sampling=sampling) for _ in range(n_repeats)])
+
+            std_error[sampling][n_samples] = estimates.std(dim=0).mean().item()
+            mean_log_p_x[sampling][n_samples] = estimates.mean().item()
+
+    reference_std_error, samples_needed = iw_samples_needed(std_error, reference_n_samples)
+
+    results = {
+        "std_error": std_error,
+        "mean_log_p_x": mean_log_p_x,
+        "reference_std_error": reference_std_error,
+        "samples_needed": samples_needed
+    }
+
+    return results
+
+
+def iw_samples_needed(std_error, reference_n_samples=600):
+    """
+    The smallest number of samples with which each sampling scheme reaches the standard error of iid sampling
+    with reference_n_samples.
+
+    Args:
+        std_error: Dict[str, Dict[int, float]]
+            Standard error per scheme and number of samples (as returned by benchmark_iw_sampling)
+        reference_n_samples: int
+    Returns:
+        reference_std_error: float
+        samples_needed: Dict[str, int]
+            per scheme, None if none of its numbers of samples reaches the reference
+    """
+    reference_std_error = std_error["iid"][reference_n_samples]
+
+    samples_needed = {}
+    for sampling, errors in std_error.items():
+        reached = [n for n in sorted(errors.keys()) if errors[n] <= reference_std_error]
+        samples_needed[sampling] = reached[0] if len(reached) > 0 else None
+
+    return reference_std_error, samples_needed
+
+
+# ----------------------------------------------------------------------------------------------------
+# DUPLICATE SENTENCES
+# ----------------------------------------------------------------------------------------------------
+
+def sequence_keys(input_ids, attention_mask):
+    """
+    Hashable key (the bytes of the unpadded token ids) of every sequence in a batch.
+
+    Args:
+        input_ids: Tensor [batch, seq_len]
+        attention_mask: Tensor [batch, seq_len]
+    Returns:
+        keys: List[bytes]
+    """
+    input_ids = input_ids.cpu().numpy()
+    lens = attention_mask.sum(dim=1).cpu().numpy()
+
+    return [input_ids[i, :lens[i]].tobytes() for i in range(len(input_ids))]
+
+
+def deduplicate_sequences(keys):
+    """
+    Find the unique sequences in a list of sequence keys.
+
+    Args:
+        keys: List[bytes]
+    Returns:
+        unique_rows: Tensor [n_unique]
+            Row of the first occurrence of every unique sequence
+        inverse: Tensor [n]
+            Which unique sequence every row is (index in unique_rows)
+    """
+    unique_rows, inverse, groups = [], [], {}
+    for row, key in enumerate(keys):
+        if key not in groups:
+            groups[key] = len(unique_rows)
+            unique_rows.append(row)
+        inverse.append(groups[key])
+
+    return torch.tensor(unique_rows, dtype=torch.long), torch.tensor(inverse, dtype=torch.long)
+
+
+def select_rows(batch, rows):
+    """
+    Take rows of a (right padded) batch and trim the padding to the longest selected sequence.
+    """
+    rows = rows.to(batch["input_ids"].device)
+    max_len = int(batch["attention_mask"][rows].sum(dim=1).max())
+
+    return {k: v[rows][:, :max_len] if v.dim() == 2 else v[rows] for k, v in batch.items()}
+
+
+def pool_duplicates(log_p_x, keys):
+    """
+    Combine the importance weighted estimates of the occurrences of the same sequence, as if they were one
+    estimate with all their samples: the log of the mean of the (per occurrence) likelihood estimates.
+    This is exact when every occurrence has the same number of samples.
+
+    Args:
+        log_p_x: Tensor [n]
+        keys: List[bytes]
+    Returns:
+        pooled_log_p_x: Tensor [n]
+    """
+    unique_rows, inverse = deduplicate_sequences(keys)
+    if len(unique_rows) == len(keys):
+        return log_p_x
+
+    inverse = inverse.numpy()
+    counts = np.bincount(inverse)
+
+    # logsumexp per group
+    pooled = np.full(len(unique_rows), -np.inf)
+    np.logaddexp.at(pooled, inverse, log_p_x.detach().cpu().double().numpy())
+    pooled = pooled - np.log(counts)
+
+    return torch.from_numpy(pooled[inverse]).to(log_p_x)
+
+
+def iw_log_p_x_known(vae_model, batch, known, **iw_kwargs):
+    """
+    Importance weighted log p(x) of a batch, where only sequences that are not in <known> (from earlier
+    batches, or earlier in this batch) are evaluated. The new estimates are added to <known>.
+
+    Args:
+        vae_model: NewsVAE
+        batch: Dict[str, Tensor]
+        known: Dict[bytes, float]
+            Estimates of sequences evaluated so far, by sequence key
+        iw_kwargs:
+            Arguments for iw_log_p_x
+    Returns:
+        log_p_x: Tensor [batch] (on CPU)
+    """
+    keys = sequence_keys(batch["input_ids"], batch["attention_mask"])
+
+    unique_rows, _ = deduplicate_sequences(keys)
+    new_rows = torch.tensor([row for row in unique_rows.tolist() if keys[row] not in known], dtype=torch.long)
+
+    if len(new_rows) > 0:
+        new_log_p_x = iw_log_p_x(vae_model, select_rows(batch, new_rows), **iw_kwargs).cpu()
+        for row, log_p_x in zip(new_rows.tolist(), new_log_p_x.tolist()):
+            known[keys[row]] = log_p_x
+
+    return torch.tensor([known[key] for key in keys])
+
+
+def report_duplicates(keys, name=""):
+    """
+    Print (and return) the fraction of sequences that are duplicates of another sequence.
+    """
+    n_unique = len(set(keys))
+    dedup_ratio = 1.0 - n_unique / max(1, len(keys))
+
+    print(f"{name} {n_unique} unique of {len(keys)} sequences (dedup ratio: {dedup_ratio:.3f})")
+
+    return dedup_ratio
+
+
+@cached_result(version=1, key_args=("n_batches", "batch_size", "n_samples", "max_seq_len_gen", "duplicates"))
 def iw_log_p_x_generated(model=None, path=None, n_batches=10, batch_size=64, n_samples=600,
-                         n_chunks=3, verbose=False, ddp=False, device_name="cuda:0", max_seq_len_gen=64):
+                         n_chunks=3, verbose=False, ddp=False, device_name="cuda:0", max_seq_len_gen=64,
+                         max_tokens=None, duplicates="reuse"):
 
     if model is None and path is None:
         print("Either provide a model, or a checkpoint path. Not neither. Aborting.");
@@ -194,7 +678,10 @@ def iw_log_p_x_generated(model=None, path=None, n_batches=10, batch_size=64, n_s
         model = load_from_checkpoint(path, world_master=True, ddp=ddp, device_name=device_name, evaluation=True,
                                      return_loss_term_manager=False)
 
-    log_p_xs, log_p_x_ws = [], []
+    log_p_xs, log_p_x_ws, lens_gen = [], [], []
+
+    # Generated sentences are often the same (short, generic), see iw_log_p_x for the duplicates modes
+    keys, known = [], {}
 
     for batch_i in range(n_batches):
         if verbose:
@@ -216,21 +703,37 @@ def iw_log_p_x_generated(model=None, path=None, n_batches=10, batch_size=64, n_s
 
             padded_predictions, mask, lens = make_batch_from_model_samples(out["predictions"])
 
-            batch = dict(input_ids=padded_predictions.to(device_name), attention_mask=mask.to(device_name))
+            batch = dict(input_ids=padded_predictions, attention_mask=mask)
+            keys.extend(sequence_keys(padded_predictions, mask))
 
-            log_p_x = iw_log_p_x(model, batch, n_samples=n_samples, n_chunks=n_chunks, verbose=True).cpu()
+            if duplicates == "reuse":
+                log_p_x = iw_log_p_x_known(model, batch, known, n_samples=n_samples, n_chunks=n_chunks,
+                                           verbose=True, max_tokens=max_tokens)
+            else:
+                log_p_x = iw_log_p_x(model, batch, n_samples=n_samples, n_chunks=n_chunks, verbose=True,
+                                     max_tokens=max_tokens).cpu()
+            lens = lens.cpu()
             log_p_x_w = log_p_x / lens
 
             log_p_xs.append(log_p_x)
             log_p_x_ws.append(log_p_x_w)
+            lens_gen.append(lens)
 
     log_p_xs = torch.cat(log_p_xs)
-    log_p_x_ws = torch.cat(log_p_x_ws)
+    lens_gen = torch.cat(lens_gen)
+
+    if duplicates == "pool":
+        log_p_xs = pool_duplicates(log_p_xs, keys)
+    log_p_x_ws = log_p_xs / lens_gen
 
-    return log_p_xs, log_p_x_ws, lens
+    report_duplicates(keys, name="Generated:")
 
+    return log_p_xs, log_p_x_ws, lens_gen
+
+@cached_result(version=1, key_args=("n_samples", "max_batches", "sampling", "duplicates"))
 def iw_log_p_x_dataset(data_loader, model=None, path=None, n_samples=600, n_chunks=3,
-                       verbose=False, ddp=False, device_name="cuda:0", max_batches=-1):
+                       verbose=False, ddp=False, device_name="cuda:0", max_batches=-1, max_tokens=None,
+                       sampling="iid", duplicates="reuse"):
     if model is None and path is None:
         print("Either provide a model, or a checkpoint path. Not neither. Aborting.");
         quit()
@@ -245,6 +748,8 @@ def iw_log_p_x_dataset(data_loader, model=None, path=None, n_samples=600, n_chun
 
     log_p_xs = []
     sent_lens = []  # handy for perplexity
+    indices = []  # dataset indices, if the loader has them (length-sorted evaluation loader)
+    keys, known = [], {}  # duplicate sentences, see iw_log_p_x for the duplicates modes
     for batch_i, batch in enumerate(data_loader):
         if verbose is True:
             print("*" * 40)
@@ -252,32 +757,528 @@ def iw_log_p_x_dataset(data_loader, model=None, path=None, n_samples=600, n_chun
             print("*" * 40)
         batch = transfer_batch_to_device(batch, device_name=device_name)
 
+        keys.extend(sequence_keys(batch["input_ids"], batch["attention_mask"]))
+
         with torch.no_grad():
-            log_p_x = iw_log_p_x(model, batch, verbose=verbose,
-                                 n_chunks=n_chunks, n_samples=n_samples)
-            sent_lens.append(batch["attention_mask"].sum(dim=1))
+            if duplicates == "reuse":
+                log_p_x = iw_log_p_x_known(model, batch, known, verbose=verbose,
+                                           n_chunks=n_chunks, n_samples=n_samples, max_tokens=max_tokens,
+                                           sampling=sampling)
+            else:
+                log_p_x = iw_log_p_x(model, batch, verbose=verbose,
+                                     n_chunks=n_chunks, n_samples=n_samples, max_tokens=max_tokens,
+                                     sampling=sampling).cpu()
+            sent_lens.append(batch["attention_mask"].sum(dim=1).cpu())
             log_p_xs.append(log_p_x)
 
+        if "index" in batch:
+            indices.append(batch["index"].cpu())
+
         if batch_i + 1 == N:
             break
 
-    log_likelihood = torch.cat(log_p_xs, dim=0).cpu()
-    sent_lens = torch.cat(sent_lens, dim=0).cpu()
+    log_likelihood = torch.cat(log_p_xs, dim=0)
+    sent_lens = torch.cat(sent_lens, dim=0)
+
+    if duplicates == "pool":
+        log_likelihood = pool_duplicates(log_likelihood, keys)
+
+    report_duplicates(keys, name="Dataset:")
+
+    # Back in dataset order
+    if len(indices) > 0:
+        indices = torch.cat(indices)
+        log_likelihood = restore_original_order(log_likelihood, indices)
+        sent_lens = restore_original_order(sent_lens, indices)
     log_likelihood_p_w = log_likelihood / sent_lens
 
     return log_likelihood, log_likelihood_p_w, sent_lens
 
 
 def iw_perplexity(data_loader, model=None, path=None, n_samples=600, n_chunks=3,
-                  verbose=False, ddp=False, device_name="cuda:0", max_batches=-1):
+                  verbose=False, ddp=False, device_name="cuda:0", max_batches=-1, max_tokens=None,
+                  sampling="iid", duplicates="reuse"):
     _, log_likelihood_p_w, _ = iw_log_p_x_dataset(data_loader, model=model, path=path, n_samples=n_samples,
                                                   n_chunks=n_chunks, verbose=verbose, ddp=ddp,
-                                                  device_name=device_name, max_batches=max_batches)
+                                                  device_name=device_name, max_batches=max_batches,
+                                                  max_tokens=max_tokens, sampling=sampling,
+                                                  duplicates=duplicates)
     iw_ppl = torch.exp((-log_likelihood_p_w).mean())
 
     return iw_ppl.item()
 
 
+# ----------------------------------------------------------------------------------------------------
+# LATENT INTERPOLATION & TRAVERSAL
+# ----------------------------------------------------------------------------------------------------
+
+def encode_sentences(vae_model, tokenizer, sentences, batch_size=64, max_seq_len=64, device_name="cuda:0"):
+    """
+    Encode sentences to their posterior means. Every unique sentence is encoded once.
+
+    Args:
+        vae_model: NewsVAE
+        tokenizer: RobertaTokenizerFast
+        sentences: List[str]
+        batch_size: int
+        max_seq_len: int
+        device_name: str
+    Returns:
+        mu: Tensor [n_sentences, latent_size]
+    """
+    unique_sentences = list(dict.fromkeys(sentences))
+    sentence_index = {s: i for i, s in enumerate(unique_sentences)}
+
+    mus = []
+    for i in range(0, len(unique_sentences), batch_size):
+        encoded = tokenizer(unique_sentences[i:i + batch_size], padding=True, truncation=True,
+                            max_length=max_seq_len, return_tensors="pt")
+        encoded = transfer_batch_to_device(dict(encoded), device_name=device_name)
+        with torch.no_grad():
+            mus.append(vae_model.encoder(input_ids=encoded["input_ids"], attention_mask=encoded["attention_mask"],
+                                         return_embeddings=False)["mu"])
+
+    mu = torch.cat(mus, dim=0)
+    index = torch.tensor([sentence_index[s] for s in sentences], dtype=torch.long, device=mu.device)
+
+    return mu[index]
+
+
+def interpolation_latents(mu_start, mu_end, n_steps=10):
+    """
+    Points on the lines between two sets of latents (both end points included).
+
+    Args:
+        mu_start: Tensor [n_pairs, latent_size]
+        mu_end: Tensor [n_pairs, latent_size]
+        n_steps: int
+    Returns:
+        latents: Tensor [n_pairs, n_steps, latent_size]
+    """
+    alphas = torch.linspace(0.0, 1.0, n_steps, device=mu_start.device).view(1, -1, 1)
+    return mu_start.unsqueeze(1) + alphas * (mu_end - mu_start).unsqueeze(1)
+
+
+def traversal_latents(mu, dims, values):
+    """
+    Sweep single latent dimensions, keeping all other dimensions at their value in mu.
+
+    Args:
+        mu: Tensor [n_sentences, latent_size]
+        dims: List[int]
+            The dimensions to sweep
+        values: Tensor [n_values]
+            The values to set the swept dimension to
+    Returns:
+        latents: Tensor [n_sentences, n_dims, n_values, latent_size]
+    """
+    values = values.to(mu.device, mu.dtype)
+    latents = mu[:, None, None, :].repeat(1, len(dims), len(values), 1)
+    for i, d in enumerate(dims):
+        latents[:, i, :, d] = values.unsqueeze(0)
+    return latents
+
+
+def decode_latents(generator, latents, max_seq_len=64, nucleus_sampling=False, top_k=0, top_p=0.9):
+    """
+    Decode a tensor of latents of any leading shape in one go. Identical latent points are only decoded
+    once (with greedy decoding their outputs are identical anyway).
+
+    Args:
+        generator: ContinuousBatchingGenerator
+        latents: Tensor [..., latent_size]
+        max_seq_len: int
+        nucleus_sampling: bool
+        top_k: int
+        top_p: float
+    Returns:
+        predictions: Tensor [..., max_seq_len - 1]
+        n_decoded: int
+            The number of unique latents that were actually decoded
+    """
+    leading_shape = latents.shape[:-1]
+    flat_latents = latents.reshape(-1, latents.shape[-1])
+
+    if nucleus_sampling:
+        unique_latents, inverse = flat_latents, torch.arange(flat_latents.shape[0], device=flat_latents.device)
+    else:
+        unique_latents, inverse = torch.unique(flat_latents, dim=0, return_inverse=True)
+
+    predictions = generator.generate(unique_latents, max_seq_len=max_seq_len, nucleus_sampling=nucleus_sampling,
+                                     top_k=top_k, top_p=top_p)
+    predictions = predictions[inverse.to(predictions.device)]
+
+    return predictions.reshape(leading_shape + (max_seq_len - 1,)), unique_latents.shape[0]
+
+
+def predictions_to_text(predictions, tokenizer, eos_token_id=2):
+    """
+    Decode generated token ids (without <s>) to text, every unique output is decoded once.
+
+    Args:
+        predictions: Tensor [..., seq_len]
+        tokenizer: RobertaTokenizerFast
+    Returns:
+        texts: nested List[str] with the leading shape of predictions
+        unique_texts: List[str]
+    """
+    leading_shape = predictions.shape[:-1]
+    unique_predictions, inverse = torch.unique(predictions.reshape(-1, predictions.shape[-1]), dim=0,
+                                               return_inverse=True)
+
+    unique_texts = []
+    for p in unique_predictions.tolist():
+        p = p[:p.index(eos_token_id)] if eos_token_id in p else p
+        unique_texts.append(tokenizer.decode(p, skip_special_tokens=True).strip())
+
+    texts = np.array(unique_texts, dtype=object)[inverse.cpu().numpy()].reshape(tuple(leading_shape)).tolist()
+
+    return texts, sorted(set(unique_texts))
+
+
+def latent_interpolation_and_traversal(vae_model, tokenizer, sentence_pairs=None, sentences=None,
+                                       n_interpolation_steps=10, traversal_dims=None, traversal_values=None,
+                                       max_seq_len=64, encode_batch_size=64, max_decode_memory_mb=2048,
+                                       nucleus_sampling=False, top_k=0, top_p=0.9, generator=None,
+                                       device_name="cuda:0"):
+    """
+    Decode interpolations between sentence pairs and single dimension traversals around sentences.
+    All sentences are encoded once, all interpolation and traversal points are built as one latent tensor
+    that is decoded by a ContinuousBatchingGenerator in batches bounded by <max_decode_memory_mb>.
+
+    Args:
+        vae_model: NewsVAE
+        tokenizer: RobertaTokenizerFast
+        sentence_pairs: List[Tuple[str, str]]
+            Pairs to interpolate between (posterior means)
+        sentences: List[str]
+            Sentences to traverse the latent dimensions around (posterior means)
+        n_interpolation_steps: int
+        traversal_dims: List[int]
+            Dimensions to traverse, all dimensions if None
+        traversal_values: Tensor [n_values]
+            Values of the traversed dimension, linspace(-3, 3, 7) if None
+        max_seq_len: int
+        encode_batch_size: int
+        max_decode_memory_mb: int
+            Memory budget for the KV cache pool (and logits) of the decoder
+        generator: ContinuousBatchingGenerator
+            Reuse an existing generator, if None one is made for the budget
+        device_name: str
+    Returns:
+        results: Dict[str, Union[Tensor, List]]
+            interpolation_predictions [n_pairs, n_steps, max_seq_len - 1], interpolation_texts,
+            traversal_predictions [n_sentences, n_dims, n_values, max_seq_len - 1], traversal_texts,
+            unique_texts and the number of (unique) decoded latent points
+    """
+    sentence_pairs = [] if sentence_pairs is None else list(sentence_pairs)
+    sentences = [] if sentences is None else list(sentences)
+    assert len(sentence_pairs) + len(sentences) > 0, "Provide sentence_pairs and/or sentences. Aborting."
+
+    # Encode all sentences at once
+    all_sentences = [s for pair in sentence_pairs for s in pair] + sentences
+    mu = encode_sentences(vae_model, tokenizer, all_sentences, batch_size=encode_batch_size,
+                          max_seq_len=max_seq_len, device_name=device_name)
+    n_pair_sentences = 2 * len(sentence_pairs)
+
+    # Build all points as one tensor
+    latents = []
+    if len(sentence_pairs) > 0:
+        interpolations = interpolation_latents(mu[0:n_pair_sentences:2], mu[1:n_pair_sentences:2],
+                                               n_steps=n_interpolation_steps)
+        latents.append(interpolations.reshape(-1, mu.shape[-1]))
+
+    if len(sentences) > 0:
+        traversal_dims = list(range(mu.shape[-1])) if traversal_dims is None else list(traversal_dims)
+        traversal_values = torch.linspace(-3.0, 3.0, 7) if traversal_values is None else traversal_values
+        traversals = traversal_latents(mu[n_pair_sentences:], traversal_dims, traversal_values)
+        latents.append(traversals.reshape(-1, mu.shape[-1]))
+
+    latents = torch.cat(latents, dim=0)
+
+    if generator is None:
+        max_batch_size = ContinuousBatchingGenerator.slots_for_memory_budget(vae_model.decoder, max_seq_len,
+                                                                             max_decode_memory_mb)
+        generator = ContinuousBatchingGenerator(vae_model.decoder, max_batch_size=max_batch_size,
+                                                max_seq_len=max_seq_len, device_name=device_name)
+
+    predictions, n_decoded = decode_latents(generator, latents, max_seq_len=max_seq_len,
+                                            nucleus_sampling=nucleus_sampling, top_k=top_k, top_p=top_p)
+    texts, unique_texts = predictions_to_text(predictions, tokenizer)
+
+    results = dict(n_latent_points=latents.shape[0], n_decoded=n_decoded, unique_texts=unique_texts)
+
+    n_interpolation_points = len(sentence_pairs) * n_interpolation_steps
+    if len(sentence_pairs) > 0:
+        results["interpolation_predictions"] = predictions[:n_interpolation_points].reshape(
+            len(sentence_pairs), n_interpolation_steps, -1)
+        results["interpolation_texts"] = [texts[i:i + n_interpolation_steps]
+                                          for i in range(0, n_interpolation_points, n_interpolation_steps)]
+
+    if len(sentences) > 0:
+        n_dims, n_values = len(traversal_dims), len(traversal_values)
+        results["traversal_predictions"] = predictions[n_interpolation_points:].reshape(
+            len(sentences), n_dims, n_values, -1)
+        traversal_texts = texts[n_interpolation_points:]
+        results["traversal_texts"] = [[traversal_texts[(s * n_dims + d) * n_values:(s * n_dims + d + 1) * n_values]
+                                       for d in range(n_dims)] for s in range(len(sentences))]
+
+    return results
+
+
+# ----------------------------------------------------------------------------------------------------
+# DATASET LEVEL LATENT STATISTICS
+# ----------------------------------------------------------------------------------------------------
+
+class PosteriorIndex:
+    def __init__(self, mu, logvar):
+        """
+        The posteriors q(z|x) = N(mu, diag(exp(logvar))) of all sentences of a data split.
+
+        Args:
+            mu: Union[Tensor, np.ndarray] [N, latent_dim]
+            logvar: Union[Tensor, np.ndarray] [N, latent_dim]
+                (numpy arrays can be memory-mapped, see load)
+        """
+        self.mu = mu
+        self.logvar = logvar
+
+    def __len__(self):
+        return len(self.mu)
+
+    @property
+    def latent_dim(self):
+        return self.mu.shape[1]
+
+    def rows(self, rows, device_name="cpu"):
+        """
+        Get (mu, logvar) of a range or array of rows as float tensors on device.
+        """
+        mu, logvar = self.mu[rows], self.logvar[rows]
+        if not torch.is_tensor(mu):
+            mu, logvar = torch.from_numpy(np.array(mu)), torch.from_numpy(np.array(logvar))
+        return mu.float().to(device_name), logvar.float().to(device_name)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name, values in [("mu", self.mu), ("logvar", self.logvar)]:
+            values = values.cpu().numpy() if torch.is_tensor(values) else np.asarray(values)
+            np.save(os.path.join(path, f"{name}.npy"), values)
+
+    @staticmethod
+    def load(path, mmap=True):
+        """
+        Load an index, memory-mapped (only the rows that are used are read) unless mmap is False.
+        """
+        mmap_mode = "r" if mmap else None
+        n = json.load(open(os.path.join(path, "meta.json")))["n"] if os.path.isfile(os.path.join(path, "meta.json")) \
+            else None
+        mu = np.load(os.path.join(path, "mu.npy"), mmap_mode=mmap_mode)[:n]
+        logvar = np.load(os.path.join(path, "logvar.npy"), mmap_mode=mmap_mode)[:n]
+        return PosteriorIndex(mu, logvar)
+
+
+def build_posterior_index(vae_model, data_loader, device_name="cuda:0", max_batches=-1, path=None):
+    """
+    Encode a data split once into a PosteriorIndex. If a path is given, the posteriors are written to
+    memory-mapped files while encoding (for splits that do not fit in memory) and the index is memory-mapped.
+
+    Args:
+        vae_model: NewsVAE
+        data_loader: DataLoader
+        device_name: str
+        max_batches: int
+        path: str
+            Directory to write the index to (optional)
+    Returns:
+        index: PosteriorIndex
+    """
+    N = len(data_loader) if max_batches < 0 else min(max_batches, len(data_loader))
+    n_max = len(data_loader.dataset)
+    latent_dim = vae_model.decoder.latent_size
+
+    mus, logvars = [], []
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        mus = np.lib.format.open_memmap(os.path.join(path, "mu.npy"), mode="w+", dtype=np.float32,
+                                        shape=(n_max, latent_dim))
+        logvars = np.lib.format.open_memmap(os.path.join(path, "logvar.npy"), mode="w+", dtype=np.float32,
+                                            shape=(n_max, latent_dim))
+    n = 0
+
+    with torch.no_grad():
+        for batch_i, batch in enumerate(data_loader):
+            print("Encoding batch {:3d}/{:3d}".format(batch_i + 1, N), end="\r")
+            batch = transfer_batch_to_device(batch, device_name)
+
+            enc_out = vae_model.encoder(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                                        return_embeddings=False)
+            mu, logvar = enc_out["mu"].float().cpu(), enc_out["logvar"].float().cpu()
+
+            if path is not None:
+                mus[n:n + len(mu)], logvars[n:n + len(mu)] = mu.numpy(), logvar.numpy()
+            else:
+                mus.append(mu)
+                logvars.append(logvar)
+            n += len(mu)
+
+            if batch_i + 1 == N:
+                break
+
+    if path is None:
+        return PosteriorIndex(torch.cat(mus), torch.cat(logvars))
+
+    mus.flush()
+    logvars.flush()
+    json.dump({"n": n}, open(os.path.join(path, "meta.json"), "w"))
+
+    return PosteriorIndex.load(path, mmap=True)
+
+
+def posterior_collapse_statistics(vae_model, data_loader, device_name="cuda:0", max_batches=-1,
+                                  active_units_threshold=0.01, ddp=False):
+    """
+    Exact split level posterior collapse diagnostics (active units, per dimension KL, variance of mu over x,
+    posterior std statistics) in one streaming pass, see PosteriorStatsAccumulator. With ddp every rank encodes
+    its own part of the split and the accumulators are merged over the ranks.
+
+    Args:
+        vae_model: NewsVAE
+        data_loader: DataLoader
+        device_name: str
+        max_batches: int
+        active_units_threshold: float
+        ddp: bool
+    Returns:
+        results: Dict[str, Union[int, float, np.ndarray]]
+    """
+    N = len(data_loader) if max_batches < 0 else min(max_batches, len(data_loader))
+    accumulator = PosteriorStatsAccumulator(active_units_threshold=active_units_threshold)
+
+    with torch.no_grad():
+        for batch_i, batch in enumerate(data_loader):
+            print("Encoding batch {:3d}/{:3d}".format(batch_i + 1, N), end="\r")
+            batch = transfer_batch_to_device(batch, device_name)
+
+            enc_out = vae_model.encoder(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+                                        return_embeddings=False)
+            accumulator.update(enc_out["mu"], enc_out["logvar"])
+
+            if batch_i + 1 == N:
+                break
+
+    if ddp:
+        accumulator.all_reduce(latent_dim=vae_model.decoder.latent_size, device_name=device_name)
+
+    return accumulator.results()
+
+
+def dataset_latent_statistics(index, n_z=-1, z_chunk_size=1024, x_block_size=4096, device_name="cuda:0",
+                              seed=0, prod_marginals=True, rank=0, world_size=1):
+    """
+    Dataset level latent statistics with the exact empirical aggregate posterior q(z) = 1/N sum_j q(z|x_j)
+    over all N posteriors of the index (instead of the minibatch weighted estimate of Chen et al.):
+
+        mutual information  E_x E_q(z|x) [log q(z|x) - log q(z)]
+        marginal KL         E_q(z) [log q(z) - log p(z)]
+        total correlation   E_q(z) [log q(z) - sum_d log q(z_d)]
+        dimension-wise KL   E_q(z) [log q(z_d) - log p(z_d)]    per dimension d
+
+    One sample z_i ~ q(z|x_i) is drawn for (a random subset of n_z of) the data points. The index is streamed
+    in blocks of x_block_size posteriors (each block is moved to the device once) and the logsumexp over all
+    posteriors is accumulated per block. With world_size > 1 (initialised process group) the samples are
+    divided over the ranks and the per-sample terms are gathered.
+
+    Args:
+        index: PosteriorIndex
+        n_z: int
+            Number of data points to draw a sample for (-1: all)
+        z_chunk_size: int
+            Number of samples evaluated at once against a block
+        x_block_size: int
+            Number of posteriors per block (the marginals are computed in sub-blocks, so that their
+            densities have at most z_chunk_size x x_block_size elements)
+        device_name: str
+        seed: int
+            Seed for the subset and the samples (same on all ranks)
+        prod_marginals: bool
+            Whether to compute the per dimension marginals (total correlation, dimension-wise KL)
+        rank: int
+        world_size: int
+    Returns:
+        results: Dict
+            per sample terms (Tensor [n_z], [n_z, latent_dim]) and their means
+    """
+    N, latent_dim = len(index), index.latent_dim
+    generator = torch.Generator().manual_seed(seed)
+
+    # Sub-sample the data points to evaluate q(z) for, divide them over the ranks
+    z_rows = torch.randperm(N, generator=generator)[:n_z] if 0 < n_z < N else torch.arange(N)
+    z_rows, _ = z_rows.sort()
+
+    # One sample per data point, drawn for all selected data points before they are divided over the ranks
+    # (on CPU, so the samples do not depend on the device or the number of ranks)
+    eps = torch.randn((len(z_rows), latent_dim), generator=generator)[rank::world_size]
+    z_rows = z_rows[rank::world_size]
+
+    mu_z, logvar_z = index.rows(z_rows.numpy())
+    latent_z = (mu_z + eps * torch.exp(0.5 * logvar_z)).to(device_name)
+    mu_z, logvar_z = mu_z.to(device_name), logvar_z.to(device_name)
+
+    n = len(latent_z)
+    log_q_z = torch.full((n,), -float("inf"), device=device_name)
+    log_q_z_d = torch.full((n, latent_dim), -float("inf"), device=device_name) if prod_marginals else None
+
+    with torch.no_grad():
+        for start in range(0, N, x_block_size):
+            print("Posterior block {:3d}/{:3d}".format(start // x_block_size + 1,
+                                                       int(np.ceil(N / x_block_size))), end="\r")
+            mu_x, logvar_x = index.rows(slice(start, start + x_block_size), device_name=device_name)
+
+            for z_start in range(0, n, z_chunk_size):
+                z_chunk = latent_z[z_start:z_start + z_chunk_size]
+                rows = slice(z_start, z_start + z_chunk_size)
+
+                log_dens = gaussian_log_density_matrix(z_chunk, mu_x, logvar_x)
+                log_q_z[rows] = torch.logaddexp(log_q_z[rows], torch.logsumexp(log_dens, dim=1))
+
+                if prod_marginals:
+                    # Blocks of the posteriors so that the [chunk, block, latent_dim] densities stay small
+                    sub_block = max(1, (z_chunk_size * x_block_size) // max(1, len(z_chunk) * latent_dim))
+                    for x_start in range(0, len(mu_x), sub_block):
+                        log_marg = logsumexp_marginal_densities(z_chunk, mu_x[x_start:x_start + sub_block],
+                                                                logvar_x[x_start:x_start + sub_block])
+                        log_q_z_d[rows] = torch.logaddexp(log_q_z_d[rows], log_marg)
+
+    log_q_z = log_q_z - np.log(N)
+
+    # [n, latent_dim]
+    log_q_z_x_d = gaussian_log_prob(latent_z, mu_z, logvar_z, reduce_latent_dim=False)
+    log_p_z_d = standard_normal_log_prob(latent_z, reduce_latent_dim=False)
+
+    terms = {
+        "rows": z_rows,
+        "mutual_information": (log_q_z_x_d.sum(dim=-1) - log_q_z).cpu(),
+        "marginal_kl": (log_q_z - log_p_z_d.sum(dim=-1)).cpu(),
+        "kl": gaussian_kl_standard_normal(mu_z, logvar_z).sum(dim=-1).cpu()
+    }
+
+    if prod_marginals:
+        log_q_z_d = log_q_z_d - np.log(N)
+        terms["total_correlation"] = (log_q_z - log_q_z_d.sum(dim=-1)).cpu()
+        terms["dim_kl"] = (log_q_z_d - log_p_z_d).cpu()
+
+    if world_size > 1:
+        terms = all_gather_results(terms, world_size)
+
+    results = {k: v.mean(dim=0) for k, v in terms.items() if k != "rows"}
+    results["per_sample"] = terms
+    results["n_x"] = N
+    results["n_z"] = len(terms["rows"])
+
+    return results
+
+
 # ----------------------------------------------------------------------------------------------------
 # SUMMARY STATS
 # ----------------------------------------------------------------------------------------------------
@@ -291,6 +1292,15 @@ def summary_statistics(path, run_name, data_loader, max_batches=-1,
     if result_file is None:
         result_file = f"{result_folder}/{run_name}/sum_stats_{run_name}.pth"
 
+    results_cat = summary_statistics_results(path, data_loader, max_batches=max_batches, device=device)
+
+    dump_pickle(results_cat, result_file)
+
+    return results_cat
+
+
+@cached_result(version=1, key_args=("max_batches",))
+def summary_statistics_results(path, data_loader, max_batches=-1, device="cuda:0"):
     # Make a loss term manager from checkpoint (includes the model)
     loss_term_manager = load_from_checkpoint(path, world_master=True, ddp=False, dataset_size=len(data_loader),
                                              device_name=device, evaluation=True, return_loss_term_manager=True)
@@ -299,11 +1309,15 @@ def summary_statistics(path, run_name, data_loader, max_batches=-1,
     loss_term_manager.objective = "vae"
 
     results = {}
+    indices = []  # dataset indices, if the loader has them (length-sorted evaluation loader)
     N = max_batches if max_batches > 0 else len(data_loader)
 
     for batch_i, batch in enumerate(data_loader):
         print("Batch {:3d}/{:3d}".format(batch_i + 1, N), end="\r")
 
+        if "index" in batch:
+            indices.append(batch["index"])
+
         with torch.no_grad():
             batch = transfer_batch_to_device(batch, device)
 
@@ -347,33 +1361,19 @@ def summary_statistics(path, run_name, data_loader, max_batches=-1,
         else:
             results_cat[k] = v
 
-    dump_pickle(results_cat, result_file)
-
-
-def calc_posterior_stats(mu, logvar):
-    stats_dict = {}
-    std = torch.sqrt(logvar.exp())
+    # Per example results back in dataset order
+    if len(indices) > 0:
+        results_cat = restore_original_order(results_cat, torch.cat(indices))
 
-    mean_z_mu = mu.mean(dim=1).mean()
-    std_z_mu = torch.std(mu, dim=1).mean()
+    return results_cat
 
-    mean_z_std = std.mean(dim=1).mean()
-    std_z_std = torch.std(std, dim=1).mean()
 
-    mean_x_mu = mu.mean(dim=0).mean()
-    std_x_mu = torch.std(mu, dim=0).mean()
-
-    mean_x_std = std.mean(dim=0).mean()
-    std_x_std = torch.std(std, dim=0).mean()
-
-    stats_dict["mean_mu"] = mean_z_mu.item()
-    stats_dict["std_z_mu"] = std_z_mu.item()
-    stats_dict["std_z_std"] = std_z_std.item()
-
-    stats_dict["mean_std"] = mean_z_std.item()
+def calc_posterior_stats(mu, logvar):
+    batch_stats = posterior_batch_stats(mu, logvar)
 
-    stats_dict["std_x_mu"] = std_x_mu.item()
-    stats_dict["std_x_std"] = std_x_std.item()
+    stats_dict = {"mean_mu": batch_stats["mean_z_mu"], "std_z_mu": batch_stats["std_z_mu"],
+                  "std_z_std": batch_stats["std_z_std"], "mean_std": batch_stats["mean_z_std"],
+                  "std_x_mu": batch_stats["std_x_mu"], "std_x_std": batch_stats["std_x_std"]}
 
     return stats_dict
 
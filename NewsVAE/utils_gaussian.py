@@ -0,0 +1,191 @@
+import math
+import torch
+
+"""
+Fused routines for diagonal Gaussians N(mu, diag(exp(logvar))) and the standard Normal prior, shared by the
+training losses (loss_and_optimisation.py, modules/encoder.py) and the evaluation code.
+
+    - exp(-logvar) (precision) is computed once and multiplied with, instead of dividing by exp(logvar)
+    - the normalising terms (logvar + log 2pi) are reduced per Gaussian before broadcasting them over samples
+    - pairwise densities use matrix multiplies instead of [z_batch, x_batch, latent_dim] differences
+
+The functions are pure tensor code without host synchronisations or data dependent control flow, so they can be
+wrapped with torch.compile (e.g. torch.compile(gaussian_log_prob)) to fuse the element wise work into one kernel.
+
+Functions in this file:
+    - gaussian_log_prob(latent_z, mu, logvar, reduce_latent_dim=True, precision=None)
+    - standard_normal_log_prob(latent_z, reduce_latent_dim=True)
+    - gaussian_kl_standard_normal(mu, logvar, var=None)
+    - posterior_prior_log_probs(latent_z, mu, logvar, return_kl=False)
+    - gaussian_log_density_matrix(latent_z, mu, logvar, double_precision=False)
+    - logsumexp_marginal_densities(latent_z, mu, logvar, log_weights=None)
+"""
+
+LOG_2PI = math.log(2 * math.pi)
+
+
+def gaussian_log_prob(latent_z, mu, logvar, reduce_latent_dim=True, precision=None):
+    """
+    log N(z | mu, diag(exp(logvar))), broadcasting latent_z against mu and logvar.
+
+    Args:
+        latent_z: Tensor [..., latent_dim]
+        mu: Tensor [..., latent_dim]
+        logvar: Tensor [..., latent_dim]
+        reduce_latent_dim: bool
+            sum over the latent dimensions
+        precision: Tensor [..., latent_dim]
+            Optional, exp(-logvar) if it is already computed
+    Returns:
+        log_prob: Tensor [...] or [..., latent_dim]
+    """
+    if precision is None:
+        precision = torch.exp(-logvar)
+
+    diff = latent_z - mu
+
+    if reduce_latent_dim:
+        # The normalising term is reduced on the (smaller) parameter shape and then broadcast
+        norm = logvar.sum(dim=-1) + mu.shape[-1] * LOG_2PI
+        return - 0.5 * ((diff * diff * precision).sum(dim=-1) + norm)
+
+    return - 0.5 * (diff * diff * precision + logvar + LOG_2PI)
+
+
+def standard_normal_log_prob(latent_z, reduce_latent_dim=True):
+    """
+    log N(z | 0, I)
+
+    Args:
+        latent_z: Tensor [..., latent_dim]
+        reduce_latent_dim: bool
+    Returns:
+        log_prob: Tensor [...] or [..., latent_dim]
+    """
+    if reduce_latent_dim:
+        return - 0.5 * ((latent_z * latent_z).sum(dim=-1) + latent_z.shape[-1] * LOG_2PI)
+
+    return - 0.5 * (latent_z * latent_z + LOG_2PI)
+
+
+def gaussian_kl_standard_normal(mu, logvar, var=None):
+    """
+    Analytical KL(N(mu, diag(exp(logvar))) || N(0, I)) per latent dimension.
+
+    Args:
+        mu: Tensor [..., latent_dim]
+        logvar: Tensor [..., latent_dim]
+        var: Tensor [..., latent_dim]
+            Optional, exp(logvar) if it is already computed
+    Returns:
+        kl: Tensor [..., latent_dim]
+    """
+    if var is None:
+        var = torch.exp(logvar)
+
+    return 0.5 * (mu * mu + var - logvar - 1)
+
+
+def posterior_prior_log_probs(latent_z, mu, logvar, return_kl=False):
+    """
+    log q(z|x) and log p(z) of (multiple) posterior samples per x, reduced over the latent dimensions, and
+    optionally the analytical KL(q(z|x) || p(z)) per latent dimension. The precision exp(-logvar), its
+    reciprocal (the variance of the KL) and the normalising terms are computed once per x on [batch, latent_dim]
+    and shared, only the squares are formed on [batch, n_samples, latent_dim].
+
+    Args:
+        latent_z: Tensor [batch, n_samples, latent_dim]
+        mu: Tensor [batch, latent_dim]
+        logvar: Tensor [batch, latent_dim]
+        return_kl: bool
+    Returns:
+        log_q_z_x: Tensor [batch, n_samples]
+        log_p_z: Tensor [batch, n_samples]
+        kl: Tensor [batch, latent_dim]
+            Only if return_kl
+    """
+    latent_dim = latent_z.shape[-1]
+    precision = torch.exp(-logvar)
+
+    # [batch, 1] normalising term of q(z|x), [batch, n_samples, latent_dim] scaled square
+    norm_q = logvar.sum(dim=-1, keepdim=True) + latent_dim * LOG_2PI
+    diff = latent_z - mu.unsqueeze(1)
+
+    log_q_z_x = - 0.5 * ((diff * diff * precision.unsqueeze(1)).sum(dim=-1) + norm_q)
+    log_p_z = - 0.5 * ((latent_z * latent_z).sum(dim=-1) + latent_dim * LOG_2PI)
+
+    if not return_kl:
+        return log_q_z_x, log_p_z
+
+    kl = gaussian_kl_standard_normal(mu, logvar, var=torch.reciprocal(precision))
+
+    return log_q_z_x, log_p_z, kl
+
+
+def gaussian_log_density_matrix(latent_z, mu, logvar, double_precision=False):
+    """
+    Log density of every z under every diagonal Gaussian, summed over the latent dimensions, with the square
+    in the exponent expanded into matrix multiplies: sum_d (z_d - mu_d)^2 / var_d =
+    z^2 @ (1 / var) - 2 z @ (mu / var) + sum_d mu_d^2 / var_d.
+
+    The expanded terms cancel, so z and mu are first centred on the mean of mu (which leaves the differences
+    unchanged and removes most of the cancellation). For very narrow Gaussians, double_precision computes the
+    expansion in float64 (slow on most GPUs and twice the memory), the result has the dtype of latent_z.
+
+    Args:
+        latent_z: Tensor [z_batch, latent_dim]
+        mu: Tensor [x_batch, latent_dim]
+        logvar: Tensor [x_batch, latent_dim]
+        double_precision: bool
+    Returns:
+        log_dens: Tensor [z_batch, x_batch]
+    """
+    dtype = latent_z.dtype
+    if double_precision:
+        latent_z, mu, logvar = latent_z.double(), mu.double(), logvar.double()
+
+    # [1, latent_dim]
+    center = mu.detach().mean(dim=0, keepdim=True)
+    latent_z, mu = latent_z - center, mu - center
+
+    precision = torch.exp(-logvar)
+    mu_precision = mu * precision
+
+    # [1, x_batch] normalising term and the constant of the square
+    norm_term = logvar.sum(dim=-1) + mu.shape[-1] * LOG_2PI + (mu * mu_precision).sum(dim=-1)
+
+    # [z_batch, x_batch]
+    square_term = torch.addmm(norm_term.unsqueeze(0), latent_z * latent_z, precision.t())
+    square_term = torch.addmm(square_term, latent_z, mu_precision.t(), alpha=-2.0)
+
+    return (- 0.5 * square_term).to(dtype)
+
+
+def logsumexp_marginal_densities(latent_z, mu, logvar, log_weights=None):
+    """
+    Per latent dimension, log sum_j w_j q(z_d|mu_jd, sigma_jd) (the unnormalised log marginal density).
+    The per Gaussian terms (normalisation, log weights) are computed on [x_batch, latent_dim], only the
+    scaled square is formed on [z_batch, x_batch, latent_dim].
+
+    Args:
+        latent_z: Tensor [z_batch, latent_dim]
+        mu: Tensor [x_batch, latent_dim]
+        logvar: Tensor [x_batch, latent_dim]
+        log_weights: Tensor [x_batch]
+            log w_j, None: w_j = 1
+    Returns:
+        log_marg: Tensor [z_batch, latent_dim]
+    """
+    # Scale by the std once on [x_batch, latent_dim]: (z - mu)^2 / var = (z / std - mu / std)^2
+    inv_std = torch.exp(-0.5 * logvar)
+
+    # [x_batch, latent_dim]
+    norm = - 0.5 * (logvar + LOG_2PI)
+    if log_weights is not None:
+        norm = norm + log_weights.unsqueeze(-1)
+
+    # [z_batch, x_batch, latent_dim]
+    scaled_diff = latent_z.unsqueeze(1) * inv_std.unsqueeze(0) - (mu * inv_std).unsqueeze(0)
+    log_dens = norm.unsqueeze(0) - 0.5 * scaled_diff * scaled_diff
+
+    return torch.logsumexp(log_dens, dim=1)
@@ -1,60 +1,213 @@
-from torch.distributions import MultivariateNormal
 import torch
+import torch.utils.checkpoint
+import math
 
 
 # -------------------------------------------------------------------------------------------
-# PyTorch Gaussian KDE (used for optimisation in loss_and_optimisation.py)
+# PyTorch Gaussian KDE (used for the kernel estimate of log q(z) in mutual_information.py)
 # -------------------------------------------------------------------------------------------
 
-# The code for the GaussianKDE class below is taken from this forum post:
-# https://discuss.pytorch.org/t/kernel-density-estimation-as-loss-function/62261/8
 class GaussianKDE:
-    def __init__(self, X, bw, device="cuda:0"):
+    def __init__(self, X, bw="scott", covariance="full", rank=None, device=None):
         """
-        X : tensor (n, d)
-          `n` points with `d` dimensions to which KDE will be fit
-        bw : numeric
-          bandwidth for Gaussian kernel
+        Gaussian kernel density estimate fit to the rows of X, the torch equivalent of scipy.stats.gaussian_kde:
+        the kernel covariance is the data covariance scaled by bw_factor ** 2. The points are whitened once at
+        fit time, so scoring is a (blocked) matrix multiply followed by a logsumexp over the points, which
+        also works for 100k+ points and queries on the GPU.
+
+        Args:
+            X: Tensor [n, d]
+                Points to fit the KDE to
+            bw: Union[str, float]
+                "scott" (n ** (-1 / (d + 4))), "silverman" ((n * (d + 2) / 4) ** (-1 / (d + 4))) or a fixed factor
+            covariance: str
+                "full" (data covariance, as scipy), "diagonal" (data variances) or "identity"
+                (the bandwidth factor is then the absolute kernel width)
+            rank: int
+                Optional, with covariance="full": low-rank whitening, only the top rank principal directions of the
+                data covariance are kept, the other directions get their mean variance (probabilistic PCA).
+                Keeps the whitening well conditioned if the data covariance is (nearly) singular.
+            device: str
+                Optional, device to fit and score on (default: the device of X)
         """
+        assert covariance in ["full", "diagonal", "identity"], f"Unknown KDE covariance: {covariance}. Aborting."
+        assert rank is None or covariance == "full", "Low-rank whitening needs covariance='full'. Aborting."
+
+        if device is not None:
+            X = X.to(device)
+
+        self.n, self.dims = X.shape
+        self.covariance = covariance
 
-        self.X = X
-        # D.W. Scott, “Multivariate Density Estimation: Theory, Practice, and Visualization”, J
-        # ohn Wiley & Sons, New York, Chicester, 1992.
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.stats.gaussian_kde.html
         if bw == "scott":
-            n, d = X.shape
-            bw = n ** (-1. / (d + 4))
-        self.bw = bw
-        self.dims = X.shape[-1]
-        self.n = X.shape[0]
-        self.mvn = MultivariateNormal(loc=torch.zeros(self.dims).to(device),
-                                      covariance_matrix=torch.eye(self.dims).to(device))
-
-    def score_samples(self, Y, X=None):
-        """Returns the kernel density estimates of each point in `Y`.
-
-        Parameters
-        ----------
-        Y : tensor (m, d)
-          `m` points with `d` dimensions for which the probability density will
-          be calculated
-        X : tensor (n, d), optional
-          `n` points with `d` dimensions to which KDE will be fit. Provided to
-          allow batch calculations in `log_prob`. By default, `X` is None and
-          all points used to initialize KernelDensityEstimator are included.
-
-
-        Returns
-        -------
-        log_probs : tensor (m)
-          log probability densities for each of the queried points in `Y`
+            self.bw_factor = self.n ** (-1. / (self.dims + 4))
+        elif bw == "silverman":
+            self.bw_factor = (self.n * (self.dims + 2) / 4.) ** (-1. / (self.dims + 4))
+        else:
+            self.bw_factor = float(bw)
+
+        # The bandwidth is a property of the fit, not something to differentiate through
+        whitening, log_det_cov = self.fit_whitening(X.detach(), covariance, rank)
+        self.whitening = whitening.to(X.dtype) if whitening is not None else None
+
+        # [n, d] whitened and scaled by 1 / bw_factor
+        self.points = self.whiten(X)
+        self.points_sq_norm = self.points.pow(2).sum(dim=-1)
+
+        # log (1 / (n sqrt((2 pi)^d |bw_factor^2 cov|)))
+        self.log_norm = - math.log(self.n) - 0.5 * self.dims * math.log(2 * math.pi) \
+                        - self.dims * math.log(self.bw_factor) - 0.5 * log_det_cov
+
+    @staticmethod
+    def fit_whitening(X, covariance, rank=None):
+        """
+        Returns the matrix W with W^T cov W = I ([d, d] for full, [d] for diagonal, None for identity) and
+        log |cov|. Computed in double precision.
         """
-        if X is None:
-            X = self.X
+        if covariance == "identity":
+            return None, 0.0
+
+        X = X.double()
+        X_centered = X - X.mean(dim=0, keepdim=True)
+
+        if covariance == "diagonal":
+            var = X_centered.pow(2).sum(dim=0) / (X.shape[0] - 1)
+            return var.rsqrt(), var.log().sum().item()
+
+        cov = X_centered.t() @ X_centered / (X.shape[0] - 1)
+        eig_vals, eig_vecs = torch.linalg.eigh(cov)
+
+        if rank is not None and rank < X.shape[1]:
+            # eigh sorts ascending: the last rank are the principal directions,
+            # the remaining directions get their mean variance
+            n_rest = X.shape[1] - rank
+            eig_vals = torch.cat([eig_vals[:n_rest].mean().expand(n_rest), eig_vals[n_rest:]])
+
+        return eig_vecs * eig_vals.rsqrt().unsqueeze(0), eig_vals.log().sum().item()
+
+    def whiten(self, X):
+        if self.whitening is None:
+            X_white = X
+        elif self.covariance == "diagonal":
+            X_white = X * self.whitening
+        else:
+            X_white = X @ self.whitening
+        return X_white / self.bw_factor
+
+    def score_samples(self, Y, query_block_size=4096, point_block_size=16384):
+        """
+        Returns the kernel density estimates of each point in Y. The queries and the points are processed in blocks,
+        so memory stays at [query_block_size, point_block_size] whatever the number of points.
+
+        Args:
+            Y: Tensor [m, d]
+                Points for which the log density is calculated
+            query_block_size: int
+            point_block_size: int
+        Returns:
+            log_probs: Tensor [m]
+                log probability densities for each of the queried points in Y
+        """
+        Y_white = self.whiten(Y.to(self.points.device))
+        Y_sq_norm = Y_white.pow(2).sum(dim=-1)
+
+        log_probs = []
+        for q_start in range(0, Y_white.shape[0], query_block_size):
+            y, y_sq_norm = Y_white[q_start:q_start + query_block_size], Y_sq_norm[q_start:q_start + query_block_size]
+
+            # Logsumexp over the point blocks
+            log_sum = None
+            for p_start in range(0, self.n, point_block_size):
+                x = self.points[p_start:p_start + point_block_size]
+                x_sq_norm = self.points_sq_norm[p_start:p_start + point_block_size]
+
+                # [query_block, point_block] squared (whitened) distances
+                sq_dist = (y_sq_norm.unsqueeze(1) + x_sq_norm.unsqueeze(0) - 2.0 * (y @ x.t())).clamp(min=0.0)
+                block_log_sum = torch.logsumexp(-0.5 * sq_dist, dim=1)
+
+                log_sum = block_log_sum if log_sum is None else torch.logaddexp(log_sum, block_log_sum)
+
+            log_probs.append(log_sum)
+
+        return torch.cat(log_probs, dim=0) + self.log_norm
+
+    def log_prob(self, Y, **block_kwargs):
+        return self.score_samples(Y, **block_kwargs)
+
+
+# -------------------------------------------------------------------------------------------
+# Separable 1D Gaussian KDE (for the 1D KDE dim marginal KL in loss_and_optimisation.py)
+# -------------------------------------------------------------------------------------------
+
+def kde_1d_log_density(points, queries, bandwidth, block_size=1024):
+    """
+    Log density of 1D Gaussian KDEs, one per column: column d of the queries is evaluated under the KDE fit to
+    column d of the points. The queries are processed in blocks of block_size rows (the [block, n, d] differences
+    of a block are recomputed in the backward pass instead of kept) and the sum over the kernels is a logsumexp.
+
+    Args:
+        points: Tensor [n, d]
+        queries: Tensor [m, d]
+        bandwidth: Union[float, Tensor [d]]
+            Kernel standard deviation (per column)
+        block_size: int
+    Returns:
+        log_density: Tensor [m, d]
+    """
+    n = points.shape[0]
+    if not torch.is_tensor(bandwidth):
+        bandwidth = torch.tensor(bandwidth, dtype=points.dtype, device=points.device)
+    bandwidth = bandwidth.expand(points.shape[1])
+
+    # log (1 / (n h sqrt(2 pi)))
+    log_norm = - math.log(n) - torch.log(bandwidth) - 0.5 * math.log(2 * math.pi)
+
+    blocks = []
+    for start in range(0, queries.shape[0], block_size):
+        query_block = queries[start:start + block_size]
+        if torch.is_grad_enabled() and (query_block.requires_grad or points.requires_grad):
+            blocks.append(torch.utils.checkpoint.checkpoint(_kde_1d_logsumexp_block, points, query_block, bandwidth))
+        else:
+            blocks.append(_kde_1d_logsumexp_block(points, query_block, bandwidth))
+
+    return torch.cat(blocks, dim=0) + log_norm
+
+
+def _kde_1d_logsumexp_block(points, query_block, bandwidth):
+    # [block, n, d] -> [block, d]
+    z = (query_block.unsqueeze(1) - points.unsqueeze(0)) / bandwidth
+    return torch.logsumexp(-0.5 * z ** 2, dim=1)
+
+
+def kde_1d_dim_marginal_log_density(latents, mode="pooled", bw="scott", block_size=1024):
+    """
+    Estimate log q(z_d) for every latent dimension of every sample with 1D KDEs.
+
+    Modes:
+        - pooled: one KDE over all batch x latent_dim values (as a GaussianKDE with identity covariance on the
+          flattened latents), with the bandwidth rule n ** (-1/5), n = batch x latent_dim
+        - per_dimension: a KDE per dimension over its batch values, with bandwidth std_d * batch ** (-1/5)
+          (Scott's rule per dimension)
+
+    Args:
+        latents: Tensor [batch, latent_dim]
+        mode: str
+        bw: Union[str, float]
+            "scott" or a fixed bandwidth
+        block_size: int
+    Returns:
+        log_q_z_d: Tensor [batch, latent_dim]
+    """
+    assert mode in ["pooled", "per_dimension"], f"Unknown 1D KDE mode: {mode}. Aborting."
+
+    if mode == "pooled":
+        points = latents.reshape(-1, 1)
+        bandwidth = points.shape[0] ** (-1. / 5) if bw == "scott" else bw
+        return kde_1d_log_density(points, points, bandwidth, block_size=block_size).reshape(latents.shape)
 
-        log_probs = torch.log(
-            (self.bw ** (-self.dims) *
-             torch.exp(self.mvn.log_prob(
-                 (X.unsqueeze(1) - Y) / self.bw))).sum(dim=0) / self.n)
+    if bw == "scott":
+        bandwidth = latents.detach().std(dim=0) * latents.shape[0] ** (-1. / 5)
+    else:
+        bandwidth = bw
 
-        return log_probs
\ No newline at end of file
+    return kde_1d_log_density(latents, latents, bandwidth, block_size=block_size)
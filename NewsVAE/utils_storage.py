@@ -0,0 +1,456 @@
+import os
+import json
+import zlib
+import struct
+import hashlib
+import inspect
+import functools
+import weakref
+import numpy as np
+import torch
+
+# ----------------------------------------------------------------------------------------------------
+# APPEND-ONLY RESULT JOURNAL
+# ----------------------------------------------------------------------------------------------------
+#
+# A journal file is a sequence of records, one per unit of work (e.g. a batch). A record holds a key
+# and a number of named columns (arrays), stored column by column:
+#
+#     b"REC " | header length (uint64) | header (json: key, column names, dtypes, shapes) |
+#     column 0 bytes | column 1 bytes | ... | b"END " | crc32 of header + column bytes (uint32)
+#
+# The END marker with a valid checksum commits the record. A record that was cut off (e.g. the job was
+# preempted while writing) is not committed, and is truncated from the file when the journal is opened
+# again, after which new records are appended behind the last committed one.
+# ----------------------------------------------------------------------------------------------------
+
+RECORD_MARKER = b"REC "
+COMMIT_MARKER = b"END "
+
+
+class ResultJournal:
+    def __init__(self, path, read_only=False):
+        """
+        Open (or create) an append-only journal of results.
+
+        Args:
+            path: str
+                Path of the journal file
+            read_only: bool
+                Open for reading only: an uncommitted tail is ignored instead of truncated, so that
+                a journal can be read while another process is writing to it.
+        """
+        self.path = str(path)
+        self.read_only = read_only
+
+        # key -> (header, offset of the column data) of all committed records, in order of writing
+        self.records = {}
+
+        if os.path.isfile(self.path):
+            self.load()
+        elif not read_only:
+            open(self.path, "wb").close()
+
+    def load(self):
+        """
+        Read the headers of all committed records and truncate an uncommitted tail.
+        """
+        file_size = os.path.getsize(self.path)
+        committed_offset = 0
+
+        with open(self.path, "rb") as f:
+            while True:
+                record = self.read_record(f, file_size)
+                if record is None:
+                    break
+
+                header, data_offset = record
+                self.records[header["key"]] = (header, data_offset)
+                committed_offset = f.tell()
+
+        if committed_offset < file_size and not self.read_only:
+            print(f"Journal {self.path}: truncating {file_size - committed_offset} bytes of an uncommitted record.")
+            with open(self.path, "r+b") as f:
+                f.truncate(committed_offset)
+
+    @staticmethod
+    def read_record(f, file_size):
+        """
+        Read the header of the record at the current position of f and check its commit marker,
+        leaves f positioned after the record.
+
+        Returns:
+            (header, data_offset) or None if there is no (complete, committed) record
+        """
+        start = f.tell()
+        if file_size - start < len(RECORD_MARKER) + 8:
+            return None
+
+        if f.read(len(RECORD_MARKER)) != RECORD_MARKER:
+            return None
+
+        header_len, = struct.unpack("<Q", f.read(8))
+        header_bytes = f.read(header_len)
+        if len(header_bytes) < header_len:
+            return None
+
+        try:
+            header = json.loads(header_bytes.decode("utf-8"))
+        except ValueError:
+            return None
+
+        data_offset = f.tell()
+        data_len = sum(column["n_bytes"] for column in header["columns"])
+        if file_size - data_offset < data_len + len(COMMIT_MARKER) + 4:
+            return None
+
+        data = f.read(data_len)
+        if f.read(len(COMMIT_MARKER)) != COMMIT_MARKER:
+            return None
+
+        crc, = struct.unpack("<I", f.read(4))
+        if crc != zlib.crc32(header_bytes + data):
+            return None
+
+        return header, data_offset
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def keys(self):
+        return list(self.records.keys())
+
+    def append(self, key, columns):
+        """
+        Append and commit a record. The record is on disk (fsync) when this function returns.
+
+        Args:
+            key: str
+                Unique key of the record, e.g. "valid/12"
+            columns: Dict[str, Union[Tensor, np.ndarray]]
+                Named arrays to store
+        """
+        assert not self.read_only, "Journal is opened read only. Aborting."
+        assert key not in self.records, f"Record {key} is already in the journal. Aborting."
+
+        column_headers, column_bytes = [], []
+        for name, values in columns.items():
+            if torch.is_tensor(values):
+                values = values.detach().cpu().numpy()
+            values = np.ascontiguousarray(values)
+            data = values.tobytes()
+
+            column_headers.append({"name": name, "dtype": values.dtype.str, "shape": list(values.shape),
+                                   "n_bytes": len(data)})
+            column_bytes.append(data)
+
+        header = {"key": key, "columns": column_headers}
+        header_bytes = json.dumps(header).encode("utf-8")
+        data = b"".join(column_bytes)
+
+        with open(self.path, "ab") as f:
+            f.write(RECORD_MARKER + struct.pack("<Q", len(header_bytes)) + header_bytes)
+            data_offset = f.tell()
+            f.write(data)
+            f.write(COMMIT_MARKER + struct.pack("<I", zlib.crc32(header_bytes + data)))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.records[key] = (header, data_offset)
+
+    def read(self, keys=None):
+        """
+        Read the columns of committed records, concatenated (along the first dimension) in order of writing.
+
+        Args:
+            keys: List[str]
+                Which records to read (default: all)
+        Returns:
+            columns: Dict[str, np.ndarray]
+        """
+        keys = self.keys() if keys is None else keys
+
+        columns = {}
+        with open(self.path, "rb") as f:
+            for key in keys:
+                header, offset = self.records[key]
+                f.seek(offset)
+
+                for column in header["columns"]:
+                    values = np.frombuffer(f.read(column["n_bytes"]), dtype=np.dtype(column["dtype"]))
+                    columns.setdefault(column["name"], []).append(values.reshape(column["shape"]))
+
+        return {name: np.concatenate(values) for name, values in columns.items()}
+
+
+def merge_journals(paths):
+    """
+    Merge the committed records of several journals (e.g. one per rank) into one dict of tensors.
+    Journals that do not exist (yet) are skipped, so this can be run while the journals are still
+    being written.
+
+    Args:
+        paths: List[str]
+    Returns:
+        merged: Dict[str, Tensor]
+    """
+    merged = {}
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+
+        for name, values in ResultJournal(path, read_only=True).read().items():
+            merged.setdefault(name, []).append(torch.from_numpy(values.copy()))
+
+    return {name: torch.cat(values) for name, values in merged.items()}
+
+
+# ----------------------------------------------------------------------------------------------------
+# CONTENT ADDRESSED RESULT CACHE
+# ----------------------------------------------------------------------------------------------------
+#
+# Evaluation results are stored under a key that is the hash of everything that determines them:
+# the function (name + version), the content of the checkpoint (or the parameters of the model),
+# the data (dataset fingerprint, split, size, batch size, sampler), the arguments that change the
+# result (e.g. the number of importance samples) and the seed of the run. A result is computed once
+# and then reused by every notebook or sweep that asks for the same thing. Caching is opt-in (pass
+# use_cache=True to a decorated function) and only useful for seeded runs, as the seed is part of the key.
+#
+#     <cache dir>/<function name>/<key>.pt      the result (torch.save, tensors stored as raw storage)
+#     <cache dir>/<function name>/<key>.json    the key components, to see what a file contains
+#
+# Bump the version of a function when a change to it changes its results.
+# ----------------------------------------------------------------------------------------------------
+
+RESULT_CACHE_DIR = os.environ.get("NEWSVAE_RESULT_CACHE",
+                                  os.path.join(os.path.expanduser("~"), ".cache", "newsvae-results"))
+
+# (real path, size, modification time) -> content hash, so large checkpoints are hashed once per process
+_file_fingerprints = {}
+
+# model -> (versions of its tensors, content hash), so a model is only hashed again after it changed
+_model_fingerprints = weakref.WeakKeyDictionary()
+
+
+def file_fingerprint(path, chunk_size=1 << 24):
+    """
+    Hash of the content of a file (e.g. a checkpoint), read in chunks.
+
+    Args:
+        path: str
+        chunk_size: int
+    Returns:
+        fingerprint: str
+    """
+    st = os.stat(path)
+    memo_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+    if memo_key not in _file_fingerprints:
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        _file_fingerprints[memo_key] = h.hexdigest()
+
+    return _file_fingerprints[memo_key]
+
+
+def model_fingerprint(model):
+    """
+    Hash of the parameters and buffers of a model (names, dtypes, shapes and values). The hash is
+    memoised per model and computed again only when a tensor of the model was modified in place
+    (e.g. by an optimiser step or load_state_dict), which is tracked by the tensor version counters.
+
+    Args:
+        model: torch.nn.Module
+    Returns:
+        fingerprint: str
+    """
+    state_dict = model.state_dict()
+    versions = tuple((name, tensor._version) for name, tensor in state_dict.items())
+
+    memo = _model_fingerprints.get(model)
+    if memo is not None and memo[0] == versions:
+        return memo[1]
+
+    h = hashlib.sha1()
+    for name, tensor in sorted(state_dict.items()):
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.float()
+        h.update(f"{name}|{tensor.dtype}|{list(tensor.shape)}".encode("utf-8"))
+        h.update(tensor.numpy().tobytes())
+
+    _model_fingerprints[model] = (versions, h.hexdigest())
+
+    return _model_fingerprints[model][1]
+
+
+def data_loader_fingerprint(data_loader):
+    """
+    Description of the data a data loader produces: the fingerprint of the (HuggingFace) dataset, its split
+    and size, the batch size and the sampler (with its rank and number of replicas if distributed).
+
+    Args:
+        data_loader: DataLoader
+    Returns:
+        fingerprint: Dict
+    """
+    dataset = data_loader.dataset
+
+    # Unwrap wrappers (e.g. IndexedDataset) around the arrow dataset
+    while not hasattr(dataset, "_fingerprint") and hasattr(dataset, "dataset"):
+        dataset = dataset.dataset
+
+    if hasattr(dataset, "_fingerprint"):
+        dataset_hash = dataset._fingerprint
+    else:
+        # Not an arrow dataset, describe it by its first examples
+        first = [dataset[i] for i in range(min(len(dataset), 16))]
+        dataset_hash = hashlib.sha1(repr(first).encode("utf-8")).hexdigest()
+
+    sampler = data_loader.sampler
+    batch_sampler = data_loader.batch_sampler
+
+    fingerprint = {
+        "dataset": dataset_hash,
+        "split": str(getattr(dataset, "split", None)),
+        "n_examples": len(dataset),
+        "batch_size": data_loader.batch_size,
+        "sampler": type(sampler).__name__,
+        "rank": getattr(sampler, "rank", None),
+        "num_replicas": getattr(sampler, "num_replicas", None)
+    }
+
+    # Custom batch samplers (e.g. LengthSortedBatchSampler) determine the batches themselves
+    if hasattr(batch_sampler, "batches"):
+        fingerprint["batch_sampler"] = type(batch_sampler).__name__
+        fingerprint["batches"] = hashlib.sha1(repr(batch_sampler.batches).encode("utf-8")).hexdigest()
+
+    return fingerprint
+
+
+class ResultCache:
+    def __init__(self, cache_dir=None):
+        """
+        On-disk store of results under content addressed keys (see above).
+
+        Args:
+            cache_dir: str
+                Directory of the cache (default: RESULT_CACHE_DIR, set with the NEWSVAE_RESULT_CACHE
+                environment variable)
+        """
+        self.cache_dir = cache_dir if cache_dir is not None else RESULT_CACHE_DIR
+
+    @staticmethod
+    def key(components):
+        """
+        Hash of the (json serialisable, otherwise repr-ed) key components.
+        """
+        return hashlib.sha1(json.dumps(components, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+    def path(self, name, key):
+        return os.path.join(self.cache_dir, name, f"{key}.pt")
+
+    def get(self, name, key):
+        """
+        Load a result, returns None if it is not in the cache.
+        """
+        path = self.path(name, key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            return torch.load(path, map_location="cpu", weights_only=False)
+        except TypeError:
+            # Older torch versions do not have weights_only
+            return torch.load(path, map_location="cpu")
+
+    def put(self, name, key, result, components=None):
+        """
+        Store a result. The file is written next to its destination and then moved in place, so a
+        preempted write never leaves a corrupt result in the cache.
+        """
+        path = self.path(name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(result, tmp_path)
+        os.replace(tmp_path, path)
+
+        if components is not None:
+            with open(path[:-len(".pt")] + ".json", "w") as f:
+                json.dump(components, f, sort_keys=True, indent=2, default=repr)
+
+
+def cached_result(version, key_args=(), model_args=("model", "vae_model"), path_args=("path", "model_path"),
+                  data_args=("data_loader", "valid_loader")):
+    """
+    Decorator that caches the result of an evaluation function in the ResultCache.
+
+    The key is made of the function name, version, the arguments in key_args (by name), the content hash of
+    the checkpoint (if a path is given, else the hash of the model parameters), the fingerprint of the data
+    loader(s) and the seed of the run (torch.initial_seed(), so only enable the cache in seeded runs).
+    Arguments that only determine how a result is computed (device, verbosity, chunking) are not part of it.
+
+    The decorated function takes two extra keyword arguments:
+        use_cache: bool
+            Whether to look up / store the result (default: False)
+        cache_dir: str
+            Directory of the cache (default: RESULT_CACHE_DIR)
+
+    Args:
+        version: int
+            Version of the function, bump it when the results of the function change
+        key_args: Tuple[str]
+            Names of the arguments that change the result
+        model_args: Tuple[str]
+            Names of the model arguments
+        path_args: Tuple[str]
+            Names of the checkpoint path arguments
+        data_args: Tuple[str]
+            Names of the data loader arguments
+    """
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, use_cache=False, cache_dir=None, **kwargs):
+            if not use_cache:
+                return f(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+
+            components = {"function": f.__name__, "version": version, "seed": torch.initial_seed()}
+            components.update({name: arguments[name] for name in key_args})
+
+            checkpoint_paths = [arguments[name] for name in path_args if arguments.get(name) is not None]
+            models = [arguments[name] for name in model_args if arguments.get(name) is not None]
+
+            if len(checkpoint_paths) > 0:
+                components["checkpoint"] = file_fingerprint(checkpoint_paths[0])
+            elif len(models) > 0:
+                components["model"] = model_fingerprint(models[0])
+
+            for name in data_args:
+                if arguments.get(name) is not None:
+                    components[name] = data_loader_fingerprint(arguments[name])
+
+            cache = ResultCache(cache_dir)
+            key = cache.key(components)
+
+            result = cache.get(f.__name__, key)
+            if result is not None:
+                print(f"Loaded cached result of {f.__name__} ({cache.path(f.__name__, key)})")
+                return result
+
+            result = f(*args, **kwargs)
+            cache.put(f.__name__, key, result, components=components)
+
+            return result
+
+        return wrapper
+
+    return decorator
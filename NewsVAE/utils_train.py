@@ -10,8 +10,9 @@ from scipy import stats
 import pandas as pd
 import pickle
 import torch
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torch.distributions import Normal
 from torch.utils.data.distributed import DistributedSampler
 
@@ -26,19 +27,29 @@ from dataset_wrappper import NewsData
 # INITIALISATION STUFF
 # ----------------------------------------------------------------------------------------------------
 
-def set_device(device_rank):
+def set_device(device_rank, device_type=None, n_threads=-1, world_size=1):
     """
     Set the device in case of cuda and give the device a name for .to(...) operations.
 
     Args:
         device_rank: Union[str, int]
             GPU rank if it is an integer, else "cpu" string.
+        device_type: str
+            "cuda" or "cpu", if None the device type is derived from device_rank (int: cuda, else: cpu). With "cpu"
+            device_rank can be the (integer) rank of a CPU process, a "cpu" device_rank always means CPU.
+        n_threads: int
+            Number of intra-op threads for a CPU process, if -1: the number of cores divided over the processes
+        world_size: int
+            Number of processes on this machine (to divide the cores over)
     Returns:
         device_name: str:
             A device name that can be used with .to(device)
     """
+    if device_type is None or type(device_rank) != int:
+        device_type = "cuda" if type(device_rank) == int else "cpu"
+
     # GPU
-    if type(device_rank) == int:
+    if device_type == "cuda":
         print(f"-> Setting device {device_rank}")
         torch.cuda.set_device(device_rank)
         cudnn.benchmark = True  # optimise backend algo
@@ -47,9 +58,63 @@ def set_device(device_rank):
     # CPU
     else:
         device_name = "cpu"
+
+        # Pin the number of threads, so that processes on the same machine do not oversubscribe the cores
+        if n_threads < 1:
+            n_threads = max(1, os.cpu_count() // max(1, world_size))
+        torch.set_num_threads(n_threads)
+        print(f"-> Using CPU with {n_threads} threads")
+
     return device_name
 
 
+def get_distributed_backend(device_type="cuda"):
+    """
+    Backend for torch.distributed: nccl for GPUs, gloo for CPUs.
+    """
+    return "nccl" if device_type == "cuda" else "gloo"
+
+
+def init_process_group(device_rank, world_size, device_type="cuda"):
+    """
+    Initialise the default process group (env:// init, see set_ddp_environment_vars) with the backend
+    that belongs to the device type.
+    """
+    dist.init_process_group(backend=get_distributed_backend(device_type), init_method='env://',
+                            world_size=world_size, rank=device_rank)
+
+
+def all_gather_results(results, world_size):
+    """
+    Gather a dict of results (tensors or lists) of all processes, on all processes, and concatenate them
+    per key in rank order. Works with both nccl and gloo, as the results are gathered as (CPU) objects.
+    Other values are returned as a list with the value of every rank.
+
+    Args:
+        results: Dict[str, Union[Tensor, List]]
+        world_size: int
+    Returns:
+        all_results: Dict[str, Union[Tensor, List]]
+    """
+    results = {k: v.cpu() if torch.is_tensor(v) else v for k, v in results.items()}
+
+    gathered = [None] * world_size
+    dist.all_gather_object(gathered, results)
+
+    all_results = dict()
+    for rank_results in gathered:
+        for k, v in rank_results.items():
+            all_results.setdefault(k, []).append(v)
+
+    for k, v in all_results.items():
+        if torch.is_tensor(v[0]):
+            all_results[k] = torch.cat(v)
+        elif isinstance(v[0], list):
+            all_results[k] = [x for rank_v in v for x in rank_v]
+
+    return all_results
+
+
 def set_ddp_environment_vars(port_nr=1235):
     """
     Set the environment variables for the DDP environment.
@@ -103,7 +168,7 @@ def determine_global_max_steps(max_global_train_steps, batch_size, world_size, a
     return max_global_train_steps, max_global_grad_steps_rank
 
 
-def get_world_specs(n_gpus, n_nodes, device_name):
+def get_world_specs(n_gpus, n_nodes, device_name, n_cpu_processes=1, device_rank=0):
     """
     Determine the world size and whether the current device is world master.
 
@@ -111,16 +176,24 @@ def get_world_specs(n_gpus, n_nodes, device_name):
         n_gpus: int
         n_nodes: int
         device_name: str
+        n_cpu_processes: int
+            Number of processes per node when running on CPU
+        device_rank: Union[int, str]
+            Rank of the current process (only used on CPU, on GPU the rank follows from the device name)
 
     Returns:
         world_size: int
             How many devices are active
         world_master: bool
-            Whether the current device is world master (GPU 0 or CPU)
+            Whether the current device is world master (GPU 0 or CPU rank 0)
     """
 
-    world_size = int(n_gpus * n_nodes) if "cuda" in device_name else 1
-    world_master = True if device_name in ["cuda:0", "cpu"] else False
+    if "cuda" in device_name:
+        world_size = int(n_gpus * n_nodes)
+        world_master = True if device_name == "cuda:0" else False
+    else:
+        world_size = int(n_cpu_processes * n_nodes)
+        world_master = True if device_rank in [0, "cpu"] else False
 
     return world_master, world_size
 
@@ -260,6 +333,160 @@ def get_dataloader(phases, ddp=False, batch_size=12, num_workers=8, max_seq_len=
     return loaders, data, samplers
 
 
+class LengthSortedBatchSampler(Sampler):
+    def __init__(self, lengths, batch_size, world_size=1, rank=0, max_batches=-1, seed=0):
+        """
+        Batch sampler for evaluation: examples are sorted by length (longest first) before they are batched,
+        so that a batch is hardly padded, and the batches are divided over the ranks by their (padded) number of
+        tokens instead of by their number of examples, so that all ranks finish at about the same time.
+
+        The batches of a rank are deterministic (needed to resume an evaluation). Evaluation results come in
+        sorted order, use the "index" of the batches (see get_length_sorted_loader) and restore_original_order
+        to put them back in dataset order. Only use it for per example outputs (e.g. log p(x)): the examples of a
+        batch have similar lengths and batch sizes vary, which changes minibatch estimates (minibatch weighted
+        log q(z), MI, TC, statistics over the batch).
+
+        Args:
+            lengths: Union[List[int], np.ndarray]
+                Sequence length of every example in the dataset
+            batch_size: int
+            world_size: int
+                Number of ranks to divide the batches over
+            rank: int
+                Rank of this process
+            max_batches: int
+                If > 0, only a random subset of max_batches x batch_size x world_size examples (in total) is used,
+                drawn with seed before sorting, so a partial evaluation is not biased towards long sequences.
+                As the batches are divided by tokens, a rank can get more or fewer than max_batches batches:
+                always iterate all batches of the sampler, cutting them off would drop the shortest sequences.
+            seed: int
+        """
+        lengths = np.asarray(lengths)
+
+        indices = np.arange(len(lengths))
+        if max_batches > 0 and max_batches * batch_size * world_size < len(lengths):
+            rng = np.random.RandomState(seed)
+            indices = rng.permutation(len(lengths))[:max_batches * batch_size * world_size]
+
+        # Longest first (stable, so ties are broken by index)
+        indices = indices[np.argsort(-lengths[indices], kind="stable")]
+        batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+        # Cost of a batch: number of tokens after padding to its longest member
+        costs = np.array([len(b) * lengths[b[0]] for b in batches])
+
+        # Longest processing time first: give the next most expensive batch to the least loaded rank
+        rank_tokens = np.zeros(world_size, dtype=np.int64)
+        rank_batches = [[] for _ in range(world_size)]
+        for batch_i in np.argsort(-costs, kind="stable"):
+            r = int(np.argmin(rank_tokens))
+            rank_batches[r].append(batch_i)
+            rank_tokens[r] += costs[batch_i]
+
+        # Per rank still longest first (memory problems show up at the start)
+        self.batches = [batches[batch_i].tolist() for batch_i in sorted(rank_batches[rank])]
+        self.rank_tokens = rank_tokens
+        self.rank = rank
+        self.num_replicas = world_size
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class IndexedDataset(Dataset):
+    def __init__(self, dataset):
+        """
+        Wraps a dataset of dicts to add the index of every example to it.
+        """
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        example = dict(self.dataset[index])
+        example["index"] = index
+        return example
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class IndexedCollate:
+    def __init__(self, collate_fn):
+        """
+        Wraps a collate function to add the dataset indices of the examples to the batch ("index").
+        """
+        self.collate_fn = collate_fn
+
+    def __call__(self, examples):
+        batch = self.collate_fn(examples)
+        batch["index"] = torch.tensor([e["index"] for e in examples], dtype=torch.long)
+        return batch
+
+
+def get_sequence_lengths(dataset):
+    """
+    Lengths of the (tokenised) examples of a dataset.
+    """
+    return np.array([len(input_ids) for input_ids in dataset["input_ids"]])
+
+
+def get_length_sorted_loader(dataset, collate_fn, batch_size=64, world_size=1, rank=0, max_batches=-1,
+                             num_workers=0, pin_memory=False, seed=0, lengths=None):
+    """
+    Get a data loader for evaluation that batches length-sorted examples and divides them over the ranks by
+    number of tokens (see LengthSortedBatchSampler). Every batch has an "index" with the dataset indices of
+    its examples.
+
+    Args:
+        dataset: Dataset
+        collate_fn: Callable
+        batch_size: int
+        world_size: int
+        rank: int
+        max_batches: int
+            If > 0, a random subset of max_batches x world_size batches in total (already applied by the sampler,
+            iterate the whole loader)
+        num_workers: int
+        pin_memory: bool
+        seed: int
+        lengths: np.ndarray
+            Sequence lengths of the examples (computed if not given)
+    Returns:
+        loader: torch.utils.data.DataLoader
+    """
+    lengths = get_sequence_lengths(dataset) if lengths is None else lengths
+
+    batch_sampler = LengthSortedBatchSampler(lengths, batch_size, world_size=world_size, rank=rank,
+                                             max_batches=max_batches, seed=seed)
+
+    return DataLoader(IndexedDataset(dataset), batch_sampler=batch_sampler, pin_memory=pin_memory,
+                      num_workers=num_workers, collate_fn=IndexedCollate(collate_fn))
+
+
+def restore_original_order(results, indices):
+    """
+    Put the (per example) results of a length-sorted evaluation back in dataset order.
+
+    Args:
+        results: Union[Tensor, Dict[str, Tensor]]
+            Results with the examples in the first dimension, values of a dict that are not
+            per example are left as they are
+        indices: Tensor [N]
+            Dataset indices of the examples (the "index" of the batches, concatenated)
+    Returns:
+        results: Union[Tensor, Dict[str, Tensor]]
+    """
+    order = torch.argsort(indices.cpu())
+
+    if torch.is_tensor(results):
+        return results[order.to(results.device)]
+
+    return {k: v[order.to(v.device)] if torch.is_tensor(v) and v.dim() > 0 and len(v) == len(order) else v
+            for k, v in results.items()}
+
+
 # ----------------------------------------------------------------------------------------------------
 # LOAD + SAVE MODEL & CHECKPOINTING
 # ----------------------------------------------------------------------------------------------------
@@ -411,6 +638,33 @@ def load_from_checkpoint(path, world_master=True, ddp=False, device_name="cuda:0
         return vae_model
 
 
+def load_shared_model(path, **load_kwargs):
+    """
+    Load a model from checkpoint once, on CPU and for evaluation, and move its parameters and buffers to shared
+    memory. Processes spawned with torch.multiprocessing that get the model as an argument attach to the same
+    (read-only) memory instead of each loading their own copy, so that the memory of a worker is mostly its
+    activations. Tied weights share their storage, so they are shared once.
+
+    Args:
+        path: str
+            Path to the checkpoint
+        load_kwargs:
+            Other arguments for load_from_checkpoint (device_name, evaluation and return_loss_term_manager are set)
+    Returns:
+        vae_model: NewsVAE
+    """
+    load_kwargs.update(dict(device_name="cpu", evaluation=True, return_loss_term_manager=False))
+    vae_model = load_from_checkpoint(path, **load_kwargs)
+
+    # No gradients, the workers only read the weights
+    for p in vae_model.parameters():
+        p.requires_grad_(False)
+
+    vae_model.share_memory()
+
+    return vae_model
+
+
 # Code for the fn below is taken from: https://stackoverflow.com/questions/32791911/fast-calculation-of-pareto-front-in-python
 # Fairly fast for many datapoints, less fast for many costs, somewhat readable
 def is_pareto_efficient_simple(costs):